@@ -31,15 +31,17 @@ class MapSquareAdmin(admin.ModelAdmin):
         return '(' + obj.coordinates + ')'
     show_coordinates.short_description = 'Coordinates'
 
+    def get_queryset(self, request):
+        # Count every map square's photos in the same query as the map squares
+        return super().get_queryset(request).with_num_photos()
+
     def count_photos(self, obj):
         """
         Returns an integer representing the number taken of that map square
         """
-
-        # filter for all photo objects with obj's map square number
-        photo_obj = Photo.objects.filter(map_square__number=obj.number)
-        return len(photo_obj)
+        return obj.num_photos
     count_photos.short_description = 'Number of Photos'
+    count_photos.admin_order_field = 'num_photos'
 
     @staticmethod
     def all_photos(obj):
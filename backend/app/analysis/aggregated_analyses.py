@@ -1,19 +1,190 @@
 """
 Module to aggregate analysis results for photos
+
+The yolo_model results of a set of photos are turned into a LabelCounts, a photos x labels
+matrix of how many of each object were found in each photo, in a single pass over the results.
+The statistics (frequent objects, objects in common, percentages, co-occurrence) are then
+computed on the whole matrix with NumPy, and can be stored as a CorpusAnalysisResult with
+materialize_label_statistics.
 """
 
+import json
 import os
 
-from app.models import PhotoAnalysisResult
-from app.analysis.yolo_pop_density import object_density
+import numpy as np
 
 from django.conf import settings
+from django.db import transaction
+
+from app.models import CorpusAnalysisResult, PhotoAnalysisResult
+from app.analysis.yolo_pop_density import object_density
 
 CLASS_NAMES_DIR = os.path.join(settings.YOLO_DIR, 'coco.names')
 with open(CLASS_NAMES_DIR, encoding='utf-8') as file:
     CLASS_NAMES = [line.strip() for line in file.readlines()]
 
 
+class LabelCounts:
+    """
+    Counts of each object label in each of a set of photos, as a photos x labels matrix.
+    Labels are the YOLO class names, followed by any other labels found in the results.
+    """
+
+    def __init__(self, yolo_dicts, photo_ids=None):
+        """
+        :param yolo_dicts: iterable of yolo_model results (dicts with a 'labels' dict of label
+                           to count)
+        :param photo_ids: optional ids of the photos the results are for, in the same order
+        """
+        self.labels = list(CLASS_NAMES)
+        label_indices = {label: i for i, label in enumerate(self.labels)}
+        rows, columns, values = [], [], []
+        num_photos = 0
+        for row, yolo_dict in enumerate(yolo_dicts):
+            num_photos += 1
+            for label, count in yolo_dict.get('labels', {}).items():
+                if label not in label_indices:
+                    label_indices[label] = len(self.labels)
+                    self.labels.append(label)
+                rows.append(row)
+                columns.append(label_indices[label])
+                values.append(count)
+
+        self.photo_ids = photo_ids
+        self.counts = np.zeros((num_photos, len(self.labels)), dtype=np.int32)
+        self.counts[rows, columns] = values
+        self.present = self.counts > 0
+
+    @classmethod
+    def from_database(cls, analysis_name='yolo_model', photos=None):
+        """
+        Load the results of analysis_name (for the given queryset of photos, or all of them)
+        in one query
+        """
+        analysis_results = PhotoAnalysisResult.objects.filter(name=analysis_name)
+        if photos is not None:
+            analysis_results = analysis_results.filter(photo__in=photos)
+        photo_ids, serialized_results = [], []
+        for photo_id, serialized_result in analysis_results.values_list('photo_id', 'result'):
+            photo_ids.append(photo_id)
+            serialized_results.append(serialized_result)
+        return cls(map(json.loads, serialized_results), photo_ids=photo_ids)
+
+    @property
+    def num_photos(self):
+        return self.counts.shape[0]
+
+    def label_columns(self, object_labels):
+        """
+        Columns of the matrix for object_labels, leaving out labels that were never seen
+        """
+        label_indices = {label: i for i, label in enumerate(self.labels)}
+        return [label_indices[label] for label in object_labels if label in label_indices]
+
+    def photo_counts(self):
+        """
+        Number of photos each label appears in
+        """
+        return self.present.sum(axis=0)
+
+    def totals(self):
+        """
+        Number of times each label was found, over all photos
+        """
+        return self.counts.sum(axis=0)
+
+    def frequent_objects(self, num=None):
+        """
+        The num labels (or all of them) that appear in the most photos, most frequent first
+        """
+        photo_counts = self.photo_counts()
+        # Stable sort, so ties keep the order of the labels
+        order = np.argsort(-photo_counts, kind='stable')
+        order = order[photo_counts[order] > 0]
+        return [self.labels[i] for i in order[:num]]
+
+    def objects_in_common(self):
+        """
+        The labels found in every photo, most numerous first
+        """
+        if not self.num_photos:
+            return []
+        totals = self.totals()
+        in_common = np.flatnonzero(self.present.all(axis=0))
+        order = in_common[np.argsort(-totals[in_common], kind='stable')]
+        return [self.labels[i] for i in order]
+
+    def object_percentage(self, object_labels, any_objects=True):
+        """
+        Percentage of photos with any (or all, if not any_objects) of object_labels
+        """
+        if isinstance(object_labels, str):
+            object_labels = [object_labels]
+        columns = self.label_columns(object_labels)
+        if not self.num_photos:
+            return 0
+        if any_objects:
+            matches = self.present[:, columns].any(axis=1)
+        elif len(columns) < len(set(object_labels)):
+            # Some of the labels were never found
+            matches = np.zeros(self.num_photos, dtype=bool)
+        else:
+            matches = self.present[:, columns].all(axis=1)
+        return round(100 * matches.sum() / self.num_photos, 2)
+
+    def co_occurrence(self):
+        """
+        For every pair of labels found, the number of photos with both of them
+
+        :return: dict of label to dict of label to number of photos (the diagonal is the number of
+                 photos with the label)
+        """
+        found = np.flatnonzero(self.present.any(axis=0))
+        present = self.present[:, found].astype(np.int32)
+        matrix = present.T @ present
+        return {
+            self.labels[i]: {
+                self.labels[j]: int(matrix[row, column])
+                for column, j in enumerate(found) if matrix[row, column]
+            }
+            for row, i in enumerate(found)
+        }
+
+    def summary(self):
+        """
+        All of the statistics, as a JSON serializable dict
+        """
+        found = np.flatnonzero(self.present.any(axis=0))
+        photo_counts = self.photo_counts()
+        totals = self.totals()
+        return {
+            'num_photos': self.num_photos,
+            'photo_counts': {self.labels[i]: int(photo_counts[i]) for i in found},
+            'totals': {self.labels[i]: int(totals[i]) for i in found},
+            'percentages': {
+                self.labels[i]: round(100 * int(photo_counts[i]) / self.num_photos, 2)
+                for i in found
+            },
+            'frequent_objects': self.frequent_objects(),
+            'objects_in_common': self.objects_in_common(),
+            'co_occurrence': self.co_occurrence(),
+        }
+
+
+def materialize_label_statistics(analysis_name='yolo_model'):
+    """
+    Compute the LabelCounts statistics of every photo's analysis_name results, and store them as
+    the CorpusAnalysisResult named f'aggregated_{analysis_name}' (replacing any earlier one)
+    """
+    summary = LabelCounts.from_database(analysis_name).summary()
+    with transaction.atomic():
+        CorpusAnalysisResult.objects.filter(name=f'aggregated_{analysis_name}').delete()
+        CorpusAnalysisResult.objects.create(
+            name=f'aggregated_{analysis_name}', result=json.dumps(summary)
+        )
+    return summary
+
+
 def statistics_analysis(analysis_name, stat_func, photo_filter=lambda i, photo: True):
     """
     :param analysis_name:
@@ -22,7 +193,10 @@ def statistics_analysis(analysis_name, stat_func, photo_filter=lambda i, photo:
     :return:
     """
 
-    analysis_result_objects = PhotoAnalysisResult.objects.filter(name=analysis_name)
+    # Fetch the photos in the same query, for photo_filter
+    analysis_result_objects = PhotoAnalysisResult.objects.filter(
+        name=analysis_name
+    ).select_related('photo')
     if not analysis_result_objects:
         raise Exception(f'Analysis "{analysis_name}" has not been run or does not exist.')
 
@@ -51,73 +225,21 @@ def frequent_objects(num=None):
     """
 
     def run(dictionaries):
-        nonlocal num
-        result = {}
-
-        # create a dictionary to map objects to
-        # number of times it appears in photos
-        for photo_dictionary in dictionaries:
-            for obj in photo_dictionary.get("labels", {}):
-                result.setdefault(obj, 0)
-                result[obj] = + 1
-
-        # Group by quantity
-        quantity_groups = {}
-        for label, quantity in result.items():
-            quantity_groups.setdefault(quantity, [])
-            quantity_groups[quantity].append(label)
-
-        # get a list of reversed sorted values
-        # sorted_values = sorted(quantity_groups, key=lambda label: result[label],
-        #                        reverse=True)
-        result_labels = []
-        if num is None:
-            num = len(result)
-
-        for quantity in sorted(quantity_groups, reverse=True):
-            if len(result_labels) == num:
-                break
-            result_labels += quantity_groups[quantity]
-
-        return result_labels
+        return LabelCounts(dictionaries).frequent_objects(num)
 
     return run
 
 
 def objects_in_common():
     def run(yolo_dicts):
-        objects = set(CLASS_NAMES)
-        quantities = {}
-        for yolo_dict in yolo_dicts:
-            yolo_labels = yolo_dict.get('labels', {})
-            objects &= set(yolo_labels)
-            # Increase quantity for objects in common
-            for label in objects:
-                quantities.setdefault(label, 0)
-                quantities[label] += yolo_labels[label]
-        return sorted(objects, key=lambda obj_label: quantities[obj_label], reverse=True)
+        return LabelCounts(yolo_dicts).objects_in_common()
 
     return run
 
 
 def object_percentage(object_labels, any_objects=True):
-    if isinstance(object_labels, str):
-        object_labels = [object_labels]
-
     def run(yolo_dicts):
-        nonlocal object_labels
-
-        matches = 0
-        for yolo_dict in yolo_dicts:
-            objects = set(yolo_dict.get('labels', {}))
-            common = objects & set(object_labels)
-
-            matches += (
-                (any_objects and len(common) > 0) or
-                (not any_objects and len(common) == len(object_labels))
-            )
-
-        return round(100 * matches / len(yolo_dicts), 2)
+        return LabelCounts(yolo_dicts).object_percentage(object_labels, any_objects)
 
     return run
 
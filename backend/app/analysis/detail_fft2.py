@@ -6,8 +6,8 @@ analysis to calculate the level of detail by examining frequency of change in ph
 """
 
 from numpy.fft import fft2
-import cv2
 
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -17,12 +17,9 @@ def analyze(photo: Photo):
     """
     Calculate the standard deviation of pixels in the image using the fast fourier transform
     """
-    image = photo.get_image_data()
-
-    # Convert image to grayscale
-    # (Changes image array shape from (height, width, 3) to (height, width))
+    # Grayscale image shared with other analyses of this photo
     # (Pixels (image[h][w]) will be a value from 0 to 255)
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    grayscale_image = get_derived_images(photo).grayscale()
 
     # Take the 2-dimensional fourier transform of the image
     image_fft2 = fft2(grayscale_image)
@@ -9,6 +9,7 @@ intersect, which should be the vanishing point
 import numpy as np
 import cv2
 
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -20,11 +21,9 @@ def analyze(photo: Photo):
     where the vanishing point is the point that has the minimum sum of
     distances to all detected lines in the photo
     """
-    image = photo.get_image_data()
-    # Convert image to grayscale
-    # (Changes image array shape from (height, width, 3) to (height, width))
+    # Grayscale image shared with other analyses of this photo
     # (Pixels (image[h][w]) will be a value from 0 to 255)
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    grayscale_image = get_derived_images(photo).grayscale()
     lines = auto_canny(grayscale_image)
 
     filter_lines = []
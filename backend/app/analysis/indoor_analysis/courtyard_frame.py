@@ -4,9 +4,7 @@ analysis to determine whether there is a dark border around the photo, which wou
 that the photo was taken inside a courtyard or through an alleyway
 '''
 
-import numpy as np
-import cv2
-
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -16,13 +14,8 @@ def analyze(photo: Photo):
     Determines if an image is a courtyard photo by identifying a dark frame around outer boundary
     of photo. Returns boolean.
     """
-    image = photo.get_image_data()
-
-    # Convert image to grayscale
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    # Normalize image pixels to range from 0 to 1
-    normalized_grayscale_image = grayscale_image / np.max(grayscale_image)
+    # Grayscale image with pixels normalized to range from 0 to 1
+    normalized_grayscale_image = get_derived_images(photo).normalized_grayscale()
 
     # Setting up variables
     borders_passed = []
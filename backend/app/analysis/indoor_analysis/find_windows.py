@@ -8,6 +8,7 @@ in a given image or not
 
 import cv2
 
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -17,12 +18,9 @@ def analyze(photo: Photo):
     """
     Determine if a given image features a window
     """
-    image = photo.get_image_data()
-
-    # Convert image to grayscale
-    # (Changes image array shape from (height, width, 3) to (height, width))
+    # Grayscale image shared with other analyses of this photo
     # (Pixels (image[h][w]) will be a value from 0 to 255)
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    grayscale_image = get_derived_images(photo).grayscale()
 
     # Find up to 200 corners in the grayscale image
     # corners is a list of 2 double lists,
@@ -7,8 +7,8 @@ in image
 :return: boolean, True if a gradient was found, False otherwise
 """
 from statistics import mean
-import cv2 as cv
 import numpy as np
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -19,13 +19,9 @@ def analyze(photo: Photo):
     Determine if image has vertical gradient. Find regression equation to represent vertical
     brightness gradient and return True if correlation coeffcient is greater than 0.85.
     """
-    # Convert image to gray_valuescale
-    image = photo.get_image_data()
-    gray_valuescale_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-    height = len(gray_valuescale_image)
-
-    # Normalize pixel values in image
-    normalized_gray_valuescale_image = gray_valuescale_image / np.max(gray_valuescale_image)
+    # Grayscale image with normalized pixel values
+    normalized_gray_valuescale_image = get_derived_images(photo).normalized_grayscale()
+    height = len(normalized_gray_valuescale_image)
 
     # Divide image into ten horizontal sections and calculate brightness of each by finding
     # number of pixels with values greater than WHITESPACE_THRESHOLD
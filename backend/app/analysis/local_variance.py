@@ -9,6 +9,7 @@ Lydia + Jackie
 
 import cv2
 
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -18,12 +19,9 @@ def analyze(photo: Photo):
     """
     Calculate the blurriness for a given Photo using the Laplacian operator
     """
-    image = photo.get_image_data()
-
-    # Convert image to grayscale
-    # (Changes image array shape from (height, width, 3) to (height, width))
+    # Grayscale image shared with other analyses of this photo
     # (Pixels (image[h][w]) will be a value from 0 to 255)
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    grayscale_image = get_derived_images(photo).grayscale()
 
     # Use Laplacian operator to give a "blurriness" metric
     # Returns this number of a photo in a single floating point number
@@ -7,6 +7,7 @@ how these measures of detail compare with each other
 
 """
 
+from app.image_cache import get_derived_images
 from app.models import Photo
 from .detail_fft2 import analyze as detail_analyze
 from .stdev import analyze as square_analyze
@@ -19,7 +20,8 @@ def analyze(photo: Photo):
     """
     Calculate the mean detail for a given Photo arithmetically
     """
-    image = photo.get_image_data()
+    # Sub-analyses share the decoded image and grayscale conversion through the cache
+    image = get_derived_images(photo).image()
     if image is None:
         return 0
 
@@ -34,8 +34,8 @@ def analyze(photo: Photo):
         # don't recompute -- if you need to, delete the serialized version
         return None
 
-    # Load the image using Pillow
-    image = photo.get_image_data(use_pillow=True)
+    # Load the image using Pillow, decoded at no more resolution than the model input needs
+    image = photo.get_image_data(use_pillow=True, max_size=(224, 224))
 
     if not image:
         return None
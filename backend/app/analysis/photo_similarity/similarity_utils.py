@@ -33,6 +33,19 @@ def deserialize_tensor(photo, verbose=True):
     return tensor
 
 
+def deserialize_feature_vector(photo):
+    """
+    Retrieve the feature vector that was generated for the input photo as a flat numpy array
+    of 512 values, or None if it was never serialized.
+    """
+    tensor = deserialize_tensor(photo, verbose=False)
+    if tensor is None:
+        return None
+    # resnet18_feature_vectors stores the (1, 512, 1, 1) avgpool output broadcast into a
+    # (1, 512, 1, 512) tensor, so every channel is repeated along the last dimension
+    return torch.flatten(tensor, start_dim=2)[0, :, 0].numpy()
+
+
 def analyze_similarity(photo: Photo, similarity_function, reverse=True):
     """
     Produce a list of all other photos by similarity to this photo's feature vector.
@@ -4,55 +4,78 @@ pop_density_detection.py - analysis to count the number of people in the photos
 
 """
 
+from functools import lru_cache
+
 import numpy as np
 import imutils
 from imutils.object_detection import non_max_suppression
 import cv2
+from ..common import prefetch
 from ..models import Photo
 
 
 MODEL = Photo
 
-def analyze(photo: Photo):
+# Images are resized to this width before detection
+DETECTION_WIDTH = 400
+
+
+@lru_cache(maxsize=None)
+def get_people_detector():
     """
-    Analysis function that returns the length of the photographer caption for a Photo object
+    Initialize the HOG descriptor/person detector.
+    This is done once per process and shared by every photo.
     """
-    # pylint: disable=too-many-locals
-
-    # initialize the HOG descriptor/person detector
     hog = cv2.HOGDescriptor()
     hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return hog
+
+
+def load_image(photo: Photo):
+    """
+    Load the photo, decoded at the lowest resolution that still covers DETECTION_WIDTH
+    """
+    return photo.get_image_data(max_size=(DETECTION_WIDTH, None))
+
+
+def analyze(photo: Photo):
+    """
+    Analysis function that returns the number of people detected in a Photo object
+    """
+    return count_people(load_image(photo))
+
+
+def analyze_batch(photos):
+    """
+    Run the analysis over an iterable of Photos, yielding (photo, result) pairs.
+    The next photo is read while people are being detected in the current one.
+    """
+    for photo, image in prefetch(photos, load_image):
+        yield photo, count_people(image)
 
-    # load the image and resize it to (1) reduce detection time
-    # and (2) improve detection accuracy
+
+def count_people(image):
+    """
+    Return the number of people detected in the image array image
+    """
+    # resize the image to (1) reduce detection time and (2) improve detection accuracy
     # images less than 400 in width get resized up, otherwise we can crash due to winStride
     # below going out of bounds
-    image = photo.get_image_data()
-    image = imutils.resize(image, width=400)
-    orig = image.copy()
+    image = imutils.resize(image, width=DETECTION_WIDTH)
 
     # detect people in the image, try adjusting parameters before creating new one
-    (rects, _weights) = hog.detectMultiScale(image, winStride=(4, 4), padding=(8, 8), scale=1.05)
+    (rects, _weights) = get_people_detector().detectMultiScale(
+        image, winStride=(4, 4), padding=(8, 8), scale=1.05
+    )
 
     # Single character variable names useful here for the math...
     # pylint: disable=invalid-name
 
-    # draw the original bounding boxes
-    for (x, y, w, h) in rects:
-        cv2.rectangle(orig, (x, y), (x + w, y + h), (0, 0, 255), 2)
-
     # apply non-maxima suppression to the bounding boxes using a
     # fairly large overlap threshold to try to maintain overlapping
     # boxes that are still people
     rects = np.array([[x, y, x + w, y + h] for (x, y, w, h) in rects])
     pick = non_max_suppression(rects, probs=None, overlapThresh=0.65)
 
-    # draw the final bounding boxes
-    for (xA, yA, xB, yB) in pick:
-        cv2.rectangle(image, (xA, yA), (xB, yB), (0, 255, 0), 2)
-
-    # Write out photos for manual inspection - for debugging
-    # cv2.imwrite(f'test_pop_density_detection_{photo.id}.jpg', image)
-
     num_people = len(pick)
     return num_people
@@ -5,33 +5,55 @@ portrait_detection.py
 analysis to calculate if there exists at least 1 face beyond the size of 200 x 200
 """
 
+from functools import lru_cache
+
 import cv2
+from app.common import prefetch
+from app.image_cache import get_derived_images
 from app.models import Photo
 MODEL = Photo
 
 
+@lru_cache(maxsize=None)
+def get_face_cascade():
+    """
+    Load Open CV's frontal face haar cascade.
+    Parsing the XML is slow, so this is done once per process and shared by every photo.
+    """
+    return cv2.CascadeClassifier(cv2.data.haarcascades
+                                 + 'haarcascade_frontalface_default.xml')
+
+
 def analyze(photo: Photo):
     """
     Face detection using Open CV's haar cascade.
     Param: Photo model
     Return: Boolean if there's at least one face with a minimum size of 200 by 200
     """
+    return detect_portrait(get_derived_images(photo).grayscale())
+
+
+def analyze_batch(photos):
+    """
+    Run the analysis over an iterable of Photos, yielding (photo, result) pairs.
+    The next photo is read while faces are being detected in the current one.
+    """
+    def load(photo):
+        return get_derived_images(photo).grayscale()
+
+    for photo, gray in prefetch(photos, load):
+        yield photo, detect_portrait(gray)
+
 
-    # Load classifier and image. Convert image to grayscale for detection
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades
-                                         + 'haarcascade_frontalface_default.xml')
-    img = photo.get_image_data()
-    if img is None:
+def detect_portrait(gray):
+    """
+    Return True if there's at least one face with a minimum size of 200 by 200 in the
+    grayscale image array gray
+    """
+    if gray is None:
         return False
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # Use cascade classifier to detect if there exists face(s) with at least given min size
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5, minSize=(200, 200))
-
-    # Calculate region and area of the face(s)
-    # for (x_coord, y_coord, width, height) in faces:
-    #     img = cv2.rectangle(img, (x_coord, y_coord),
-    #                         (x_coord + width, y_coord + height),
-    #                         (255, 0, 0), 2)
+    faces = get_face_cascade().detectMultiScale(gray, 1.3, 5, minSize=(200, 200))
 
     return len(faces) > 0
@@ -5,9 +5,7 @@ calc_whitespace.py
 analysis to calculate ratio of pixels above a certain threshold value to the size of the image
 """
 
-import numpy as np
-import cv2
-
+from app.image_cache import get_derived_images
 from app.models import Photo
 
 MODEL = Photo
@@ -19,21 +17,16 @@ def analyze(photo: Photo):
     """
     Calculate the whitespace % for a given Photo
     """
-    image = photo.get_image_data()
+    derived_images = get_derived_images(photo)
 
-    if image is None:
+    if derived_images.image() is None:
         return -1
 
-    # Convert image to grayscale
-    # (Changes image array shape from (height, width, 3) to (height, width))
-    # (Pixels (image[h][w]) will be a value from 0 to 255)
-    grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    # Normalize image pixels to range from 0 to 1
+    # Normalize grayscale image pixels to range from 0 to 1
     # Normalized values are used instead of absolute pixel values to account for
     # differences in brightness (across all photos) that may cause white areas in
     # some photos, like a piece of paper, to appear dark.
-    normalized_grayscale_image = grayscale_image / np.max(grayscale_image)
+    normalized_grayscale_image = derived_images.normalized_grayscale()
 
     # Count number of pixels that have a value greater than the WHITESPACE_THRESHOLD
     # n.b. this threshold was arbitrarily chosen
@@ -43,6 +36,6 @@ def analyze(photo: Photo):
     # Percentage of pixels above the threshold to the total number of pixels in the photo
     # (Prevent larger images from being ranked as being composed mostly of whitespace,
     # just because they are larger)
-    whitespace_percentage = number_of_pixels / grayscale_image.size * 100
+    whitespace_percentage = number_of_pixels / normalized_grayscale_image.size * 100
 
     return whitespace_percentage
@@ -5,11 +5,18 @@ analysis that calculates the relative density of people in a photo based on the
 bounding boxes returned by the yolo_model
 
 """
+import json
+
+import numpy as np
+
 from app.models import Photo
 from app.models import PhotoAnalysisResult
 
 MODEL = Photo
 
+# Assumed photo dimensions when there is no local photo to get them from
+DEFAULT_PHOTO_DIM = (10000, 10000)
+
 
 def overlap_1d(line1, line2):
     """
@@ -49,6 +56,34 @@ def overlap_2d(rect1, rect2):
     return x_overlap * y_overlap
 
 
+def overlap_1d_matrix(starts, lengths):
+    """
+    Vectorized overlap_1d between every pair of line segments.
+    :param starts: array of the start points of the line segments
+    :param lengths: array of the lengths of the line segments
+    :return: A square array where [i, j] is overlap_1d of line segments i and j
+    """
+    ends = starts + lengths
+    longest_line_len = np.maximum(lengths[:, np.newaxis], lengths[np.newaxis, :])
+    line_overlap = (
+        np.minimum(ends[:, np.newaxis], ends[np.newaxis, :])
+        - np.maximum(starts[:, np.newaxis], starts[np.newaxis, :])
+    ) / longest_line_len
+    line_overlap = np.where(line_overlap < 0, 1 / (line_overlap ** 2 + 1), line_overlap + 1)
+    return line_overlap / 2
+
+
+def overlap_2d_matrix(rects):
+    """
+    Vectorized overlap_2d between every pair of rectangles.
+    :param rects: An array of shape (number of rectangles, 4) of (x_position, y_position, width,
+    height) rows
+    :return: A square array where [i, j] is overlap_2d of rectangles i and j
+    """
+    x_positions, y_positions, widths, heights = rects.T
+    return overlap_1d_matrix(x_positions, widths) * overlap_1d_matrix(y_positions, heights)
+
+
 def box_to_rect(box):
     """
     Given a box representing an object's location in a photo as predicted by the yolo_model,
@@ -64,7 +99,7 @@ def box_to_rect(box):
     )
 
 
-def object_density(object_name, yolo_dict, photo_dim=(10000, 10000)):
+def object_density(object_name, yolo_dict, photo_dim=DEFAULT_PHOTO_DIM):
     """
     Given an object name, the output of the yolo_model analysis for a photo (yolo_dict),
     and the dimensions of the photo, return the density of the specified object
@@ -90,24 +125,47 @@ def object_density(object_name, yolo_dict, photo_dim=(10000, 10000)):
         # pylint: disable=arguments-out-of-order
         return overlap_2d(rect1, rect2) + overlap_2d(rect2, rect1)
 
-    density = 0
-    for i, box_i in enumerate(boxes):
-        density_i = 0
-        for j, box_j in enumerate(boxes):
-            if i == j:
-                continue
-            density_i += overlap_2d(
-                box_to_rect(box_i), box_to_rect(box_j)
-            )
-        density += density_i / (len(boxes) - 1)
+    if not boxes:
+        return 0
 
-    return density
+    # The average overlap of each box with every other box, summed over the boxes
+    overlaps = overlap_2d_matrix(np.array([box_to_rect(box) for box in boxes], dtype=float))
+    np.fill_diagonal(overlaps, 0)
+    return float(overlaps.sum() / (len(boxes) - 1))
 
 
 def analyze(photo: Photo):
     yolo_dict = PhotoAnalysisResult.objects.filter(
         name="yolo_model", photo=photo
     ).first().parsed_result()
-    image = photo.get_image_data()
-    photo_dim = image.shape[:2][::-1] if image is not None else (10000, 10000)
+    photo_dim = photo.get_dimensions() or DEFAULT_PHOTO_DIM
     return object_density("person", yolo_dict, photo_dim)
+
+
+def analyze_batch(photos):
+    """
+    Fetch the yolo_model results of the whole batch in one query, and record the dimensions
+    of any photos that don't have them yet in another
+    """
+    yolo_results = dict(
+        PhotoAnalysisResult.objects.filter(
+            name="yolo_model", photo__in=photos
+        ).values_list('photo_id', 'result')
+    )
+
+    photo_dims = {}
+    photos_to_update = []
+    for photo in photos:
+        recorded = photo.width is not None and photo.height is not None
+        photo_dims[photo.id] = photo.get_dimensions(save=False)
+        if not recorded and photo_dims[photo.id]:
+            photos_to_update.append(photo)
+    if photos_to_update:
+        Photo.objects.bulk_update(photos_to_update, ['width', 'height'])
+
+    for photo in photos:
+        if photo.id not in yolo_results:
+            raise Exception(f'{photo} has no yolo_model result')
+        yolo_dict = json.loads(yolo_results[photo.id])
+        photo_dim = photo_dims[photo.id] or DEFAULT_PHOTO_DIM
+        yield photo, object_density("person", yolo_dict, photo_dim)
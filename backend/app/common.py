@@ -1,6 +1,8 @@
 """
 Miscellaneous utility functions useful throughout the system
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
 from django.shortcuts import render
@@ -34,3 +36,24 @@ def print_header(header_str):
         ################################################################################
         # {header_str}
         ################################################################################'''))
+
+
+def prefetch(items, load, ahead=2):
+    """
+    Yield (item, load(item)) for each item in items, in order.
+
+    load runs in a background thread for the next `ahead` items, so that reading and decoding
+    photos overlaps with whatever the caller is doing with the current one. Any exception
+    raised by load is re-raised when its item is reached.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) > ahead:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+        while pending:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
@@ -0,0 +1,267 @@
+"""
+Caches for photo image data, so that analyses don't repeat the same decoding and conversions
+
+get_derived_images(photo) returns a DerivedImages object for the photo, which lazily computes and
+memoizes the grayscale, normalized and downscaled versions of the image that most analyses start
+from. Objects are shared by every analysis that asks for the same Photo instance (e.g., the
+sub-analyses of mean_detail and combined_indoor), and the memory they hold is bounded.
+
+get_decoded_image_cache() returns the opt-in on-disk cache of decoded images used by
+Photo.get_image_data, or None if it isn't enabled. Decoded arrays are stored uncompressed as
+.npy files and memory mapped on later runs, so repeat analysis runs skip JPEG decoding.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from threading import RLock
+
+import cv2
+import numpy as np
+
+from django.conf import settings
+
+
+class DerivedImages:
+    """
+    Lazily computed, memoized versions of the image data of a single photo.
+
+    Arrays returned from here are shared between analyses, so treat them as read-only
+    (copy before modifying them in place).
+    """
+
+    def __init__(self, photo, owner=None):
+        self.photo = photo
+        self.owner = owner
+        self._arrays = {}
+
+    def _memoize(self, key, compute):
+        """
+        Return the array memoized under key, calling compute() to make it the first time
+        (and then evicting other photos from the owner cache if it's over its limit)
+        """
+        if key not in self._arrays:
+            self._arrays[key] = compute()
+            if self.owner is not None:
+                self.owner.enforce_limit()
+        return self._arrays[key]
+
+    @property
+    def nbytes(self):
+        """ Total size of the arrays memoized so far """
+        return sum(array.nbytes for array in self._arrays.values() if array is not None)
+
+    def image(self):
+        """
+        The image data as returned by Photo.get_image_data
+        """
+        return self._memoize('image', self.photo.get_image_data)
+
+    def grayscale(self):
+        """
+        The image converted to grayscale
+        (Changes image array shape from (height, width, 3) to (height, width))
+        (Pixels (image[h][w]) will be a value from 0 to 255)
+        """
+        def compute():
+            image = self.image()
+            if image is None or image.ndim == 2:
+                return image
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return self._memoize('grayscale', compute)
+
+    def normalized_grayscale(self):
+        """
+        The grayscale image divided by its brightest pixel, so values range from 0 to 1
+        """
+        def compute():
+            grayscale_image = self.grayscale()
+            return grayscale_image / np.max(grayscale_image)
+        return self._memoize('normalized_grayscale', compute)
+
+    def pyramid_level(self, level):
+        """
+        The grayscale image downscaled by a factor of 2 ** level with cv2.pyrDown
+        (level 0 is the grayscale image itself)
+        """
+        if level == 0:
+            return self.grayscale()
+        return self._memoize(
+            ('pyramid', level),
+            lambda: cv2.pyrDown(self.pyramid_level(level - 1)),
+        )
+
+
+class DerivedImageCache:
+    """
+    Holds DerivedImages objects for recently used photos, evicting the least recently used
+    photos once the arrays they hold add up to more than max_bytes.
+    The most recently used photo is never evicted, even if it is over the limit by itself.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, photo):
+        """
+        Get the DerivedImages for photo, creating it if needed
+        """
+        # Keyed on the instance rather than the pk, as analyses are also run on unsaved Photos.
+        # The entry keeps a reference to the photo, so its id can't be reused while cached.
+        key = id(photo)
+        with self._lock:
+            derived_images = self._entries.get(key)
+            if derived_images is None:
+                derived_images = DerivedImages(photo, owner=self)
+                self._entries[key] = derived_images
+            self._entries.move_to_end(key)
+            return derived_images
+
+    def enforce_limit(self):
+        """
+        Evict least recently used photos until we're within max_bytes
+        """
+        with self._lock:
+            total_bytes = sum(entry.nbytes for entry in self._entries.values())
+            while total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total_bytes -= evicted.nbytes
+
+    def clear(self):
+        """
+        Evict every photo
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+DERIVED_IMAGE_CACHE = DerivedImageCache()
+
+
+def get_derived_images(photo):
+    """
+    Get the shared, memoized DerivedImages for photo
+    """
+    return DERIVED_IMAGE_CACHE.get(photo)
+
+
+class DecodedImageCache:
+    """
+    On-disk cache of decoded image arrays.
+
+    Entries are keyed on the source file's path, modification time and size, plus a variant
+    describing how it was decoded (e.g., grayscale or reduced resolution), so editing or
+    replacing a photo invalidates its entries. Once the cache grows past max_bytes the least
+    recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = RLock()
+
+    def entry_path(self, source, variant):
+        """
+        Path of the cache entry for the given source file and decoding variant
+        """
+        stat = os.stat(source)
+        key = f'{os.path.abspath(source)}|{stat.st_mtime_ns}|{stat.st_size}|{variant!r}'
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def load(self, source, variant, decode):
+        """
+        Return the cached array for source and variant, calling decode() and storing its result
+        if there isn't one yet.
+
+        Cached arrays are memory mapped copy-on-write: they're only read from disk as they're
+        used, and modifying them doesn't change the cache.
+        """
+        path = self.entry_path(source, variant)
+        try:
+            array = np.load(path, mmap_mode='c')
+            # Bump the modification time, which is what we evict by
+            os.utime(path)
+            return array
+        except (OSError, ValueError):
+            # Not cached yet (or a corrupt entry, which we overwrite)
+            pass
+
+        array = decode()
+        self.store(path, array)
+        return array
+
+    def store(self, path, array):
+        """
+        Write array to path, then evict old entries if we're over max_bytes
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first so that other processes never read a partial entry
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                np.save(temp_file, np.asarray(array))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, _, size in self._entries())
+            else:
+                self._total_bytes += os.path.getsize(path)
+            if self._total_bytes > self.max_bytes:
+                self.evict()
+
+    def _entries(self):
+        """
+        List (path, modification time, size) for every entry in the cache
+        """
+        entries = []
+        with os.scandir(self.cache_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.endswith('.npy'):
+                    try:
+                        stat = dir_entry.stat()
+                    except FileNotFoundError:  # evicted by another process
+                        continue
+                    entries.append((dir_entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is at most max_bytes
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            total_bytes = sum(size for _, _, size in entries)
+            for path, _, size in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+            self._total_bytes = total_bytes
+
+
+_DECODED_IMAGE_CACHES = {}
+
+
+def get_decoded_image_cache():
+    """
+    Get the on-disk decoded image cache configured by settings.DECODED_IMAGE_CACHE_DIR
+    and settings.DECODED_IMAGE_CACHE_MAX_BYTES, or None if it's disabled
+    """
+    cache_dir = getattr(settings, 'DECODED_IMAGE_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    max_bytes = settings.DECODED_IMAGE_CACHE_MAX_BYTES
+    key = (str(cache_dir), max_bytes)
+    if key not in _DECODED_IMAGE_CACHES:
+        _DECODED_IMAGE_CACHES[key] = DecodedImageCache(cache_dir, max_bytes)
+    return _DECODED_IMAGE_CACHES[key]
@@ -0,0 +1,65 @@
+"""
+Resized copies ("derivatives") of photos, for pages that show many photos at once
+
+This module doesn't import Django, so that make_derivatives can run in worker processes.
+"""
+import os
+
+from PIL import Image
+
+# Pillow format name and save options for each derivative file extension
+DERIVATIVE_FORMATS = {
+    'jpg': ('JPEG', {'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'method': 4}),
+}
+
+
+def is_up_to_date(output_path, source_path):
+    """
+    Whether output_path exists and is newer than source_path
+    """
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(source_path)
+    except OSError:
+        return False
+
+
+def make_derivatives(source_path, outputs, quality=85, force=False):
+    """
+    Write resized copies of the image at source_path, keeping its aspect ratio
+
+    :param source_path: path of the full size image
+    :param outputs: list of (output path, size, extension): the image is shrunk to fit in a
+                    size x size box (never enlarged) and saved in the format for extension
+    :param quality: JPEG/WebP quality
+    :param force: rewrite outputs that are already newer than the source
+    :return: the (size, extension) of every output that exists once we're done
+    """
+    to_write = []
+    done = []
+    for output_path, size, extension in outputs:
+        if force or not is_up_to_date(output_path, source_path):
+            to_write.append((output_path, size, extension))
+        else:
+            done.append((size, extension))
+    if not to_write:
+        return done
+
+    with Image.open(source_path) as image:
+        largest_size = max(size for _, size, _ in to_write)
+        # Let libjpeg decode at a reduced scale when the largest derivative is small enough
+        image.draft('RGB', (largest_size, largest_size))
+        image = image.convert('RGB')
+
+        # Shrink from largest to smallest, so each resize starts from the nearest bigger copy
+        resized = image
+        for output_path, size, extension in sorted(to_write, key=lambda output: -output[1]):
+            if max(resized.size) > size:
+                resized = resized.copy()
+                resized.thumbnail((size, size), Image.LANCZOS)
+            pil_format, save_options = DERIVATIVE_FORMATS[extension]
+            temp_path = f'{output_path}.tmp'
+            resized.save(temp_path, pil_format, quality=quality, **save_options)
+            os.replace(temp_path, output_path)
+            done.append((size, extension))
+    return done
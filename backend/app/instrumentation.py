@@ -0,0 +1,212 @@
+"""
+Timing and throughput statistics for long running commands like runanalysis
+
+A RunStats collects how long each stage of the work (e.g., decoding photos, running an analysis,
+saving results) took each time it ran, and summarizes them as percentiles and photos per second.
+
+Code that runs deep inside a stage (like Photo.get_image_data) can record into whichever
+RunStats is active with timed_stage, without having it passed down.
+
+A QueryCounter counts and times the SQL queries run through a database connection.
+"""
+import heapq
+import json
+import math
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+_ACTIVE_STATS = None
+
+
+def percentile(sorted_values, fraction):
+    """
+    The value at the given fraction (0 to 1) of sorted_values, by the nearest rank method
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+
+class RunStats:
+    """
+    Timings of the stages of a run over num_total items, and progress through them
+
+    Safe to record from several threads (e.g., photos decoded in a prefetch thread).
+    """
+
+    def __init__(self, name, num_total=None):
+        self.name = name
+        self.num_total = num_total
+        self.num_done = 0
+        self.num_failed = 0
+        self.start_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+        self._durations = {}
+        self._lock = Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._durations.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Time the body of the with statement as one run of stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the RunStats that timed_stage records into, for the body of the with statement
+        """
+        global _ACTIVE_STATS  # pylint: disable=global-statement
+        previous_stats = _ACTIVE_STATS
+        _ACTIVE_STATS = self
+        try:
+            yield self
+        finally:
+            _ACTIVE_STATS = previous_stats
+
+    def timed_iter(self, iterable, stage):
+        """
+        Iterate over iterable, timing how long each item took to produce as a run of stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, time.perf_counter() - start)
+            yield item
+
+    def item_done(self, failed=False):
+        """
+        Count an item as done (or failed), for progress_line and summary
+        """
+        with self._lock:
+            if failed:
+                self.num_failed += 1
+            else:
+                self.num_done += 1
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def progress_line(self):
+        """
+        One line summary of progress so far, with an estimate of the time left
+        """
+        num_processed = self.num_done + self.num_failed
+        rate = num_processed / self.elapsed if self.elapsed else 0
+        line = f'{self.name}: {num_processed}'
+        if self.num_total is not None:
+            line += f'/{self.num_total}'
+        line += f' photos ({self.num_failed} failed), {rate:.2f} photos/sec'
+        if self.num_total is not None and rate:
+            line += f', ETA {format_duration((self.num_total - num_processed) / rate)}'
+        return line
+
+    def summary(self):
+        """
+        Aggregate statistics for the run so far, as a JSON serializable dict.
+        Stage latencies are in seconds.
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            stages = {}
+            for stage, durations in self._durations.items():
+                durations = sorted(durations)
+                stages[stage] = {
+                    'count': len(durations),
+                    'total': sum(durations),
+                    'mean': sum(durations) / len(durations),
+                    'p50': percentile(durations, 0.5),
+                    'p95': percentile(durations, 0.95),
+                    'max': durations[-1],
+                }
+            return {
+                'name': self.name,
+                'photos': self.num_done,
+                'failed': self.num_failed,
+                'wall_seconds': elapsed,
+                'cpu_seconds': time.process_time() - self.start_cpu_time,
+                'photos_per_second': self.num_done / elapsed if elapsed else None,
+                'stages': stages,
+            }
+
+    def summary_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Time the body of the with statement as a run of stage in the active RunStats, if any
+    """
+    stats = _ACTIVE_STATS
+    if stats is None:
+        yield
+        return
+    with stats.stage(stage):
+        yield
+
+
+class QueryCounter:
+    """
+    Counts and times the SQL queries of a database connection, keeping the slowest
+    num_slowest of them. Install it with connection.execute_wrapper:
+
+        query_counter = QueryCounter()
+        with connection.execute_wrapper(query_counter):
+            ...
+
+    Unlike CaptureQueriesContext, it doesn't need DEBUG or keep every query, so it can count any
+    number of them.
+    """
+
+    def __init__(self, num_slowest=5):
+        self.num_slowest = num_slowest
+        self.count = 0
+        self.total_time = 0.0
+        self._slowest = []  # heap of (seconds, count, sql, params)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            self.count += 1
+            self.total_time += seconds
+            if self.num_slowest:
+                entry = (seconds, self.count, sql, None if many else params)
+                if len(self._slowest) < self.num_slowest:
+                    heapq.heappush(self._slowest, entry)
+                else:
+                    heapq.heappushpop(self._slowest, entry)
+
+    def slowest_queries(self):
+        """
+        (seconds, sql, params) of the slowest queries, slowest first (params is None for
+        queries run with executemany)
+        """
+        return [
+            (seconds, sql, params)
+            for seconds, _, sql, params in sorted(self._slowest, reverse=True)
+        ]
@@ -0,0 +1,32 @@
+"""
+Django management command aggregateanalyses
+
+Computes the label statistics of a per-photo analysis over the whole corpus (see
+app.analysis.aggregated_analyses) and stores them as a CorpusAnalysisResult
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+from app.analysis.aggregated_analyses import materialize_label_statistics
+from app.common import print_header
+
+
+class Command(BaseCommand):
+    """
+    Custom django-admin command to aggregate the results of a photo analysis
+    """
+    help = 'Aggregates the label statistics of a photo analysis into a CorpusAnalysisResult'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analysis_name', type=str, action='store', default='yolo_model',
+                            help='Name of the photo analysis to aggregate')
+
+    def handle(self, *args, **options):
+        analysis_name = options.get('analysis_name')
+        summary = materialize_label_statistics(analysis_name)
+        print_header(f'Aggregated {analysis_name} results of {summary["num_photos"]} photos')
+        print(json.dumps(
+            {label: summary['percentages'][label] for label in summary['frequent_objects']},
+            indent=4,
+        ))
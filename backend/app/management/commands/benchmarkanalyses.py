@@ -0,0 +1,427 @@
+"""
+Django management command benchmarkanalyses
+
+Times the analyses in app/analysis on a synthetic corpus of photos at several resolutions
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import pkgutil
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from importlib import import_module
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from app.common import print_header
+from app.image_cache import DERIVED_IMAGE_CACHE
+from app.instrumentation import RunStats
+from app.management.commands.runanalysis import compute_results
+from app.models import MapSquare, Photo
+
+# Modules in app/analysis that aren't analyses runanalysis can run
+EXCLUDED_MODULES = {'x_tests'}
+
+# Differences smaller than these are noise rather than regressions
+MIN_SECONDS_PER_PHOTO_DIFFERENCE = 0.01
+MIN_PEAK_RSS_MB_DIFFERENCE = 20
+
+
+def parse_size(value):
+    """
+    Parse an image size like 1600x1200 into (width, height)
+    """
+    try:
+        width, height = (int(dimension) for dimension in value.lower().split('x'))
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(f'Expected a size like 1600x1200, not {value}') \
+            from error
+    return width, height
+
+
+def format_size(size):
+    return f'{size[0]}x{size[1]}'
+
+
+def find_analysis_names(package_path=settings.ANALYSIS_DIR, prefix=''):
+    """
+    Names of the modules in app/analysis (and its packages), in the form runanalysis takes them.
+    Nothing is imported, so the heavy dependencies of some analyses are only loaded by the
+    processes that benchmark them.
+    """
+    analysis_names = []
+    for module_info in pkgutil.iter_modules([str(package_path)]):
+        if module_info.name in EXCLUDED_MODULES:
+            continue
+        if module_info.ispkg:
+            analysis_names += find_analysis_names(
+                os.path.join(package_path, module_info.name), f'{prefix}{module_info.name}.'
+            )
+        else:
+            analysis_names.append(prefix + module_info.name)
+    return sorted(analysis_names)
+
+
+def draw_synthetic_photo(size, seed):
+    """
+    Draw a deterministic stand-in for a photo of a street: a gradient sky, buildings with
+    windows, a few figures, film grain and a white border like the scans of slides have.
+
+    The scene is laid out in relative coordinates, so the same seed gives the same photo at
+    every size.
+    """
+    width, height = size
+    random = np.random.RandomState(seed)
+
+    sky = np.linspace(200, 120, height)[:, np.newaxis].repeat(width, axis=1)
+    image = Image.fromarray(sky.astype(np.uint8)).convert('RGB')
+    draw_street(ImageDraw.Draw(image), size, random)
+
+    pixels = np.asarray(image, dtype=np.int16)
+    pixels += random.normal(0, 8, (height, width, 1)).astype(np.int16)
+    border = max(1, round(0.03 * min(width, height)))
+    pixels[:border], pixels[-border:] = 255, 255
+    pixels[:, :border], pixels[:, -border:] = 255, 255
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def draw_street(draw, size, random):
+    """
+    Draw the buildings and figures of draw_synthetic_photo, laid out with random (a
+    np.random.RandomState)
+    """
+    width, height = size
+    horizon = random.uniform(0.3, 0.5)
+    left = 0.0
+    while left < 1:
+        right = min(1.0, left + random.uniform(0.1, 0.3))
+        top = random.uniform(0.1, horizon)
+        shade = int(random.uniform(60, 170))
+        draw.rectangle(
+            [left * width, top * height, right * width, height], fill=(shade,) * 3
+        )
+        for window_x in np.arange(left + 0.02, right - 0.03, 0.05):
+            for window_y in np.arange(top + 0.03, 0.8, 0.08):
+                draw.rectangle(
+                    [window_x * width, window_y * height,
+                     (window_x + 0.02) * width, (window_y + 0.04) * height],
+                    fill=(shade // 3,) * 3,
+                )
+        left = right
+
+    for _ in range(random.randint(2, 8)):
+        figure_x, figure_y = random.uniform(0.05, 0.95), random.uniform(0.7, 0.9)
+        left, right = figure_x * width, (figure_x + 0.02) * width
+        draw.ellipse(
+            [left, (figure_y - 0.08) * height, right, (figure_y - 0.05) * height],
+            fill=(30, 30, 30),
+        )
+        draw.rectangle([left, (figure_y - 0.05) * height, right, figure_y * height],
+                       fill=(40, 40, 40))
+
+
+def make_corpus(corpus_dir, size, num_photos, seed):
+    """
+    Write num_photos synthetic photos of the given size, laid out like LOCAL_PHOTOS_DIR
+    (as map square 1), unless they're already there
+
+    :return: the directory to use as LOCAL_PHOTOS_DIR
+    """
+    photos_dir = os.path.join(corpus_dir, f'{format_size(size)}_seed{seed}')
+    map_square_dir = os.path.join(photos_dir, '1')
+    os.makedirs(map_square_dir, exist_ok=True)
+    for number in range(num_photos):
+        photo_path = os.path.join(map_square_dir, f'{number}_photo.jpg')
+        if not os.path.exists(photo_path):
+            temp_path = f'{photo_path}.tmp'
+            draw_synthetic_photo(size, seed * 100003 + number).save(temp_path, 'JPEG', quality=90)
+            os.replace(temp_path, photo_path)
+    return photos_dir
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+
+def make_synthetic_photos(num_photos):
+    """
+    Unsaved Photos of map square 1 for the photos written by make_corpus
+    """
+    map_square = MapSquare(number=1)
+    return [
+        Photo(number=number, map_square=map_square,
+              photographer_caption=f'Rue de Synthèse, photo {number}')
+        for number in range(num_photos)
+    ]
+
+
+def benchmark_analysis(analysis_name, photos_dir, num_photos, batch_size):
+    """
+    Run an analysis over the synthetic photos in photos_dir, the same way runanalysis would
+    (without saving the results), and measure it. seconds_per_photo is measured once the
+    analysis has warmed up on the first photo.
+
+    Anything the analysis writes to ANALYSIS_PICKLE_PATH (like cached feature vectors, which are
+    keyed by map square and photo number) goes to a temporary directory next to photos_dir, so
+    it can't end up in the real results, and no run reuses the work of an earlier one.
+
+    Meant to be run in a process of its own, so that the peak RSS is this analysis's alone.
+
+    :return: dict of measurements, or None if the module isn't an analysis
+    """
+    with tempfile.TemporaryDirectory(prefix='analysis_results_',
+                                     dir=os.path.dirname(photos_dir)) as results_dir, \
+            override_settings(
+                LOCAL_PHOTOS_DIR=photos_dir,
+                ANALYSIS_PICKLE_PATH=Path(results_dir),
+                # Decoding is part of what we're measuring
+                DECODED_IMAGE_CACHE_DIR=None,
+            ):
+        start_time = time.perf_counter()
+        try:
+            analysis_module = import_module(f'.{analysis_name}', package='app.analysis')
+        except Exception as error:  # pylint: disable=broad-except
+            return {'error': f'Import failed: {error}'}
+        import_seconds = time.perf_counter() - start_time
+
+        if getattr(analysis_module, 'analyze', None) is None \
+                or getattr(analysis_module, 'MODEL', None) is not Photo:
+            return None
+        return {
+            'import_seconds': import_seconds,
+            **time_analysis(analysis_module, analysis_name, num_photos, batch_size),
+        }
+
+
+def time_analysis(analysis_module, analysis_name, num_photos, batch_size):
+    """
+    Time analysis_module over num_photos synthetic photos, for benchmark_analysis
+    """
+    analysis_func = analysis_module.analyze
+    analysis_batch_func = getattr(analysis_module, 'analyze_batch', None)
+
+    output = io.StringIO()
+    # The first photo pays for loading models and initializing libraries, so it's timed on its
+    # own, and the photos are then timed on fresh Photo instances (with nothing memoized)
+    start_time = time.perf_counter()
+    with redirect_stdout(output):
+        try:
+            analysis_func(make_synthetic_photos(1)[0])
+        except Exception as error:  # pylint: disable=broad-except
+            print('Error:', error)
+    first_photo_seconds = time.perf_counter() - start_time
+    DERIVED_IMAGE_CACHE.clear()
+
+    stats = RunStats(analysis_name, num_total=num_photos)
+    results = []
+    with redirect_stdout(output), stats.activate():
+        for photo, result in compute_results(
+            make_synthetic_photos(num_photos), analysis_func, analysis_batch_func, batch_size,
+            analysis_name, stats
+        ):
+            stats.item_done()
+            results.append((photo.number, result))
+    summary = stats.summary()
+
+    return {
+        'photos': summary['photos'],
+        'failed': summary['failed'],
+        'first_error': next(
+            (line for line in output.getvalue().splitlines() if line.startswith('Error:')), None
+        ),
+        'first_photo_seconds': first_photo_seconds,
+        'wall_seconds': summary['wall_seconds'],
+        'cpu_seconds': summary['cpu_seconds'],
+        'seconds_per_photo': summary['wall_seconds'] / num_photos,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'results_digest': results_digest(results),
+        'stages': summary['stages'],
+    }
+
+
+def results_digest(results):
+    """
+    Hash of a list of (photo number, result), to tell whether an analysis's results changed
+    """
+    serialized_results = json.dumps(sorted(results), sort_keys=True, default=str)
+    return hashlib.sha1(serialized_results.encode()).hexdigest()
+
+
+def run_in_new_process(func, *args):
+    """
+    Call func(*args) in a fresh process forked from this one, and return its result
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('fork')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def compare_to_baseline(benchmarks, baseline, tolerance):
+    """
+    Compare benchmark measurements against those of a baseline run
+
+    :return: list of descriptions of the regressions
+    """
+    regressions = []
+    for analysis_name, measurements_by_size in benchmarks.items():
+        for size, measurements in measurements_by_size.items():
+            baseline_measurements = baseline.get(analysis_name, {}).get(size)
+            if not baseline_measurements or 'error' in baseline_measurements:
+                continue
+            label = f'{analysis_name} at {size}'
+            if 'error' in measurements:
+                regressions.append(f'{label}: {measurements["error"]}')
+                continue
+
+            for metric, min_difference in [
+                ('seconds_per_photo', MIN_SECONDS_PER_PHOTO_DIFFERENCE),
+                ('peak_rss_mb', MIN_PEAK_RSS_MB_DIFFERENCE),
+            ]:
+                value = measurements[metric]
+                baseline_value = baseline_measurements[metric]
+                if value > baseline_value * (1 + tolerance) \
+                        and value - baseline_value > min_difference:
+                    regressions.append(
+                        f'{label}: {metric} went from {baseline_value:.3f} to {value:.3f}'
+                    )
+            if measurements['failed'] > baseline_measurements['failed']:
+                regressions.append(f'{label}: {measurements["failed"]} photos failed, up from '
+                                   f'{baseline_measurements["failed"]}')
+            elif measurements['results_digest'] != baseline_measurements['results_digest']:
+                regressions.append(f'{label}: results changed')
+    return regressions
+
+
+class Command(BaseCommand):
+    """
+    Custom django-admin command used to benchmark the analyses on synthetic photos
+    """
+    help = 'Measure the time and memory the analyses take on synthetic photos of several sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'analysis_names',
+            nargs='*',
+            help='Analyses to benchmark, as given to runanalysis (default: all of them)',
+        )
+        parser.add_argument(
+            '--sizes',
+            type=parse_size,
+            nargs='+',
+            action='store',
+            default=[(640, 480), (1600, 1200), (3200, 2400)],
+            help='Photo sizes to benchmark, like 1600x1200',
+        )
+        parser.add_argument('--photos_per_size', type=int, action='store', default=8)
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            action='store',
+            default=16,
+            help='Number of photos handed to analyze_batch at a time, for analyses that have one',
+        )
+        parser.add_argument('--seed', type=int, action='store', default=0)
+        parser.add_argument(
+            '--corpus_dir',
+            type=str,
+            action='store',
+            default=os.path.join(settings.BACKEND_DATA_DIR, 'benchmark_corpus'),
+            help='Where the synthetic photos are kept between runs',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            action='store',
+            help='Save the measurements as JSON, e.g. to use as a baseline later',
+        )
+        parser.add_argument(
+            '--baseline',
+            type=str,
+            action='store',
+            help='JSON saved with --output by an earlier run, to check for regressions against',
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            action='store',
+            default=0.25,
+            help='Fraction by which time per photo or peak RSS can grow before it is reported',
+        )
+
+    def handle(self, *args, **options):
+        # pylint: disable=too-many-locals
+        analysis_names = options.get('analysis_names') or find_analysis_names()
+        sizes = options.get('sizes')
+        photos_per_size = options.get('photos_per_size')
+        batch_size = options.get('batch_size')
+        seed = options.get('seed')
+        corpus_dir = options.get('corpus_dir')
+        output_path = options.get('output')
+        baseline_path = options.get('baseline')
+        tolerance = options.get('tolerance')
+
+        print_header(f'Drawing {photos_per_size} synthetic photos at each size...')
+        photos_dirs = {
+            format_size(size): make_corpus(corpus_dir, size, photos_per_size, seed)
+            for size in sizes
+        }
+
+        benchmarks = {}
+        print_header('Benchmarking analyses...')
+        print(f'{"Analysis":40} {"Size":>10} {"s/photo":>9} {"CPU s":>8} {"Peak MB":>8} '
+              f'{"Failed":>6}')
+        for analysis_name in analysis_names:
+            measurements_by_size = {}
+            for size, photos_dir in photos_dirs.items():
+                measurements = run_in_new_process(
+                    benchmark_analysis, analysis_name, photos_dir, photos_per_size, batch_size
+                )
+                if measurements is None:
+                    break
+                measurements_by_size[size] = measurements
+                if 'error' in measurements:
+                    print(f'{analysis_name:40} {size:>10} {measurements["error"]}')
+                    break
+                print(f'{analysis_name:40} {size:>10} {measurements["seconds_per_photo"]:9.3f} '
+                      f'{measurements["cpu_seconds"]:8.2f} {measurements["peak_rss_mb"]:8.0f} '
+                      f'{measurements["failed"]:6}')
+            if measurements_by_size:
+                benchmarks[analysis_name] = measurements_by_size
+
+        if output_path:
+            with open(output_path, 'w', encoding='utf-8') as output_file:
+                json.dump({
+                    'sizes': list(photos_dirs),
+                    'photos_per_size': photos_per_size,
+                    'seed': seed,
+                    'benchmarks': benchmarks,
+                }, output_file, indent=2)
+            print(f'Saved the measurements to {output_path}')
+
+        if baseline_path:
+            with open(baseline_path, encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+            if (baseline['photos_per_size'], baseline['seed']) != (photos_per_size, seed):
+                print('Warning: the baseline was run on a different corpus, so its results '
+                      'will differ.')
+            regressions = compare_to_baseline(benchmarks, baseline['benchmarks'], tolerance)
+            print_header(f'{len(regressions)} regressions against {baseline_path}')
+            for regression in regressions:
+                print(regression)
+            if regressions:
+                sys.exit(1)
@@ -0,0 +1,439 @@
+"""
+Django management command benchmarkapi
+
+Measures the latency and SQL queries of the API endpoints against a synthetic database
+"""
+
+import json
+import random
+import time
+from textwrap import shorten
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from app.common import print_header
+from app.instrumentation import QueryCounter, percentile
+from app.models import Cluster, CorpusAnalysisResult, MapSquare, Photo, PhotoAnalysisResult, \
+    Photographer
+from app.views import ANALYSIS_TAGS
+
+NUM_CLUSTERS = 8
+NUM_SIMILAR_PHOTOS = 10
+YOLO_LABELS = ['person', 'car', 'bicycle', 'horse', 'dog', 'truck']
+
+# The indexes added by migration 0004_natural_key_indexes, as (model, indexed columns)
+NATURAL_KEY_INDEXES = [
+    (MapSquare, ['number']),
+    (Photographer, ['name']),
+    (Photographer, ['number']),
+    (Photo, ['map_square_id', 'number']),
+    (PhotoAnalysisResult, ['name', 'photo_id']),
+]
+
+# Analyses whose results some endpoints expect in a particular shape; the rest get numbers
+YOLO_ANALYSIS = 'yolo_model'
+SIMILARITY_ANALYSES = ['resnet18_cosine_similarity', 'photo_similarity.resnet18_cosine_similarity']
+NUMERIC_ANALYSES = [
+    name for name in ANALYSIS_TAGS.values() if name not in [YOLO_ANALYSIS, *SIMILARITY_ANALYSES]
+]
+
+# (name, url name, url args, JSON body for a POST or None for a GET), for every /api/ route
+ENDPOINTS = [
+    ('photo', 'photo', [1, 1], None),
+    ('previous_next_photos', 'previous_next_photos', [1, 1], None),
+    ('similar_photos', 'similar_photos', [1, 1, NUM_SIMILAR_PHOTOS], None),
+    ('all_photographers', 'all_photographers', [], None),
+    ('photographer', 'photographer', [1], None),
+    ('map_square', 'map_square', [1], None),
+    ('corpus_analysis', 'get_corpus', [], None),
+    ('all_photos', 'all_photos', [], None),
+    ('all_analyses', 'all_analyses', [], None),
+    ('all_map_squares', 'all_map_squares', [], None),
+    ('similarity', 'all_photos_in_order', [], None),
+    ('analysis', 'get_photos_by_analysis', [NUMERIC_ANALYSES[0]], None),
+    ('analysis_object', 'get_photos_by_analysis', [YOLO_ANALYSIS, 'person'], None),
+    ('clustering', 'clustering', [NUM_CLUSTERS, 0], None),
+    ('search', 'search', [], {'isAdvanced': False, 'keyword': 'car'}),
+    ('advanced_search', 'search', [], {
+        'isAdvanced': True,
+        'photographerName': '',
+        'photographerId': '',
+        'caption': '',
+        'tags': ['person'],
+        'analysisTags': [],
+        'sliderSearchValues': {'Object Detection Confidence': [50, 100]},
+    }),
+    ('get_tags', 'get_tags', [], None),
+    ('arrondissements_geojson', 'get_arrondissement', [], None),
+    ('one_arrondissement_geojson', 'get_one_arrondissement', [1], None),
+]
+
+
+def get_analysis_names(num_analyses):
+    """
+    Names of num_analyses analyses to give every photo results for
+    """
+    analysis_names = [YOLO_ANALYSIS, *SIMILARITY_ANALYSES, *NUMERIC_ANALYSES]
+    analysis_names += [
+        f'synthetic_analysis_{i}' for i in range(max(0, num_analyses - len(analysis_names)))
+    ]
+    return analysis_names[:num_analyses]
+
+
+def make_result(analysis_name, rng, earlier_photos):
+    """
+    A plausible, JSON serialized result of analysis_name for a photo
+    """
+    if analysis_name == YOLO_ANALYSIS:
+        boxes = [
+            {
+                'label': rng.choice(YOLO_LABELS),
+                'x_coord': rng.randint(0, 1000),
+                'y_coord': rng.randint(0, 800),
+                'width': rng.randint(10, 300),
+                'height': rng.randint(10, 300),
+                'confidence': rng.randint(30, 100),
+            }
+            for _ in range(rng.randint(0, 6))
+        ]
+        labels = {}
+        for box in boxes:
+            labels[box['label']] = labels.get(box['label'], 0) + 1
+        return json.dumps({'boxes': boxes, 'labels': labels})
+    if analysis_name in SIMILARITY_ANALYSES:
+        # [map square number, photo number, similarity] of photos that already exist
+        similar_photos = rng.sample(earlier_photos, min(NUM_SIMILAR_PHOTOS, len(earlier_photos)))
+        return json.dumps([
+            [map_square_number, photo_number, rng.random()]
+            for map_square_number, photo_number in similar_photos
+        ])
+    return json.dumps(rng.random() * 100)
+
+
+def populate_database(first_map_square, last_map_square, num_map_squares, num_photos,
+                      analysis_names, num_photographers, seed):
+    """
+    Add map squares first_map_square to last_map_square (inclusive) of a synthetic corpus of
+    num_map_squares map squares and num_photos photos, with their photos, photographers and
+    analysis results. Calling this for consecutive ranges builds up the corpus in stages.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    rng = random.Random(f'{seed}_{first_map_square}')
+    with transaction.atomic():
+        if first_map_square == 1:
+            Cluster.objects.bulk_create(
+                [Cluster(model_n=NUM_CLUSTERS, label=label) for label in range(NUM_CLUSTERS)]
+            )
+            CorpusAnalysisResult.objects.create(
+                name='aggregated_analyses', result=json.dumps({'labels': YOLO_LABELS})
+            )
+
+        MapSquare.objects.bulk_create([
+            MapSquare(number=number, name=f'Map square {number}', boundaries='',
+                      coordinates=f'{48.8 + number / 10000}, {2.3 + number / 10000}')
+            for number in range(first_map_square, last_map_square + 1)
+        ])
+        map_squares = MapSquare.objects.filter(number__gte=first_map_square,
+                                               number__lte=last_map_square)
+        # Photographer n is assigned map square n and takes the photos in every
+        # num_photographers-th map square from there
+        Photographer.objects.bulk_create([
+            Photographer(number=map_square.number, name=f'Photographer {map_square.number}',
+                         map_square=map_square)
+            for map_square in map_squares if map_square.number <= num_photographers
+        ])
+        photographers_by_number = {
+            photographer.number: photographer for photographer in Photographer.objects.all()
+        }
+
+        photos = []
+        for map_square in map_squares:
+            # Spread the photos as evenly as possible over the map squares
+            photos_in_square = num_photos * map_square.number // num_map_squares \
+                - num_photos * (map_square.number - 1) // num_map_squares
+            photographer = photographers_by_number[(map_square.number - 1) % num_photographers + 1]
+            photos += [
+                Photo(number=number, map_square=map_square, photographer=photographer,
+                      front_src=True, shelfmark=f'{map_square.number}-{number}',
+                      alt='', librarian_caption=f'Rue {rng.choice(YOLO_LABELS)}',
+                      photographer_caption=f'Photo {number}, {rng.choice(YOLO_LABELS)}')
+                for number in range(1, photos_in_square + 1)
+            ]
+        Photo.objects.bulk_create(photos, batch_size=1000)
+        photos = Photo.objects.filter(map_square__in=map_squares).select_related('map_square')
+
+        earlier_photos = list(Photo.objects.filter(map_square__number__lt=first_map_square)
+                              .values_list('map_square__number', 'number'))
+        results = []
+        clusters = list(Cluster.objects.filter(model_n=NUM_CLUSTERS).order_by('label'))
+        cluster_photos = []
+        for photo in photos:
+            earlier_photos.append((photo.map_square.number, photo.number))
+            results += [
+                PhotoAnalysisResult(name=analysis_name, photo=photo,
+                                    result=make_result(analysis_name, rng, earlier_photos))
+                for analysis_name in analysis_names
+            ]
+            cluster_photos.append(Cluster.photos.through(
+                cluster=clusters[photo.id % NUM_CLUSTERS], photo=photo
+            ))
+        PhotoAnalysisResult.objects.bulk_create(results, batch_size=1000)
+        Cluster.photos.through.objects.bulk_create(cluster_photos, batch_size=1000)
+
+
+def drop_natural_key_indexes():
+    """
+    Drop the NATURAL_KEY_INDEXES, found by their columns, to compare query plans against the
+    schema before migration 0004_natural_key_indexes (the rest of the schema, like the columns
+    added since, is left as is). Unique constraints on the same columns are kept.
+
+    :return: names of the indexes dropped
+    """
+    dropped_indexes = []
+    with connection.cursor() as cursor:
+        for model, columns in NATURAL_KEY_INDEXES:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            for name, constraint in constraints.items():
+                if constraint['index'] and not constraint['unique'] \
+                        and constraint['columns'] == columns:
+                    cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+                    dropped_indexes.append(name)
+    return dropped_indexes
+
+
+def request_endpoint(client, url_name, url_args, body):
+    """
+    Request one of the ENDPOINTS with the test client, POSTing body as JSON if it isn't None
+    """
+    url = reverse(url_name, args=url_args)
+    if body is None:
+        return client.get(url)
+    return client.post(url, json.dumps(body), content_type='application/json')
+
+
+def count_queries(client, endpoints):
+    """
+    Number of SQL queries each endpoint makes
+    """
+    query_counts = {}
+    for name, url_name, url_args, body in endpoints:
+        query_counter = QueryCounter(num_slowest=0)
+        with connection.execute_wrapper(query_counter):
+            request_endpoint(client, url_name, url_args, body)
+        query_counts[name] = query_counter.count
+    return query_counts
+
+
+def explain_query(sql, params):
+    """
+    The database's query plan for a query, as a list of lines
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+        # SQLite's EXPLAIN QUERY PLAN gives (id, parent, notused, detail) rows
+        return [str(row[-1]) for row in cursor.fetchall()]
+
+
+def explain_endpoint(client, url_name, url_args, body):
+    """
+    Request an endpoint, and get the query plan of each distinct query it makes
+
+    :return: dict of SQL to query plan
+    """
+    queries = {}
+
+    def capture_query(execute, sql, params, many, context):
+        if not many:
+            queries.setdefault(sql, params)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(capture_query):
+        request_endpoint(client, url_name, url_args, body)
+    return {sql: explain_query(sql, params) for sql, params in queries.items()}
+
+
+def benchmark_endpoints(client, endpoints, repeat, explain=False):
+    """
+    Request each endpoint repeat times, measuring latency, SQL queries and response size.
+    If explain, also get the query plans of the queries each endpoint makes.
+    """
+    measurements = {}
+    for name, url_name, url_args, body in endpoints:
+        latencies = []
+        for _ in range(repeat):
+            query_counter = QueryCounter()
+            with connection.execute_wrapper(query_counter):
+                start_time = time.perf_counter()
+                response = request_endpoint(client, url_name, url_args, body)
+                latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        measurements[name] = {
+            'status': response.status_code,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'queries': query_counter.count,
+            'sql_ms': query_counter.total_time * 1000,
+            'response_bytes': len(response.content),
+            'slowest_queries': [
+                {'ms': seconds * 1000, 'sql': sql}
+                for seconds, sql, _ in query_counter.slowest_queries()
+            ],
+        }
+        if explain:
+            measurements[name]['query_plans'] = explain_endpoint(client, url_name, url_args, body)
+    return measurements
+
+
+class Command(BaseCommand):
+    """
+    Custom django-admin command used to benchmark the API endpoints
+    """
+    help = 'Measure the latency and SQL queries of the API endpoints on a synthetic database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--map_squares', type=int, action='store', default=1755)
+        parser.add_argument('--photos', type=int, action='store', default=20000)
+        parser.add_argument(
+            '--analyses',
+            type=int,
+            action='store',
+            default=20,
+            help='Number of analysis results for each photo',
+        )
+        parser.add_argument('--photographers', type=int, action='store', default=200)
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            action='store',
+            default=3,
+            help='Number of times to request each endpoint',
+        )
+        parser.add_argument(
+            '--endpoints',
+            nargs='+',
+            action='store',
+            choices=[name for name, _, _, _ in ENDPOINTS],
+            help='Endpoints to benchmark (default: all of them)',
+        )
+        parser.add_argument(
+            '--growth_check_fraction',
+            type=float,
+            action='store',
+            default=0.1,
+            help='Also count the queries with this fraction of the map squares, to flag endpoints '
+                 'whose number of queries grows with the data (0 to skip this)',
+        )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Show the query plan of every distinct query each endpoint makes',
+        )
+        parser.add_argument(
+            '--drop_natural_key_indexes',
+            action='store_true',
+            help='Drop the indexes added by migration 0004_natural_key_indexes from the test '
+                 'database, to compare query plans without them',
+        )
+        parser.add_argument('--seed', type=int, action='store', default=0)
+        parser.add_argument(
+            '--output',
+            type=str,
+            action='store',
+            help='Save the measurements as JSON',
+        )
+
+    def handle(self, *args, **options):
+        # pylint: disable=too-many-locals
+        num_map_squares = options.get('map_squares')
+        num_photos = options.get('photos')
+        analysis_names = get_analysis_names(options.get('analyses'))
+        num_photographers = min(options.get('photographers'), num_map_squares)
+        repeat = options.get('repeat')
+        endpoint_names = options.get('endpoints')
+        growth_check_fraction = options.get('growth_check_fraction')
+        seed = options.get('seed')
+        output_path = options.get('output')
+        explain = options.get('explain')
+        drop_indexes = options.get('drop_natural_key_indexes')
+
+        endpoints = [
+            endpoint for endpoint in ENDPOINTS
+            if endpoint_names is None or endpoint[0] in endpoint_names
+        ]
+        populate_args = (num_map_squares, num_photos, analysis_names, num_photographers, seed)
+
+        # Everything happens in a throwaway test database
+        setup_test_environment()
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            dropped_indexes = drop_natural_key_indexes() if drop_indexes else []
+            if dropped_indexes:
+                print_header(f'Dropped the indexes {", ".join(dropped_indexes)}')
+            client = Client()
+            small_query_counts = {}
+            num_small_map_squares = round(num_map_squares * growth_check_fraction)
+            if 0 < num_small_map_squares < num_map_squares:
+                print_header(f'Populating {num_small_map_squares} map squares...')
+                populate_database(1, num_small_map_squares, *populate_args)
+                small_query_counts = count_queries(client, endpoints)
+            else:
+                num_small_map_squares = 0
+
+            print_header(f'Populating {num_map_squares} map squares, {num_photos} photos and '
+                         f'{len(analysis_names)} analyses...')
+            populate_database(num_small_map_squares + 1, num_map_squares, *populate_args)
+
+            print_header(f'Requesting each endpoint {repeat} times...')
+            measurements = benchmark_endpoints(client, endpoints, repeat, explain)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            teardown_test_environment()
+
+        print_header('Results')
+        print(f'{"Endpoint":28} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9} {"Queries":>8} '
+              f'{"SQL ms":>8} {"KB":>9}')
+        growing_endpoints = []
+        for name, endpoint_measurements in measurements.items():
+            if name in small_query_counts:
+                endpoint_measurements['queries_at_growth_check'] = small_query_counts[name]
+                if endpoint_measurements['queries'] > small_query_counts[name]:
+                    growing_endpoints.append(name)
+            status = endpoint_measurements['status']
+            print(f'{name:28} {endpoint_measurements["p50_ms"]:9.1f} '
+                  f'{endpoint_measurements["p95_ms"]:9.1f} {endpoint_measurements["max_ms"]:9.1f} '
+                  f'{endpoint_measurements["queries"]:8} {endpoint_measurements["sql_ms"]:8.1f} '
+                  f'{endpoint_measurements["response_bytes"] / 1024:9.1f}'
+                  + ('' if status == 200 else f'  (status {status})'))
+
+        if explain:
+            print_header('Query plans')
+            for name, endpoint_measurements in measurements.items():
+                print(f'{name}:')
+                for sql, plan in endpoint_measurements['query_plans'].items():
+                    print(f'  {shorten(sql, 150)}')
+                    for line in plan:
+                        print(f'      {line}')
+
+        if small_query_counts:
+            print_header(f'{len(growing_endpoints)} endpoints make more queries with more data')
+            for name in growing_endpoints:
+                print(f'{name}: {small_query_counts[name]} queries with {num_small_map_squares} '
+                      f'map squares, {measurements[name]["queries"]} with {num_map_squares}')
+
+        if output_path:
+            with open(output_path, 'w', encoding='utf-8') as output_file:
+                json.dump({
+                    'map_squares': num_map_squares,
+                    'photos': num_photos,
+                    'analyses': len(analysis_names),
+                    'photographers': num_photographers,
+                    'dropped_indexes': dropped_indexes,
+                    'growing_endpoints': growing_endpoints,
+                    'endpoints': measurements,
+                }, output_file, indent=2)
+            print(f'Saved the measurements to {output_path}')
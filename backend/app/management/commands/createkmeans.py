@@ -4,20 +4,267 @@ Django management command syncdb
 Syncs local db with data from project Google Sheet
 """
 
+import argparse
 import pickle
 import os
 
+from functools import partial
+
 import cv2
-from sklearn.cluster import KMeans
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+from sklearn.metrics import silhouette_score
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
+from app.analysis.photo_similarity import similarity_utils
 from app.common import print_header
 from app.models import Photo
 from app.models import Cluster
 
 
+def photo_pks_from_ids(photo_ids):
+    """
+    Map a list of '{photo number}_{map square number}' ids to Photo primary keys,
+    with a single query. Ids with no matching photo are left out.
+    """
+    numbers = set()
+    map_square_numbers = set()
+    for photo_id in photo_ids:
+        number, map_square_number = photo_id.split('_')
+        numbers.add(int(number))
+        map_square_numbers.add(int(map_square_number))
+    rows = Photo.objects.filter(
+        number__in=numbers,
+        map_square__number__in=map_square_numbers,
+    ).values_list('pk', 'number', 'map_square__number')
+
+    pks = {}
+    for photo_pk, number, map_square_number in rows:
+        # If there are duplicates, use the first photo like filter(...)[0] would
+        pks.setdefault(f'{number}_{map_square_number}', photo_pk)
+    return pks
+
+
+def assign_clusters(number_of_clusters, photo_ids, labels):
+    """
+    Replace the photos in the clusters of the number_of_clusters model with the labeled photos,
+    creating the clusters if needed. Memberships are swapped in a single transaction, so readers
+    see either the old or the new clustering.
+    :return: the number of photos added to clusters
+    """
+    photo_pks = photo_pks_from_ids(photo_ids)
+    membership = Cluster.photos.through
+
+    with transaction.atomic():
+        clusters = {
+            cluster.label: cluster
+            for cluster in Cluster.objects.filter(model_n=number_of_clusters)
+        }
+        missing_labels = set(range(number_of_clusters)) - set(clusters)
+        if missing_labels:
+            Cluster.objects.bulk_create([
+                Cluster(model_n=number_of_clusters, label=label) for label in missing_labels
+            ])
+            clusters = {
+                cluster.label: cluster
+                for cluster in Cluster.objects.filter(model_n=number_of_clusters)
+            }
+
+        # Reset clusters to prevent previous photos from remaining in a cluster
+        # if they should not be
+        membership.objects.filter(cluster__in=clusters.values()).delete()
+
+        memberships = []
+        added_pks = set()
+        for photo_id, label in zip(photo_ids, labels):
+            photo_pk = photo_pks.get(photo_id)
+            if photo_pk is None:
+                print(f'Skipping photo {photo_id}, which is no longer in the database')
+                continue
+            cluster_pk = clusters[int(label)].pk
+            if (cluster_pk, photo_pk) in added_pks:
+                continue
+            added_pks.add((cluster_pk, photo_pk))
+            memberships.append(membership(cluster_id=cluster_pk, photo_id=photo_pk))
+        membership.objects.bulk_create(memberships, batch_size=500)
+    return len(memberships)
+
+
+def write_features(photos, num_features, featurize, features_path):
+    """
+    Write featurize(photo), a flat array of num_features values, for each photo as a float32
+    row of a memory mapped .npy file at features_path, so that only one photo's features are
+    held in memory at a time.
+
+    Photos that fail to load are skipped, so the file may have fewer rows than photos.
+    :return: the ids of the photos that were written, in row order
+    """
+    num_photos = len(photos)
+    features = np.lib.format.open_memmap(
+        features_path,
+        mode='w+',
+        dtype=np.float32,
+        shape=(num_photos, num_features),
+    )
+    photo_ids = []
+    for i, photo in enumerate(photos):
+        try:
+            features[len(photo_ids)] = featurize(photo)
+            photo_ids.append(f'{photo.number}_{photo.map_square.number}')
+            print(f'Reformatted {i} of {num_photos} photos.')
+        except Exception as error:  # pylint: disable=broad-except
+            print(f'Error: {error}')
+            print(f'Skipping photo number {photo.number}, map square '
+                  f'{photo.map_square.number}')
+    features.flush()
+    del features
+    return photo_ids
+
+
+def pixel_features(photo, dimensions):
+    """
+    The photo's grayscale image, resized to dimensions and flattened
+    """
+    grayscale_image = photo.get_image_data(as_gray=True, max_size=dimensions)
+    return cv2.resize(grayscale_image, dimensions).flatten() / 255
+
+
+def resnet18_features(photo):
+    """
+    The photo's stored ResNet-18 feature vector (see resnet18_feature_vectors)
+    """
+    feature_vector = similarity_utils.deserialize_feature_vector(photo)
+    if feature_vector is None:
+        raise ValueError('No feature vector was serialized (run resnet18_feature_vectors first)')
+    return feature_vector
+
+
+def reduce_dimensions(features, n_components, chunk_size):
+    """
+    Project the rows of features onto their first n_components principal components,
+    fitting IncrementalPCA over chunks of rows so memory use depends on chunk_size
+
+    There can't be more components than rows or columns, so n_components is clamped to those.
+    :return: an in-memory array of shape (number of rows, n_components)
+    """
+    num_rows, num_columns = features.shape
+    n_components = min(n_components, num_rows, num_columns)
+    # Every partial_fit call needs at least n_components rows, so a short last chunk is
+    # fit together with the one before it
+    chunk_size = max(chunk_size, n_components)
+    chunk_starts = list(range(0, num_rows, chunk_size))
+    if len(chunk_starts) > 1 and num_rows - chunk_starts[-1] < n_components:
+        chunk_starts.pop()
+    chunk_ends = chunk_starts[1:] + [num_rows]
+
+    pca = IncrementalPCA(n_components=n_components)
+    for start, end in zip(chunk_starts, chunk_ends):
+        pca.partial_fit(features[start:end])
+    return np.concatenate([
+        pca.transform(features[start:end]) for start, end in zip(chunk_starts, chunk_ends)
+    ])
+
+
+def parse_cluster_counts(value):
+    """
+    Parse a number of clusters ('8') or an inclusive range of them ('2-10') into a list
+    """
+    try:
+        if '-' in value:
+            start, end = value.split('-')
+            cluster_counts = list(range(int(start), int(end) + 1))
+        else:
+            cluster_counts = [int(value)]
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(f'invalid number of clusters: {value!r}') from error
+    if not cluster_counts or min(cluster_counts) < 2:
+        raise argparse.ArgumentTypeError(f'numbers of clusters must be at least 2: {value!r}')
+    return cluster_counts
+
+
+def fit_minibatch_kmeans(features, number_of_clusters, random_state, chunk_size, passes):
+    """
+    Fit a MiniBatchKMeans model with partial_fit over chunks of the rows of features,
+    so memory use depends on chunk_size rather than on the number of photos
+    :return: the fitted model, the label of every row and the model's inertia
+    """
+    # partial_fit needs at least n_clusters samples in its first call
+    chunk_size = max(chunk_size, number_of_clusters)
+    chunk_starts = range(0, len(features), chunk_size)
+    kmeans = MiniBatchKMeans(n_clusters=number_of_clusters, random_state=random_state)
+    for _ in range(passes):
+        for start in chunk_starts:
+            kmeans.partial_fit(features[start:start + chunk_size])
+    labels = []
+    inertia = 0.0
+    for start in chunk_starts:
+        chunk = features[start:start + chunk_size]
+        labels.append(kmeans.predict(chunk))
+        # score is the negative sum of squared distances to the closest centers
+        inertia -= kmeans.score(chunk)
+    return kmeans, np.concatenate(labels), inertia
+
+
+def sampled_silhouette_score(features, labels, sample_size, random_state):
+    """
+    Silhouette score of the clustering over a random sample of at most sample_size rows,
+    as the full score is quadratic in the number of photos
+    """
+    if len(set(labels)) < 2:
+        return float('nan')
+    random_generator = np.random.default_rng(random_state)
+    sample = np.sort(random_generator.choice(
+        len(features), size=min(sample_size, len(features)), replace=False
+    ))
+    sample_labels = labels[sample]
+    if len(set(sample_labels)) < 2:
+        return float('nan')
+    return float(silhouette_score(features[sample], sample_labels))
+
+
+def sweep_kmeans(features, cluster_counts, random_state, chunk_size, passes,
+                 silhouette_sample_size, n_jobs):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Fit a kmeans model for each number of clusters in cluster_counts over the same features,
+    in parallel threads (the heavy lifting in scikit-learn releases the GIL, and threads
+    share the feature matrix rather than copying it)
+    :return: a dict from number of clusters to (labels, inertia, silhouette score)
+    """
+    def fit(number_of_clusters):
+        _kmeans, labels, inertia = fit_minibatch_kmeans(
+            features, number_of_clusters, random_state, chunk_size, passes
+        )
+        silhouette = sampled_silhouette_score(
+            features, labels, silhouette_sample_size, random_state
+        )
+        return number_of_clusters, (labels, inertia, silhouette)
+
+    return dict(Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(fit)(number_of_clusters) for number_of_clusters in cluster_counts
+    ))
+
+
+def best_cluster_count(sweep_results):
+    """
+    The number of clusters with the highest silhouette score in the results of sweep_kmeans,
+    or None if none of them have one
+    """
+    scored_cluster_counts = [
+        (silhouette, number_of_clusters)
+        for number_of_clusters, (_labels, _inertia, silhouette) in sweep_results.items()
+        if not np.isnan(silhouette)
+    ]
+    if not scored_cluster_counts:
+        return None
+    return max(scored_cluster_counts)[1]
+
+
 class Command(BaseCommand):
     """
     Custom django-admin command used to run an analysis from the app/analysis folder
@@ -27,9 +274,12 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             'n_clusters',
-            type=int,
+            type=parse_cluster_counts,
             action='store',
-            help='Number of different clusters the model tries to group the photos into',
+            nargs='+',
+            help='Number of different clusters the model tries to group the photos into. '
+                 'Give several numbers or ranges (e.g. 4 8 10-12) to fit a model for each '
+                 'and compare their inertia and silhouette scores',
         )
         parser.add_argument(
             '--limit',
@@ -48,97 +298,154 @@ class Command(BaseCommand):
         parser.add_argument(
             '--random_state',
             action='store',
+            type=int,
             default=0,
             help='Used for kmeans centroid initialization'
         )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            action='store',
+            default=128,
+            help='Number of photos held in memory at a time while clustering',
+        )
+        parser.add_argument(
+            '--passes',
+            type=int,
+            action='store',
+            default=3,
+            help='Number of passes over the photos when fitting the kmeans model',
+        )
+        parser.add_argument(
+            '--features',
+            action='store',
+            choices=['pixels', 'resnet18'],
+            default='pixels',
+            help='Cluster on resized grayscale pixels, or on the feature vectors stored by the '
+                 'resnet18_feature_vectors analysis',
+        )
+        parser.add_argument(
+            '--pca_components',
+            type=int,
+            action='store',
+            help='Reduce the features to this many dimensions with incremental PCA before '
+                 'clustering',
+        )
+        parser.add_argument(
+            '--n_jobs',
+            type=int,
+            action='store',
+            default=-1,
+            help='Number of models fit in parallel when given several numbers of clusters '
+                 '(-1 to use every core)',
+        )
+        parser.add_argument(
+            '--silhouette_sample_size',
+            type=int,
+            action='store',
+            default=2000,
+            help='Number of photos sampled to compute each silhouette score',
+        )
         parser.add_argument('--use_pickled', action='store_true')
 
     def handle(self, *args, **options):
         # pylint: disable=too-many-locals
-        number_of_clusters = options.get('n_clusters')
+        cluster_counts = sorted({
+            number_of_clusters
+            for cluster_count_list in options.get('n_clusters')
+            for number_of_clusters in cluster_count_list
+        })
         limit = options.get('limit', None)
         random_state = options.get('random_state')
         use_pickled = options.get('use_pickled')
         dimensions = tuple(options.get('resize'))
+        chunk_size = options.get('chunk_size')
+        passes = options.get('passes')
+        feature_type = options.get('features')
+        pca_components = options.get('pca_components')
+        n_jobs = options.get('n_jobs')
+        silhouette_sample_size = options.get('silhouette_sample_size')
 
-        labels_path = os.path.join(settings.ANALYSIS_PICKLE_PATH,
-                                   f'{number_of_clusters}_{dimensions}_model.pickle')
-        photos_path = os.path.join(settings.ANALYSIS_PICKLE_PATH,
-                                   f'{dimensions}_photos.pickle')
-        valid_photos = []
-        if use_pickled and os.path.exists(labels_path):
-            with open(labels_path, 'rb') as labels_pickle:
-                labels, photo_ids = pickle.load(labels_pickle)
-            # Collect photos that have a valid source in the order that labels were originally
-            # assigned
-            for photo_id in photo_ids:
-                number, map_square_number = photo_id.split('_')
-                valid_photos.append(
-                    Photo.objects.filter(
-                        number=int(number),
-                        map_square__number=int(map_square_number)
-                    )[0]
-                )
+        if feature_type == 'resnet18':
+            features_name = 'resnet18'
+            num_features = 512
+            featurize = resnet18_features
         else:
-            # Create Kmeans model and get labels
+            features_name = str(dimensions)
+            num_features = dimensions[0] * dimensions[1]
+            featurize = partial(pixel_features, dimensions=dimensions)
+        model_name = features_name + (f'_pca{pca_components}' if pca_components else '')
+
+        def get_labels_path(number_of_clusters):
+            return os.path.join(settings.ANALYSIS_PICKLE_PATH,
+                                f'{number_of_clusters}_{model_name}_model.pickle')
+
+        # Reformatted photos are stored as rows of a float32 .npy file, with the ids of the
+        # photos they came from pickled alongside
+        features_path = os.path.join(settings.ANALYSIS_PICKLE_PATH,
+                                     f'{features_name}_photos.npy')
+        photo_ids_path = os.path.join(settings.ANALYSIS_PICKLE_PATH,
+                                      f'{features_name}_photo_ids.pickle')
+
+        # Number of clusters -> (labels, ids of the labeled photos)
+        clusterings = {}
+        for number_of_clusters in cluster_counts:
+            labels_path = get_labels_path(number_of_clusters)
+            if use_pickled and os.path.exists(labels_path):
+                with open(labels_path, 'rb') as labels_pickle:
+                    labels, photo_ids = pickle.load(labels_pickle)
+                clusterings[number_of_clusters] = (labels, photo_ids)
+
+        cluster_counts_to_fit = [
+            number_of_clusters for number_of_clusters in cluster_counts
+            if number_of_clusters not in clusterings
+        ]
+        if cluster_counts_to_fit:
+            # Create Kmeans models and get labels
             print_header("Preparing reformatted photos (This might take a couple of minutes)...")
-            reformatted_photos = []
-            if use_pickled and os.path.exists(photos_path):
+            if use_pickled and os.path.exists(features_path) and os.path.exists(photo_ids_path):
                 print('Loading pickled reformatted photos.')
-                with open(photos_path, 'rb') as photos_pickle:
-                    reformatted_photos = pickle.load(photos_pickle)
+                with open(photo_ids_path, 'rb') as photo_ids_pickle:
+                    photo_ids = pickle.load(photo_ids_pickle)
             else:
-                valid_photos = [photo for photo in Photo.objects.all() if photo.has_valid_source()]
+                os.makedirs(settings.ANALYSIS_PICKLE_PATH, exist_ok=True)
+                valid_photos = [photo for photo in Photo.objects.select_related('map_square')
+                                if photo.has_valid_source()]
                 if limit:
                     valid_photos = valid_photos[:limit]
-                num_photos = len(valid_photos)
-                for i, photo in enumerate(valid_photos):
-                    try:
-                        grayscale_image = photo.get_image_data(as_gray=True)
-                        reformatted_photo = cv2.resize(grayscale_image, dimensions).flatten() / 255
-                        reformatted_photos.append(reformatted_photo)
-                        print(f'Reformatted {i} of {num_photos} photos.')
-                    except Exception as e:
-                        print(f'Error: {e}')
-                        print(f'Skipping photo number {photo.number}, map square '
-                              f'{photo.map_square.number}')
-
-                # TODO: handle case where analysis fails (this won't pickle if something fails)
-                # Save reformatted_photos
-                with open(photos_path, 'wb') as photos_pickle:
-                    pickle.dump(reformatted_photos, photos_pickle)
+                photo_ids = write_features(valid_photos, num_features, featurize, features_path)
+                with open(photo_ids_path, 'wb') as photo_ids_pickle:
+                    pickle.dump(photo_ids, photo_ids_pickle)
             print("Done!")
 
+            # Rows past len(photo_ids) belong to photos that failed to load
+            features = np.load(features_path, mmap_mode='r')[:len(photo_ids)]
+            if pca_components:
+                print_header(f"Reducing features to {pca_components} dimensions...")
+                features = reduce_dimensions(features, pca_components, chunk_size)
+
             print_header("Generating labels...")
-            kmeans = KMeans(
-                n_clusters=number_of_clusters, random_state=random_state
-            ).fit(reformatted_photos)
-            labels = kmeans.labels_
+            sweep_results = sweep_kmeans(
+                features, cluster_counts_to_fit, random_state, chunk_size, passes,
+                silhouette_sample_size, n_jobs,
+            )
+            for number_of_clusters, (labels, _inertia, _silhouette) in sweep_results.items():
+                clusterings[number_of_clusters] = (labels, photo_ids)
             print("Done!")
 
-        # Get clusters
-        clusters = Cluster.objects.filter(model_n=number_of_clusters)
-        if not clusters:
-            clusters = []
-            for i in range(number_of_clusters):
-                cluster = Cluster(model_n=number_of_clusters, label=i)
-                cluster.save()
-                clusters.append(cluster)
-        else:
-            # Reset clusters if they exist to prevent previous photos from remaining in the
-            # cluster if they should not be
-            for cluster in clusters:
-                cluster.photos.remove(*cluster.photos.all())
-
-        # Add photos to clusters
-        print('Adding photos to clusters')
-        for photo, label in zip(valid_photos, labels):
-            label = int(label)
-            clusters[label].photos.add(photo)
-            clusters[label].save()
-
-        # Save labels
-        # TODO: handle case where analysis fails (this won't pickle if something fails)
-        with open(labels_path, 'wb') as labels_pickle:
-            photo_ids = [f'{photo.number}_{photo.map_square.number}' for photo in valid_photos]
-            pickle.dump([labels, photo_ids], labels_pickle)
+            print_header("Kmeans models")
+            print(f'{"n_clusters":>10}  {"inertia":>14}  {"silhouette":>10}')
+            for number_of_clusters, (_labels, inertia, silhouette) in sweep_results.items():
+                print(f'{number_of_clusters:>10}  {inertia:>14.2f}  {silhouette:>10.4f}')
+            best_number_of_clusters = best_cluster_count(sweep_results)
+            if best_number_of_clusters is not None:
+                print(f'Best silhouette score with {best_number_of_clusters} clusters')
+
+        for number_of_clusters, (labels, photo_ids) in clusterings.items():
+            print(f'Adding photos to {number_of_clusters} clusters')
+            num_added = assign_clusters(number_of_clusters, photo_ids, labels)
+            print(f'Added {num_added} photos to {number_of_clusters} clusters')
+
+            # Save labels
+            with open(get_labels_path(number_of_clusters), 'wb') as labels_pickle:
+                pickle.dump([labels, photo_ids], labels_pickle)
@@ -0,0 +1,115 @@
+"""
+Django management command createthumbnails
+
+Makes resized copies of every local photo for list and grid views, and records them on the Photo
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.common import print_header
+from app.image_derivatives import DERIVATIVE_FORMATS, make_derivatives
+from app.models import Photo
+
+
+class Command(BaseCommand):
+    """
+    Custom django-admin command used to make resized copies of the photos
+    """
+    help = 'Make resized copies (e.g. thumbnails) of every local photo, keeping aspect ratios'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            action='store',
+            default=[200, 500, 1200],
+            help='Each copy fits in a size x size box',
+        )
+        parser.add_argument(
+            '--formats',
+            nargs='+',
+            action='store',
+            choices=sorted(DERIVATIVE_FORMATS),
+            default=['jpg', 'webp'],
+        )
+        parser.add_argument('--quality', type=int, action='store', default=85)
+        parser.add_argument(
+            '--workers',
+            type=int,
+            action='store',
+            default=os.cpu_count(),
+            help='Number of processes resizing photos',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Remake copies even if they are newer than the photo',
+        )
+        parser.add_argument('--src_dir', action='store', default=settings.LOCAL_PHOTOS_DIR)
+
+    def handle(self, *args, **options):
+        # pylint: disable=too-many-locals
+        sizes = sorted(set(options.get('sizes')))
+        extensions = options.get('formats')
+        quality = options.get('quality')
+        workers = options.get('workers')
+        force = options.get('force')
+        src_dir = options.get('src_dir')
+
+        photos = []
+        tasks = []
+        for photo in Photo.objects.select_related('map_square'):
+            if not photo.has_valid_source() or photo.map_square is None:
+                continue
+            source_path = photo.get_image_local_filepath(src_dir=src_dir)
+            if not source_path or not os.path.exists(source_path):
+                continue
+            outputs = [
+                (photo.get_derivative_path(size, extension, src_dir=src_dir), size, extension)
+                for size in sizes
+                for extension in extensions
+            ]
+            photos.append(photo)
+            tasks.append((source_path, outputs))
+
+        print_header(f'Making {len(sizes) * len(extensions)} copies of {len(photos)} photos...')
+        changed_photos = []
+        num_failed = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(make_derivatives, source_path, outputs, quality, force)
+                for source_path, outputs in tasks
+            ]
+            for i, (photo, future) in enumerate(zip(photos, futures)):
+                try:
+                    done = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print('Error:', error)
+                    print(f'Photo number {photo.number}, map square {photo.map_square.number} '
+                          'failed. Skipping.')
+                    num_failed += 1
+                    continue
+
+                # Keep any sizes made by earlier runs, and add the ones we have now
+                derivatives = json.loads(photo.derivatives) if photo.derivatives else {}
+                for size, extension in done:
+                    extensions_made = derivatives.setdefault(str(size), [])
+                    if extension not in extensions_made:
+                        extensions_made.append(extension)
+                derivatives = json.dumps(derivatives, sort_keys=True)
+                if derivatives != photo.derivatives:
+                    photo.derivatives = derivatives
+                    changed_photos.append(photo)
+                if (i + 1) % 100 == 0:
+                    print(f'Processed {i + 1} of {len(photos)} photos.')
+
+        with transaction.atomic():
+            Photo.objects.bulk_update(changed_photos, ['derivatives'], batch_size=500)
+        print(f'Done! Updated {len(changed_photos)} photos ({num_failed} failed).')
@@ -8,17 +8,250 @@ import sys
 import pickle
 import os
 import json
+import time
 
 from importlib import import_module
-from typing import Callable
+from typing import Callable, Iterable, Iterator, Optional, Tuple
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
 
 from app.common import print_header
+from app.instrumentation import RunStats, timed_stage
 from app.models import PhotoAnalysisResult
 
 
+def describe_instance(model_instance):
+    """
+    Identify a photo in the command's progress output
+    """
+    # NOTE: This assumes that the photo number and map square number are not None
+    return f'{type(model_instance).__name__} {model_instance.id} ' \
+           f'(Photo number: {model_instance.number}, ' \
+           f'Map square: {model_instance.map_square.number})'
+
+
+def compute_results(
+    model_instances: list,
+    analysis_func: Callable[[object], object],
+    analysis_batch_func: Optional[Callable[[Iterable], Iterator[Tuple[object, object]]]],
+    batch_size: int,
+    analysis_name: str,
+    stats: RunStats,
+):
+    """
+    Run the analysis over model_instances, yielding (model_instance, result) pairs
+    for every instance that was analyzed successfully.
+
+    If the analysis module provides analyze_batch, instances are handed to it batch_size at a
+    time. If a batch raises, the instances it had not finished are retried one at a time with
+    analyze, so that a single bad photo only costs its own result.
+
+    The time taken for each result (and photos that fail) are recorded in stats.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    if analysis_batch_func is None:
+        batches = [(model_instance,) for model_instance in model_instances]
+    else:
+        batches = [
+            model_instances[i:i + batch_size]
+            for i in range(0, len(model_instances), batch_size)
+        ]
+
+    for batch in batches:
+        num_done = 0
+        if analysis_batch_func is not None:
+            try:
+                for model_instance, result in stats.timed_iter(analysis_batch_func(batch),
+                                                               'analyze'):
+                    print(f'Ran {analysis_name} on {describe_instance(model_instance)}')
+                    num_done += 1
+                    yield model_instance, result
+            except Exception as error:  # pylint: disable=broad-except
+                print('Error:', error)
+                print('Batch failed. Running the rest of the batch one photo at a time.')
+
+        for model_instance in batch[num_done:]:
+            print(f'Running {analysis_name} on {describe_instance(model_instance)}')
+            try:
+                with stats.stage('analyze'):
+                    result = analysis_func(model_instance)
+            except Exception as error:  # pylint: disable=broad-except
+                print('Error:', error)
+                print(f'Photo number {model_instance.number} failed. Skipping.')
+                stats.item_done(failed=True)
+                continue
+            yield model_instance, result
+
+
+class ResultJournal:
+    """
+    Append-only checkpoint of analysis results, stored as one JSON object per line
+    ({"id": instance identifier, "result": result}) so each result costs a single small write.
+
+    Appends are fsync'd every fsync_every results and when the journal is closed. A crash can
+    only lose the results since the last fsync, and a line cut short by the crash is ignored
+    when the journal is read back.
+    """
+
+    def __init__(self, path, fsync_every: int = 20):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._file = None
+        self._num_unsynced = 0
+
+    def load(self, legacy_pickle_path=None) -> dict:
+        """
+        Read the results recorded so far, with later entries overriding earlier ones.
+        If there is no journal yet, fall back on the pickled results of older runs.
+        """
+        stored_results = {}
+        if not os.path.exists(self.path):
+            if legacy_pickle_path and os.path.exists(legacy_pickle_path):
+                with open(legacy_pickle_path, 'rb') as analysis_pickle:
+                    stored_results = pickle.load(analysis_pickle)
+            return stored_results
+
+        with open(self.path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial line from a run that crashed mid-write
+                    continue
+                stored_results[entry['id']] = entry['result']
+        return stored_results
+
+    def open(self, stored_results: dict):
+        """
+        Start a compacted journal holding stored_results, and append to it from then on.
+        The compacted copy replaces the old journal atomically.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            for instance_identifier, result in stored_results.items():
+                temp_file.write(self._format_entry(instance_identifier, result))
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    def append(self, instance_identifier: str, result):
+        """
+        Record the result of an instance, fsyncing if fsync_every results haven't been yet
+        """
+        self._file.write(self._format_entry(instance_identifier, result))
+        self._num_unsynced += 1
+        if self._num_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush the appended results to disk
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._num_unsynced = 0
+
+    def close(self):
+        """
+        Flush the appended results to disk and stop appending
+        """
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _format_entry(instance_identifier, result):
+        return json.dumps({'id': instance_identifier, 'result': result}) + '\n'
+
+
+class ResultWriter:
+    """
+    Buffers analysis results and writes them to the database batch_size at a time,
+    each batch in a single transaction.
+
+    In incremental mode, existing results of the analysis for the same model instances are
+    updated in place (with bulk_update) rather than new rows being created.
+    """
+
+    def __init__(self, analysis_result_model, analysis_name: str, batch_size: int,
+                 incremental: bool = False):
+        self.analysis_result_model = analysis_result_model
+        self.analysis_name = analysis_name
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.pending = []
+        self.num_written = 0
+
+    def add(self, model_instance, result):
+        """
+        Queue a result to be written, flushing the queue if it's full
+        """
+        # Serialize straight away, so an unserializable result fails on its own photo
+        with timed_stage('serialize'):
+            serialized_result = json.dumps(result)
+        self.pending.append((model_instance, serialized_result))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the queued results. If the batch fails, results are retried one at a time
+        so that a single bad row only costs its own result.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            with timed_stage('save'):
+                self._write(pending)
+        except Exception as batch_error:  # pylint: disable=broad-except
+            print('Error:', batch_error)
+            print('Writing the batch failed. Writing its results one at a time.')
+            for model_instance, serialized_result in pending:
+                try:
+                    self._write([(model_instance, serialized_result)])
+                except Exception as row_error:  # pylint: disable=broad-except
+                    print('Error:', row_error)
+                    print(f'Saving photo number {model_instance.number} failed. Skipping.')
+
+    def _write(self, pending):
+        """
+        Write (model instance, serialized result) pairs in one transaction, creating or (in
+        incremental mode) updating the rows in bulk
+        """
+        with transaction.atomic():
+            existing_results = {}
+            if self.incremental:
+                for analysis_result in self.analysis_result_model.objects.filter(
+                    name=self.analysis_name,
+                    photo__in=[model_instance for model_instance, _ in pending],
+                ):
+                    existing_results.setdefault(analysis_result.photo_id, analysis_result)
+
+            results_to_create = []
+            results_to_update = []
+            for model_instance, serialized_result in pending:
+                analysis_result = existing_results.get(model_instance.id)
+                if analysis_result is None:
+                    results_to_create.append(self.analysis_result_model(
+                        name=self.analysis_name,
+                        result=serialized_result,
+                        photo=model_instance,
+                    ))
+                else:
+                    analysis_result.result = serialized_result
+                    results_to_update.append(analysis_result)
+
+            self.analysis_result_model.objects.bulk_create(results_to_create)
+            self.analysis_result_model.objects.bulk_update(results_to_update, ['result'])
+        self.num_written += len(pending)
+
+
 class Command(BaseCommand):
     """
     Custom django-admin command used to run an analysis from the app/analysis folder
@@ -29,12 +262,68 @@ class Command(BaseCommand):
         parser.add_argument('analysis_name', action='store', type=str)
         parser.add_argument('--use_pickled', action='store_true')
         parser.add_argument('--run_one', action='store_true')
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            action='store',
+            default=16,
+            help='Number of photos handed to analyze_batch at a time, for analyses that have one',
+        )
+        parser.add_argument(
+            '--write_batch_size',
+            type=int,
+            action='store',
+            default=500,
+            help='Number of results written to the database per transaction',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Keep this analysis's existing results in the database, updating the results "
+                 'of the photos that are analyzed instead of replacing every result',
+        )
+        parser.add_argument(
+            '--decoded_image_cache_dir',
+            type=str,
+            action='store',
+            help='Cache decoded photos in this directory, so repeat runs skip decoding '
+                 '(overrides settings.DECODED_IMAGE_CACHE_DIR)',
+        )
+        parser.add_argument(
+            '--progress_every',
+            type=int,
+            action='store',
+            default=0,
+            help='Print throughput and an ETA every this many photos (0 to never print them)',
+        )
+        parser.add_argument(
+            '--stats_file',
+            type=str,
+            action='store',
+            help='Also write the JSON timing summary of the run to this file',
+        )
 
     def handle(self, *args, **options):
-        # pylint: disable=too-many-locals
+        decoded_image_cache_dir = options.get('decoded_image_cache_dir')
+        # Override the setting for this run only, rather than for the rest of the process
+        with override_settings(
+            DECODED_IMAGE_CACHE_DIR=decoded_image_cache_dir or settings.DECODED_IMAGE_CACHE_DIR
+        ):
+            self.run_analysis(options)
+
+    def run_analysis(self, options):
+        """
+        Run the analysis with the command's options
+        """
+        # pylint: disable=too-many-locals,too-many-statements,too-many-branches
         analysis_name = options.get('analysis_name')
         use_pickled = options.get('use_pickled')
         run_one = options.get('run_one')
+        batch_size = options.get('batch_size')
+        write_batch_size = options.get('write_batch_size')
+        incremental = options.get('incremental')
+        progress_every = options.get('progress_every')
+        stats_file = options.get('stats_file')
 
         try:
             analysis_module = import_module(f'.{analysis_name}', package='app.analysis')
@@ -47,22 +336,30 @@ class Command(BaseCommand):
             # Make sure local "ANALYSIS_PICKLE_PATH" exists before attempting to read or write
             os.makedirs(settings.ANALYSIS_PICKLE_PATH, exist_ok=True)
 
-            result_path = os.path.join(settings.ANALYSIS_PICKLE_PATH, f'{analysis_name}.pickle')
-            if os.path.exists(result_path):
-                with open(result_path, 'rb') as analysis_pickle:
-                    stored_results = pickle.load(analysis_pickle)
-            else:
-                stored_results = {}
+            # Results are checkpointed to a journal as they're computed, so that --use_pickled
+            # can pick up where a previous run left off (older runs pickled them instead)
+            journal = ResultJournal(
+                os.path.join(settings.ANALYSIS_PICKLE_PATH, f'{analysis_name}.jsonl')
+            )
+            stored_results = journal.load(
+                legacy_pickle_path=os.path.join(
+                    settings.ANALYSIS_PICKLE_PATH, f'{analysis_name}.pickle'
+                )
+            )
 
             analysis_func: Callable[[object], dict] = getattr(analysis_module, 'analyze')
+            # Analyses that load expensive models or detectors can also provide analyze_batch,
+            # a generator taking an iterable of instances and yielding (instance, result) pairs
+            analysis_batch_func = getattr(analysis_module, 'analyze_batch', None)
             model = getattr(analysis_module, 'MODEL')
 
             # TODO(ra): currently we assume all analyses are on Photos
             # Eventually we want to generalize to include analyses on MapSquares and Photographers
             analysis_result_model = PhotoAnalysisResult
 
-            # delete existing db instances
-            analysis_result_model.objects.filter(name=analysis_name).delete()
+            if not incremental:
+                # delete existing db instances
+                analysis_result_model.objects.filter(name=analysis_name).delete()
 
             if run_one:
                 # in a list because this has to be iterable for the loop below...
@@ -70,58 +367,78 @@ class Command(BaseCommand):
             else:
                 model_instances = model.objects.all()
 
-            num_computed = 0
-            save_threshold = 20  # Number of analyses that need to be done before pickling
+            result_writer = ResultWriter(
+                analysis_result_model, analysis_name, write_batch_size, incremental
+            )
 
+            load_start = time.perf_counter()
+            instances_to_analyze = []
             for model_instance in model_instances:
                 if not model_instance.has_valid_source():
                     continue
                 # NOTE: These identifiers assume that the photo number and map square number are
                 #       not None
-                print_msg = f'Running {analysis_name} on {model} {model_instance.id} ' \
-                            f'(Photo number: {model_instance.number}, ' \
-                            f'Map square: {model_instance.map_square.number})'
                 instance_identifier = f'photo_{model_instance.number}_' \
                                       f'{model_instance.map_square.number}'
 
-                should_run_analysis = True
                 if use_pickled:
                     if instance_identifier in stored_results:
                         print(f'Using stored results on (Photo number: {model_instance.number}, '
                               f'Map square: {model_instance.map_square.number})')
-                        result = stored_results[instance_identifier]
-                        should_run_analysis = False
-                    else:
-                        print('No stored result was found, so recomputing.')
-
-                if should_run_analysis:
-                    print(print_msg)
-                    try:
-                        result = analysis_func(model_instance)
-                        analysis_result = analysis_result_model(
-                            name=analysis_name,
-                            result=json.dumps(result),
-                            photo=model_instance,
-                        )
-                        analysis_result.save()
-
-                        # Store the result
-                        stored_results[instance_identifier] = result
-                        num_computed += 1
-
-                        # Quick save the analysis results so far in case of failure
-                        if num_computed == save_threshold:
-                            num_computed = 0
-                            with open(result_path, 'wb+') as analysis_pickle:
-                                pickle.dump(stored_results, analysis_pickle)
-                    except Exception as e:  # pylint: disable=bare-except
-                        print('Error:', e)
-                        print(f'Photo number {model_instance.number} failed. Skipping.')
-
-            # Save the analysis stored_results
-            # TODO: handle case where analysis fails (this won't pickle if something fails)
+                        try:
+                            result_writer.add(model_instance, stored_results[instance_identifier])
+                        except Exception as error:  # pylint: disable=broad-except
+                            print('Error:', error)
+                            print(f'Photo number {model_instance.number} failed. Skipping.')
+                        continue
+                    print('No stored result was found, so recomputing.')
+                instances_to_analyze.append(model_instance)
+
+            stats = RunStats(analysis_name, num_total=len(instances_to_analyze))
+            stats.record('load', time.perf_counter() - load_start)
+
+            computed_results = compute_results(
+                instances_to_analyze,
+                analysis_func,
+                analysis_batch_func,
+                batch_size,
+                analysis_name,
+                stats,
+            )
+            journal.open(stored_results)
+            last_progress = 0
             try:
-                with open(result_path, 'wb+') as analysis_pickle:
-                    pickle.dump(stored_results, analysis_pickle)
-            except:  # pylint: disable=bare-except
-                pass
+                with stats.activate():
+                    for model_instance, result in computed_results:
+                        instance_identifier = f'photo_{model_instance.number}_' \
+                                              f'{model_instance.map_square.number}'
+                        try:
+                            result_writer.add(model_instance, result)
+
+                            # Store the result
+                            stored_results[instance_identifier] = result
+                            with stats.stage('checkpoint'):
+                                journal.append(instance_identifier, result)
+                        except Exception as error:  # pylint: disable=broad-except
+                            print('Error:', error)
+                            print(f'Photo number {model_instance.number} failed. Skipping.')
+                            stats.item_done(failed=True)
+                        else:
+                            stats.item_done()
+
+                        num_processed = stats.num_done + stats.num_failed
+                        if progress_every and num_processed - last_progress >= progress_every:
+                            print(stats.progress_line())
+                            last_progress = num_processed
+
+                    result_writer.flush()
+            finally:
+                journal.close()
+
+            # Per-stage latencies (in seconds) and throughput, for comparing runs
+            print_header('Run statistics')
+            summary = stats.summary_json()
+            print(summary)
+            if stats_file:
+                with open(stats_file, 'w', encoding='utf-8') as stats_output:
+                    stats_output.write(summary + '\n')
@@ -3,12 +3,21 @@ Django management command syncdb
 
 Syncs local db with data from project Google Sheet
 """
+# pylint: disable=too-many-lines
 
 # Python standard library
 import csv
-import io
+import json
+from collections import Counter
 import os
 import pickle
+import random
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from textwrap import dedent
 from pathlib import Path
 
@@ -16,7 +25,8 @@ from pathlib import Path
 import cv2
 import tqdm
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
@@ -25,6 +35,7 @@ from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 # Ours
 from app.models import Photo, MapSquare, Photographer
@@ -48,6 +59,15 @@ SIDES = ['cleaned', 'front', 'back', 'binder', 'thumbnail']
 
 MODEL_NAME_TO_MODEL = {"Photo": Photo, "MapSquare": MapSquare, "Photographer": Photographer}
 
+# HTTP statuses of Google API errors that are worth retrying (403 only for rate limiting)
+RETRYABLE_STATUSES = {403, 429, 500, 502, 503, 504}
+
+# Network errors that are worth retrying (a download resumes from what it already wrote)
+RETRYABLE_TRANSPORT_ERRORS = (socket.timeout, ConnectionError, ssl.SSLError)
+
+# Bytes requested at a time when downloading a photo
+DOWNLOAD_CHUNK_SIZE = 16 * 2 ** 20
+
 
 def authorize_google_apps(cli_auth):
     """
@@ -83,145 +103,363 @@ def authorize_google_apps(cli_auth):
     return credentials
 
 
-def create_lookup_dict(drive_service):
+def list_drive_files(drive_service, query, fields='id, name'):
+    """
+    List every file matching a Drive query, following nextPageToken through all the pages
+    :param fields: the fields of each file to return
+    """
+    files = []
+    page_token = None
+    while True:
+        response = drive_service.files().list(
+            q=query,
+            fields=f'nextPageToken, files({fields})',
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        files.extend(response.get('files', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+def create_lookup_dict(drive_service, service_factory=None, max_workers=4, parents_per_query=50):
     """
     Creates a quick look up dictionary to get the image URL using map square number and source name
+
+    Map square folders are listed parents_per_query at a time (with a single query over their
+    ids), in up to max_workers threads.
     :param drive_service: the Google drive service
+    :param service_factory: creates a Google drive service for each thread (the service isn't
+                            thread safe); if None, the folders are listed one query at a time
+    :param max_workers: maximum number of queries to run at the same time
+    :param parents_per_query: number of map square folders listed by each query
     :return Look up dictionary to get the image URL using map square number and source name
     """
-    # Resource object for interacting with the google API
+    # List of dictionaries containing id and name of map square folder in the google drive
+    map_square_folders = list_drive_files(drive_service, f"'{PHOTO_FOLDER_ID}' in parents")
 
-    # Get list of files in google drive folder
-    results = drive_service.files().list(
-        q=f"'{PHOTO_FOLDER_ID}' in parents",
-        fields="nextPageToken, files(id, name)"
-    ).execute()
+    folder_id_groups = [
+        [folder['id'] for folder in map_square_folders[i:i + parents_per_query]]
+        for i in range(0, len(map_square_folders), parents_per_query)
+    ]
+    thread_local = threading.local()
 
-    # List of dictionaries containing id and name of map square folder in the google drive
-    map_square_folders = results.get('files', [])
-
-    lookup_dict = {}
-    # tqdm is a library that shows a progress bar
-    for map_square in tqdm.tqdm(map_square_folders):
-        result = drive_service.files().list(
-            q=f"'{map_square['id']}' in parents",
-            fields="files(id, name)"
-        ).execute()
-        images = result.get('files', [])
-
-        # Creates a dictionary mapping photo number to a list of the photo sources belonging to
-        # that number
-        map_square_dict = {'GOOGLE_DRIVE_MAP_SQUARE_FOLDER_ID': map_square['id']}
-        for image in images:
-            photo_number = image['name'].split('_')[0]
-            photo_drive_file_ids = map_square_dict.get(photo_number, {})
-            filename = image['name']
-            filename = filename.replace('JPG', 'jpg').replace('jpeg', 'jpg')
-            photo_drive_file_ids[filename] = image['id']
-            map_square_dict[photo_number] = photo_drive_file_ids
-
-        lookup_dict[map_square['name']] = map_square_dict
+    def list_images(folder_ids):
+        if service_factory is None:
+            service = drive_service
+        else:
+            if not hasattr(thread_local, 'service'):
+                thread_local.service = service_factory()
+            service = thread_local.service
+        query = ' or '.join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+        return list_drive_files(service, query, fields='id, name, parents')
+
+    images_by_folder_id = {folder['id']: [] for folder in map_square_folders}
+    with ThreadPoolExecutor(max_workers=max_workers if service_factory else 1) as executor:
+        # tqdm is a library that shows a progress bar
+        for images in tqdm.tqdm(executor.map(list_images, folder_id_groups),
+                                total=len(folder_id_groups)):
+            for image in images:
+                for parent_id in image.get('parents', []):
+                    if parent_id in images_by_folder_id:
+                        images_by_folder_id[parent_id].append(image)
+
+    return {
+        folder['name']: create_map_square_dict(folder, images_by_folder_id[folder['id']])
+        for folder in map_square_folders
+    }
+
+
+def create_map_square_dict(map_square_folder, images):
+    """
+    Creates a dictionary mapping photo number to a dictionary of the file ids of the photo sources
+    belonging to that number
+    :param map_square_folder: the id and name of the map square folder in the Google drive
+    :param images: the ids and names of the images in that folder
+    """
+    map_square_dict = {'GOOGLE_DRIVE_MAP_SQUARE_FOLDER_ID': map_square_folder['id']}
+    for image in images:
+        photo_number = image['name'].split('_')[0]
+        photo_drive_file_ids = map_square_dict.get(photo_number, {})
+        filename = image['name']
+        filename = filename.replace('JPG', 'jpg').replace('jpeg', 'jpg')
+        photo_drive_file_ids[filename] = image['id']
+        map_square_dict[photo_number] = photo_drive_file_ids
+    return map_square_dict
+
+
+def get_lookup_dict(drive_service, service_factory=None, max_workers=4, refresh=False):
+    """
+    create_lookup_dict, cached on disk at settings.DRIVE_LOOKUP_CACHE_FILE for
+    settings.DRIVE_LOOKUP_CACHE_TTL seconds so that repeat syncs skip listing the Drive folders
+    :param refresh: ignore the cache, and list the folders again
+    """
+    cache_path = Path(settings.DRIVE_LOOKUP_CACHE_FILE)
+    if not refresh and cache_path.exists():
+        age = time.time() - cache_path.stat().st_mtime
+        if age < settings.DRIVE_LOOKUP_CACHE_TTL:
+            print(f'Using the Drive listing cached {int(age // 60)} minutes ago '
+                  '(use --refresh_drive_lookup to list it again).')
+            with open(cache_path, encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+
+    lookup_dict = create_lookup_dict(drive_service, service_factory, max_workers)
+
+    temp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as cache_file:
+        json.dump(lookup_dict, cache_file)
+    os.replace(temp_path, cache_path)
     return lookup_dict
 
 
-# pylint: disable=too-many-arguments
+def is_retryable(error):
+    """
+    Whether a Google API error is transient (rate limiting or a server error)
+    """
+    status = error.resp.status
+    if status == 403:
+        # 403 is also used for permission errors, which retrying won't fix
+        return b'ateLimitExceeded' in error.content
+    return status in RETRYABLE_STATUSES
+
+
+class PhotoDownloader:
+    """
+    Downloads files from Google Drive in a pool of threads, so syncdb can keep writing rows to
+    the database while photos download.
+
+    Each thread builds its own Drive service with service_factory, as the underlying HTTP
+    client isn't thread safe. Rate limiting, server errors and dropped connections are retried
+    with exponential backoff. Files are downloaded with ranged requests to a .part file which is
+    renamed into place once complete, so an interrupted run never leaves a truncated photo
+    behind, and a retry (or the next run) requests the rest of the file from where the .part
+    file stops.
+    """
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+
+    def __init__(self, service_factory, max_workers=8, max_retries=5, backoff=1.0,
+                 redownload=False, verbose=False):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.service_factory = service_factory
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.redownload = redownload
+        self.verbose = verbose
+        self.sleep = time.sleep
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread_local = threading.local()
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def get_service(self):
+        """
+        The calling thread's Drive service
+        """
+        if not hasattr(self._thread_local, 'service'):
+            self._thread_local.service = self.service_factory()
+        return self._thread_local.service
+
+    def submit(self, drive_file_id, local_path, after_download=None):
+        """
+        Queue a download of the Drive file to local_path, unless it's already there (and we
+        aren't redownloading). after_download(drive_service, local_path), if given, is then
+        called from the download thread.
+        """
+        future = self._executor.submit(
+            self._download, drive_file_id, Path(local_path), after_download
+        )
+        self._futures.append((drive_file_id, local_path, future))
+        return future
+
+    def _download(self, drive_file_id, local_path, after_download):
+        """
+        Download the Drive file to local_path (run in a download thread)
+        """
+        drive_service = self.get_service()
+        if self.redownload or not local_path.exists():
+            if self.verbose:
+                print(f'Downloading {local_path}')
+            part_path = local_path.with_name(local_path.name + '.part')
+            if self.redownload and part_path.exists():
+                part_path.unlink()
+
+            try:
+                self._download_with_retries(drive_service, drive_file_id, part_path)
+            except Exception:
+                # Keep what we got for the next run to resume, unless it's nothing
+                if part_path.exists() and part_path.stat().st_size == 0:
+                    part_path.unlink()
+                raise
+            os.replace(part_path, local_path)
+
+        if after_download:
+            after_download(drive_service, local_path)
+
+    def _download_with_retries(self, drive_service, drive_file_id, part_path):
+        """
+        Download the Drive file to part_path, retrying transient errors up to max_retries times
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._download_to_part_file(drive_service, drive_file_id, part_path)
+                return
+            except HttpError as error:
+                if error.resp.status == 416:
+                    # The .part file doesn't match the file on Drive, so start over
+                    part_path.unlink()
+                elif not is_retryable(error):
+                    raise
+                if attempt == self.max_retries:
+                    raise
+            except RETRYABLE_TRANSPORT_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+            self.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    def _download_to_part_file(self, drive_service, drive_file_id, part_path):
+        """
+        Append the Drive file to part_path, requesting chunk_size bytes at a time from the end
+        of what's already there
+        """
+        request = drive_service.files().get_media(fileId=drive_file_id)
+        with open(part_path, 'ab') as out_file:
+            offset = out_file.tell()
+            total_size = None
+            while total_size is None or offset < total_size:
+                headers = dict(request.headers)
+                headers['range'] = f'bytes={offset}-{offset + self.chunk_size - 1}'
+                response, content = request.http.request(request.uri, 'GET', headers=headers)
+                if response.status == 416 and offset == 0:
+                    # An empty file has no bytes to request
+                    return
+                if response.status not in (200, 206):
+                    raise HttpError(response, content, uri=request.uri)
+                if response.status == 200:
+                    # The whole file, rather than the range we asked for
+                    out_file.seek(0)
+                    out_file.truncate()
+                    out_file.write(content)
+                    return
+
+                if not content:
+                    raise ConnectionError(f'Drive returned no data at byte {offset}')
+                out_file.write(content)
+                offset += len(content)
+                # e.g. 'bytes 0-99/1234', with '*' if the total size isn't known
+                size = response.get('content-range', '').rpartition('/')[2]
+                if size.isdigit():
+                    total_size = int(size)
+                elif len(content) < self.chunk_size:
+                    total_size = offset
+
+    def wait(self):
+        """
+        Wait for every queued download to finish, printing the ones that failed
+        :return: the number of downloads that failed
+        """
+        num_failed = 0
+        for drive_file_id, local_path, future in self._futures:
+            try:
+                future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                num_failed += 1
+                print('Error:', error)
+                print(f'Downloading {local_path} (Drive file {drive_file_id}) failed. Skipping.')
+        self._futures = []
+        return num_failed
+
+
+def upload_thumbnail(drive_service, local_photo_path, photo_number, map_square_folder_id):
+    """
+    Create a thumbnail from a downloaded photo, and upload it to the map square's
+    Google Drive folder
+    """
+    img = cv2.imread(str(local_photo_path))
+    thumbnail_dims = (500, 500) # Is this a good thumbnail size?
+    thumbnail_img = cv2.resize(img, thumbnail_dims)
+    thumbnail_path = Path(local_photo_path.parent, f'{photo_number}_thumbnail.jpg')
+    cv2.imwrite(str(thumbnail_path), thumbnail_img)
+
+    file_metadata = {'name': f'{photo_number}_thumbnail.jpg'}
+    media = MediaFileUpload(thumbnail_path, mimetype='image/jpeg')
+    # Uploads the thumbnail to your personal Drive
+    file = drive_service.files().create(body=file_metadata,
+                                        media_body=media,
+                                        fields='id').execute()
+    # Sets the parent of that file to the DH Paris 1970 Photo Folder in Google Drive
+    drive_service.files().update(fileId=file.get('id'),
+                                 addParents=map_square_folder_id,
+                                 fields='id, parents').execute()
+
+    # Remove the temporary thumbnail image in local storage
+    os.remove(thumbnail_path)
+
+
 def add_photo_srcs(
     model_kwargs,
     map_square_number,
     map_square_folder,
     photo_number,
-    drive_service,
-    local_download,
-    redownload,
-    verbose,
+    photo_downloader,
     create_thumbnails
 ):
     """
-    Takes the map square folder and the photo number to dynamically adds the Google Drive urls
-    into the model kwargs
+    Takes the map square folder and the photo number to dynamically record which sides of
+    the photo are on Google Drive in the model kwargs, and queue downloads of them
 
     :param model_kwargs: Dictionary of keyword arguments to be used in creating the model
     :param map_square_number: the map square number
     :param map_square_folder: Dictionary of photo sources with keys of photo_number
     :param photo_number: The number of the desired photo in the map_square_folder
-    :param drive_service: the Google Drive service
-    :param local_download: should we download the photos locally if we do not have them already?
-    :param redownload: should we redownload all photos locally?
-    :param verbose: should we print verbose messages
+    :param photo_downloader: PhotoDownloader used to download the photos locally,
+                             or None to not download them
     :param create_thumbnails: should we create thumbnails and upload it to Google Drive?
     """
-    # TODO(ra): this needs refactoring out into component parts -- has gotten too bloated
-    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
     photo_drive_file_ids = map_square_folder.get(str(photo_number), '')
     if photo_drive_file_ids == '':
         return
 
-    already_made_thumbnail = False
+    photo_field_names = get_field_names(Photo)
+    # Only make a thumbnail if there isn't one in Drive yet, from the first side we download
+    make_thumbnail = (
+        create_thumbnails
+        and f'{photo_number}_thumbnail.jpg' not in photo_drive_file_ids
+    )
 
     for side in SIDES:
-
         drive_file_id = photo_drive_file_ids.get(f'{photo_number}_{side}.jpg', '')
+        if f'{side}_src' in photo_field_names:
+            model_kwargs[f'{side}_src'] = bool(drive_file_id)
 
-        if drive_file_id:
-            src_url = f"https://drive.google.com/uc?id={drive_file_id}&export=download"
-            model_kwargs[f'{side}_src'] = src_url
-
-            if side == 'thumbnail':
-                continue  # we do not want to download thumbnails
-
-            if local_download:
-                request = drive_service.files().get_media(fileId=drive_file_id)
-                Path(settings.LOCAL_PHOTOS_DIR).mkdir(exist_ok=True)
-                local_map_square_dir = Path(settings.LOCAL_PHOTOS_DIR, map_square_number)
-                local_map_square_dir.mkdir(exist_ok=True)
-                local_photo_path = Path(local_map_square_dir, f'{photo_number}_{side}.jpg')
-
-                if (not local_photo_path.exists()) or redownload:
-                    if verbose:
-                        print(f'Downloading map square {map_square_number}, photo {photo_number}, '
-                              f'side {side}')
-                    out_file = io.FileIO(local_photo_path, mode='wb')
-                    downloader = MediaIoBaseDownload(out_file, request)
-                    done = False
-                    while done is False:
-                        _, done = downloader.next_chunk()
-
-                model_kwargs[f'{side}_local_path'] = local_photo_path
-
-                # Create thumbnails only on the cleaned image
-                if create_thumbnails and side in ['cleaned', 'front']:
-                    thumbnail_id = photo_drive_file_ids.get(f'{photo_number}_thumbnail.jpg', '')
-                    if thumbnail_id != '' or already_made_thumbnail:
-                        already_made_thumbnail = True
-                        return  # We already have that thumbnail in drive
-
-                    # Create thumbnail from existing local file
-                    img = cv2.imread(str(local_photo_path))
-                    thumbnail_dims = (500, 500) # Is this a good thumbnail size?
-                    thumbnail_img = cv2.resize(img, thumbnail_dims)
-                    thumbnail_path = Path(local_map_square_dir, f'{photo_number}_thumbnail.jpg')
-                    cv2.imwrite(str(thumbnail_path), thumbnail_img)
-
-                    file_metadata = {'name': f'{photo_number}_thumbnail.jpg'}
-                    media = MediaFileUpload(thumbnail_path, mimetype='image/jpeg')
-                    # Uploads the thumbnail to your personal Drive
-                    file = drive_service.files().create(body=file_metadata,
-                                                        media_body=media,
-                                                        fields='id').execute()
-                    # Sets the parent of that file to the DH Paris 1970 Photo Folder in Google Drive
-                    folder_id = map_square_folder['GOOGLE_DRIVE_MAP_SQUARE_FOLDER_ID']
-                    drive_service.files().update(fileId=file.get('id'),
-                                                 addParents=folder_id,
-                                                 fields='id, parents').execute()
-
-                    # Remove the temporary thumbnail image in local storage
-                    os.remove(thumbnail_path)
-
-                    already_made_thumbnail = True
-        else:
-            model_kwargs[f'{side}_src'] = None
-            if side != 'thumbnail':
-                model_kwargs[f'{side}_local_path'] = None
+        # we do not want to download thumbnails
+        if not drive_file_id or side == 'thumbnail' or photo_downloader is None:
+            continue
+
+        local_map_square_dir = Path(settings.LOCAL_PHOTOS_DIR, map_square_number)
+        local_map_square_dir.mkdir(parents=True, exist_ok=True)
+        local_photo_path = Path(local_map_square_dir, f'{photo_number}_{side}.jpg')
+
+        after_download = None
+        # Create thumbnails only on the cleaned image (or the front if there's no cleaned one)
+        if make_thumbnail and side in ['cleaned', 'front']:
+            make_thumbnail = False
+            after_download = partial(
+                upload_thumbnail,
+                photo_number=photo_number,
+                map_square_folder_id=map_square_folder['GOOGLE_DRIVE_MAP_SQUARE_FOLDER_ID'],
+            )
+
+        photo_downloader.submit(drive_file_id, local_photo_path, after_download)
 
 
 def call_sheets_api(spreadsheet_ranges, sheets_service):
@@ -239,15 +477,158 @@ def call_sheets_api(spreadsheet_ranges, sheets_service):
     return databases
 
 
-def create_map_square(map_square_count, mp_coords_dict, verbose):
+def get_natural_key(model_name, model_kwargs):
+    """
+    The key that identifies a row across syncs (database pks change when the db is rebuilt):
+    the number for map squares and photographers, and the map square and photo number for photos
+    """
+    if model_name == 'Photo':
+        map_square = model_kwargs.get('map_square')
+        return getattr(map_square, 'number', None), model_kwargs.get('number')
+    return model_kwargs.get('number')
+
+
+def get_existing_instances(model_name):
+    """
+    Map the natural key of every existing instance of the model to the instance
+    """
+    model = MODEL_NAME_TO_MODEL[model_name]
+    instances = model.objects.all()
+    if model_name == 'Photo':
+        instances = instances.select_related('map_square')
+    existing_instances = {}
+    for instance in instances:
+        if model_name == 'Photo':
+            natural_key = (getattr(instance.map_square, 'number', None), instance.number)
+        else:
+            natural_key = instance.number
+        # If there are duplicates, keep the first one
+        existing_instances.setdefault(natural_key, instance)
+    return existing_instances
+
+
+@lru_cache(maxsize=None)
+def get_field_names(model):
+    """
+    Names of the model's fields
+    """
+    return frozenset(field.name for field in model._meta.get_fields())
+
+
+class PendingChanges:
+    """
+    Model instances to create, update or delete, written in bulk by save()
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.to_create = []
+        self.to_update = {}
+        self.updated_fields = set()
+        self.to_delete = []
+
+    def create(self, instance):
+        """
+        Queue a new instance to be created
+        """
+        self.to_create.append(instance)
+
+    def update(self, instance, changed_fields):
+        """
+        Queue an existing instance to be saved, with the names of the fields that changed
+        (only those fields are written)
+        """
+        if instance.pk is None:
+            return  # Not created yet, so it's saved with the changes anyway
+        self.to_update[instance.pk] = instance
+        self.updated_fields.update(changed_fields)
+
+    def delete(self, instance):
+        """
+        Queue an existing instance to be deleted
+        """
+        self.to_delete.append(instance)
+
+    def save(self, batch_size=500):
+        """
+        Write every pending change in a single transaction
+        """
+        with transaction.atomic():
+            if self.to_delete:
+                self.model.objects.filter(
+                    pk__in=[instance.pk for instance in self.to_delete]
+                ).delete()
+            self.model.objects.bulk_create(self.to_create, batch_size=batch_size)
+            if self.to_update:
+                # Fields that didn't change on an instance are rewritten with their old value
+                self.model.objects.bulk_update(
+                    list(self.to_update.values()),
+                    sorted(self.updated_fields),
+                    batch_size=batch_size,
+                )
+        self.to_create = []
+        self.to_update = {}
+        self.updated_fields = set()
+        self.to_delete = []
+
+
+def upsert_model_instance(model_name, model_kwargs, existing_instances, pending_changes, verbose):
+    """
+    Create the model instance described by model_kwargs, or if an instance with the same natural
+    key exists, update the fields that changed. Existing instances (and anything pointing to
+    them, like analysis results) are kept.
+    :param existing_instances: dict from natural key to instance, which new instances are added to
+    :param pending_changes: PendingChanges the creation or update is queued in
+    :return: 'created', 'updated' or 'unchanged'
+    """
+    model = MODEL_NAME_TO_MODEL[model_name]
+    natural_key = get_natural_key(model_name, model_kwargs)
+    instance = existing_instances.get(natural_key)
+
+    if instance is None:
+        if verbose:
+            print(f'Creating {model_name} with kwargs: {model_kwargs}\n')
+        instance = model(**model_kwargs)
+        pending_changes.create(instance)
+        existing_instances[natural_key] = instance
+        return 'created'
+
+    changed_fields = []
+    for field_name, value in model_kwargs.items():
+        field = model._meta.get_field(field_name)
+        if field.is_relation:
+            new_value = getattr(value, 'pk', None)
+            old_value = getattr(instance, field.attname)
+        else:
+            new_value = field.to_python(value)
+            old_value = getattr(instance, field_name)
+        if new_value != old_value:
+            setattr(instance, field_name, value)
+            changed_fields.append(field_name)
+
+    if not changed_fields:
+        return 'unchanged'
+    if verbose:
+        print(f'Updating {", ".join(changed_fields)} of {model_name} {natural_key}\n')
+    pending_changes.update(instance, changed_fields)
+    return 'updated'
+
+
+def create_map_square(map_square_count, mp_coords_dict, verbose, existing_map_squares,
+                      pending_changes):
     """
     Final step to create map squares. Factored out for now because it's called twice:
     once to create map squares that are explicitly specified in the spreadsheet,
     and a second time to create the missing map squares.
+    Map squares that already exist (from an earlier sync) are left alone, and new ones are
+    queued in pending_changes.
 
     TODO: refactor out the rest of the map square creation code out of populate_database into
     this function.
     """
+    if map_square_count in existing_map_squares:
+        return
+
     if map_square_count in mp_coords_dict.keys():
         temp_model_coordinates = mp_coords_dict[map_square_count]
     else:
@@ -263,30 +644,37 @@ def create_map_square(map_square_count, mp_coords_dict, verbose):
         print(f'Creating map square with kwargs: {temp_model_kwargs}\n')
 
     model_instance = MapSquare(**temp_model_kwargs)
-    model_instance.save()
+    pending_changes.create(model_instance)
+    existing_map_squares[map_square_count] = model_instance
 
 
 def populate_database(
     model_name,
     values_as_a_dict,
     photo_url_lookup,
-    drive_service,
-    local_download,
-    redownload,
+    photo_downloader,
     verbose,
-    create_thumbnails
+    create_thumbnails,
+    delete_missing=False,
 ):
     """
-    Adds model instances to the database based on the data imported from the google spreadsheet
+    Adds model instances to the database based on the data imported from the google spreadsheet,
+    or updates them if they already exist. Foreign keys are resolved from instances loaded
+    up front, and everything is written in bulk in a single transaction at the end.
+    Existing instances that are no longer in the spreadsheet are counted as 'missing', and
+    deleted if delete_missing is set.
     :param model_name: Name of the model to create an instance of
     :param values_as_a_dict: List of dictionaries representing spreadsheet rows in the form of
     { column names: cell values }
     :param photo_url_lookup: Dictionary of map square folders in the form of a dictionary
-    :param drive_service: the Google Drive service
-    :param local_download: should we download the photos locally if we do not have them already?
-    :param redownload: should we redownload all photos locally?
+    :param photo_downloader: PhotoDownloader used to download the photos locally,
+                             or None to not download them
     :param verbose: should we print verbose messages
     :param create_thumbnails: should we create thumbnails and upload it to Google Drive?
+    :param delete_missing: should we delete instances that are no longer in the spreadsheet
+                           (along with everything that points to them, like analysis results)?
+    :return: Counter of how many instances were 'created', 'updated', 'unchanged', 'missing'
+             (and 'deleted')
     """
     # TODO(ra): @refactor -- this function has gotten bloated bc the handling code
     # for the different models has diverged a lot over the course of the semester
@@ -294,6 +682,28 @@ def populate_database(
     # Disabling these pylint checks now for expedience, but needs a cleanup
     # pylint: disable=too-many-locals
     # pylint: disable=too-many-branches
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    model = MODEL_NAME_TO_MODEL[model_name]
+    model_field_names = get_field_names(model)
+    sync_counts = Counter()
+    existing_instances = get_existing_instances(model_name)
+    previous_instances = dict(existing_instances)
+    # Natural keys of the instances the spreadsheet has (or that are created for it)
+    synced_keys = set()
+    pending_changes = PendingChanges(model)
+
+    # Foreign key targets, looked up in memory rather than with a query per row
+    map_squares_by_number = {}
+    photographers_by_number = {}
+    photographers_by_name = {}
+    if model_name in ['Photo', 'Photographer']:
+        for map_square in MapSquare.objects.all():
+            map_squares_by_number.setdefault(map_square.number, map_square)
+    if model_name == 'Photo':
+        for photographer in Photographer.objects.all():
+            photographers_by_number.setdefault(photographer.number, photographer)
+            photographers_by_name.setdefault(photographer.name, photographer)
+
     if model_name == "MapSquare":
         map_square_count = 1
         # Opens Map_Page_Output.csv and creates a dictionary with the map square
@@ -310,9 +720,6 @@ def populate_database(
 
     for row in values_as_a_dict:
         # Filter column headers for model fields
-        model_fields = MODEL_NAME_TO_MODEL[model_name]._meta.get_fields()
-        model_field_names = [field.name for field in model_fields]
-
         model_kwargs = {}
         for header in row.keys():
             if header in model_field_names or header == 'map_square_number':
@@ -354,8 +761,7 @@ def populate_database(
         if model_name in ['Photo', 'Photographer']:
             map_square_number = model_kwargs.get('map_square', None)
             # Returns the object that matches or None if there is no match
-            model_kwargs['map_square'] = \
-                MapSquare.objects.filter(number=map_square_number).first()
+            model_kwargs['map_square'] = map_squares_by_number.get(map_square_number)
 
         if model_name == 'Photo':
             # Gets the Map Square folder and the photo number to look up the URLs
@@ -370,36 +776,32 @@ def populate_database(
                     map_square_number,
                     map_square_folder,
                     photo_number,
-                    drive_service,
-                    local_download,
-                    redownload,
-                    verbose,
+                    photo_downloader,
                     create_thumbnails
                 )
 
             # Get the corresponding Photographer objects
             photographer_number = model_kwargs.get('photographer', None)
             if photographer_number is not None:
-                model_kwargs['photographer'] = \
-                    Photographer.objects.filter(number=photographer_number).first()
+                model_kwargs['photographer'] = photographers_by_number.get(photographer_number)
 
             if photographer_name != '' and 'photographer' not in model_kwargs:
-                model_kwargs['photographer'] = \
-                    Photographer.objects.filter(name=photographer_name).first()
+                model_kwargs['photographer'] = photographers_by_name.get(photographer_name)
 
         # Creates models for all of the MapSquares not listed in the spreadsheet between the
         # previous row and the current one
         if model_name == "MapSquare":
             while map_square_count != model_kwargs['number']:
-                create_map_square(map_square_count, mp_coords_dict, verbose)
+                create_map_square(map_square_count, mp_coords_dict, verbose,
+                                  existing_instances, pending_changes)
+                synced_keys.add(map_square_count)
                 map_square_count += 1
             map_square_count += 1
 
-        if verbose:
-            print(f'Creating {model_name} with kwargs: {model_kwargs}\n')
-
-        model_instance = MODEL_NAME_TO_MODEL[model_name](**model_kwargs)
-        model_instance.save()
+        sync_counts[upsert_model_instance(
+            model_name, model_kwargs, existing_instances, pending_changes, verbose
+        )] += 1
+        synced_keys.add(get_natural_key(model_name, model_kwargs))
 
         # When the last row in the spreadsheet is reached, creates MapSquare models for all
         # remaining, absent MapSquares (total: 1,755)
@@ -407,9 +809,24 @@ def populate_database(
             and model_kwargs['number'] == int(values_as_a_dict[-1]['number'])
         ):
             while map_square_count <= 1755:
-                create_map_square(map_square_count, mp_coords_dict, verbose)
+                create_map_square(map_square_count, mp_coords_dict, verbose,
+                                  existing_instances, pending_changes)
+                synced_keys.add(map_square_count)
                 map_square_count += 1
 
+    for natural_key, instance in previous_instances.items():
+        if natural_key in synced_keys:
+            continue
+        sync_counts['missing'] += 1
+        if verbose:
+            print(f'{model_name} {natural_key} is no longer in the spreadsheet\n')
+        if delete_missing:
+            pending_changes.delete(instance)
+            sync_counts['deleted'] += 1
+
+    pending_changes.save()
+    return sync_counts
+
 
 class Command(BaseCommand):
     """
@@ -424,6 +841,44 @@ class Command(BaseCommand):
         parser.add_argument('--verbose', action='store_true')
         parser.add_argument('--quick', action='store_true')
         parser.add_argument('--cli_auth', action='store_true')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Update the existing db in place instead of rebuilding it, keeping analysis '
+                 'results and anything else attached to rows that are still in the spreadsheet',
+        )
+        parser.add_argument(
+            '--delete_missing',
+            action='store_true',
+            help='With --incremental, delete rows that are no longer in the spreadsheet (and '
+                 'their analysis results) instead of only reporting them',
+        )
+        parser.add_argument(
+            '--refresh_drive_lookup',
+            action='store_true',
+            help='List the photos in Google Drive again, even if a recent listing is cached',
+        )
+        parser.add_argument(
+            '--lookup_workers',
+            type=int,
+            action='store',
+            default=4,
+            help='Number of Google Drive folder listing queries run at the same time',
+        )
+        parser.add_argument(
+            '--download_workers',
+            type=int,
+            action='store',
+            default=8,
+            help='Number of photos downloaded from Google Drive at the same time',
+        )
+        parser.add_argument(
+            '--download_retries',
+            type=int,
+            action='store',
+            default=5,
+            help='Number of times a download is retried after rate limiting or a server error',
+        )
 
     def handle(self, *args, **options):
         # pylint: disable=too-many-locals
@@ -433,6 +888,12 @@ class Command(BaseCommand):
         verbose = options.get('verbose')
         quick = options.get('quick')
         cli_auth = options.get('cli_auth')
+        download_workers = options.get('download_workers')
+        download_retries = options.get('download_retries')
+        incremental = options.get('incremental')
+        delete_missing = options.get('delete_missing')
+        refresh_drive_lookup = options.get('refresh_drive_lookup')
+        lookup_workers = options.get('lookup_workers')
 
         if create_thumbnails and not local_download:
             local_download = True
@@ -441,36 +902,43 @@ class Command(BaseCommand):
         if redownload and not local_download:
             local_download = True
 
-        # Delete database
-        if os.path.exists(settings.DB_PATH):
-            print_header('Deleting existing db...')
-            try:
-                os.remove(settings.DB_PATH)
-            except PermissionError:
-                # weird indentation because turns out dedent nests weirdly...
-                print_header('Permission Error')
-                print(dedent('''
-                    Unable to delete the database file while the backend is running.
-                    Please stop the "Run backend" process and try again.
-                '''))
-
-                return
-
-        # Delete all migrations
-        for file in os.listdir(settings.MIGRATIONS_DIR):
-            if file not in ['__init__.py', '__pycache__']:
-                file_path = os.path.join(settings.MIGRATIONS_DIR, file)
-                os.remove(file_path)
-        print('Done!')
-
-        # Rebuild database
-        print_header('Rebuilding db from migrations...')
-        call_command('makemigrations')
-        call_command('migrate')
-        print('Done!')
+        if incremental:
+            # Bring the schema up to date, keeping the data
+            print_header('Applying any new migrations...')
+            call_command('migrate')
+            print('Done!')
+        else:
+            # Delete database
+            if os.path.exists(settings.DB_PATH):
+                print_header('Deleting existing db...')
+                try:
+                    os.remove(settings.DB_PATH)
+                except PermissionError:
+                    # weird indentation because turns out dedent nests weirdly...
+                    print_header('Permission Error')
+                    print(dedent('''
+                        Unable to delete the database file while the backend is running.
+                        Please stop the "Run backend" process and try again.
+                    '''))
+
+                    return
+
+            # Delete all migrations
+            for file in os.listdir(settings.MIGRATIONS_DIR):
+                if file not in ['__init__.py', '__pycache__']:
+                    file_path = os.path.join(settings.MIGRATIONS_DIR, file)
+                    os.remove(file_path)
+            print('Done!')
+
+            # Rebuild database
+            print_header('Rebuilding db from migrations...')
+            call_command('makemigrations')
+            call_command('migrate')
+            print('Done!')
 
         # THIS IS JUST FOR PROTOTYPING NEVER EVER EVER EVER IN PRODUCTION do this
-        User.objects.create_superuser('admin', password='adminadmin')
+        if not User.objects.filter(username='admin').exists():
+            User.objects.create_superuser('admin', password='adminadmin')
 
         if quick:
             return
@@ -493,26 +961,58 @@ class Command(BaseCommand):
 
         # Call Drive API to create a lookup dictionary for photo urls
         print_header('Getting the URL for all photos (This might take a couple of minutes)...')
-        photo_url_lookup = create_lookup_dict(drive_service)
+        photo_url_lookup = get_lookup_dict(
+            drive_service,
+            service_factory=lambda: build('drive', 'v3', credentials=credentials),
+            max_workers=lookup_workers,
+            refresh=refresh_drive_lookup,
+        )
 
         if not databases:
             print_header('No data found.')
             return
 
-        for model_name, values in zip(spreadsheet_ranges, databases):
-            print_header(f'{model_name}: Importing these values from the spreadsheet')
-            # Sorts the rows in the spreadsheet by the map square number [MapSquare ONLY]
-            if model_name == 'MapSquare':
-                values = [values[0]] + sorted(values[1:], key=lambda x: int(x[0]))
-            header = values[0]
-            values_as_a_dict = [dict(zip(header, row)) for row in values[1:]]
-            populate_database(
-                model_name,
-                values_as_a_dict,
-                photo_url_lookup,
-                drive_service,
-                local_download,
-                redownload,
-                verbose,
-                create_thumbnails
+        photo_downloader = None
+        if local_download:
+            photo_downloader = PhotoDownloader(
+                lambda: build('drive', 'v3', credentials=credentials),
+                max_workers=download_workers,
+                max_retries=download_retries,
+                redownload=redownload,
+                verbose=verbose,
             )
+
+        try:
+            for model_name, values in zip(spreadsheet_ranges, databases):
+                print_header(f'{model_name}: Importing these values from the spreadsheet')
+                # Sorts the rows in the spreadsheet by the map square number [MapSquare ONLY]
+                if model_name == 'MapSquare':
+                    values = [values[0]] + sorted(values[1:], key=lambda x: int(x[0]))
+                header = values[0]
+                values_as_a_dict = [dict(zip(header, row)) for row in values[1:]]
+                sync_counts = populate_database(
+                    model_name,
+                    values_as_a_dict,
+                    photo_url_lookup,
+                    photo_downloader,
+                    verbose,
+                    create_thumbnails,
+                    delete_missing,
+                )
+                print(f"{model_name}: {sync_counts['created']} created, "
+                      f"{sync_counts['updated']} updated, "
+                      f"{sync_counts['unchanged']} unchanged")
+                if sync_counts['missing']:
+                    print(f"{model_name}: {sync_counts['missing']} no longer in the spreadsheet"
+                          + (' (deleted)' if sync_counts['deleted'] else
+                             ' (kept, use --delete_missing to delete them)'))
+
+            if photo_downloader:
+                print_header('Waiting for photo downloads to finish...')
+                num_failed = photo_downloader.wait()
+                if num_failed:
+                    print(f'{num_failed} downloads failed. Run syncdb --local again to retry them.')
+                print('Done!')
+        finally:
+            if photo_downloader:
+                photo_downloader.shutdown()
@@ -0,0 +1,52 @@
+"""
+Middleware for the paris_1970 app
+"""
+import logging
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .instrumentation import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStatsMiddleware:
+    """
+    Counts and times the SQL queries of each request, reporting them in X-Query-Count and
+    X-DB-Time (milliseconds) response headers. Requests that make more than
+    settings.QUERY_STATS_MAX_QUERIES queries, or spend more than settings.QUERY_STATS_MAX_DB_TIME
+    seconds in them, are logged with their slowest queries.
+
+    Only installed if settings.QUERY_STATS_ENABLED is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_STATS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_counter = QueryCounter(num_slowest=settings.QUERY_STATS_NUM_SLOWEST)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(query_counter))
+            response = self.get_response(request)
+
+        response['X-Query-Count'] = str(query_counter.count)
+        response['X-DB-Time'] = f'{query_counter.total_time * 1000:.1f}'
+
+        if query_counter.count > settings.QUERY_STATS_MAX_QUERIES \
+                or query_counter.total_time > settings.QUERY_STATS_MAX_DB_TIME:
+            slowest_queries = '\n'.join(
+                f'  {seconds * 1000:.1f} ms: {sql}'
+                for seconds, sql, _ in query_counter.slowest_queries()
+            )
+            logger.warning(
+                '%s %s made %d queries taking %.1f ms. Slowest queries:\n%s',
+                request.method, request.path, query_counter.count,
+                query_counter.total_time * 1000, slowest_queries,
+            )
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.14 on 2026-10-19 16:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_photographer_approx_loc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='derivatives',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
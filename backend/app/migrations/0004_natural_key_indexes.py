@@ -0,0 +1,36 @@
+# Generated by Django 3.2.14 on 2026-10-19 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_photo_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mapsquare',
+            name='number',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='photographer',
+            name='name',
+            field=models.CharField(db_index=True, max_length=252),
+        ),
+        migrations.AlterField(
+            model_name='photographer',
+            name='number',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['map_square', 'number'], name='app_photo_square_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photoanalysisresult',
+            index=models.Index(fields=['name', 'photo'], name='app_result_name_photo_idx'),
+        ),
+    ]
@@ -8,12 +8,24 @@ import json
 from urllib.error import HTTPError
 from http.client import RemoteDisconnected
 
-from skimage import io
-from PIL import Image
+import numpy as np
+from skimage import color, io
+from PIL import Image, UnidentifiedImageError
 
 from django.db import models
 from django.conf import settings
 
+from .image_cache import get_decoded_image_cache
+from .instrumentation import timed_stage
+
+
+def get_draft_size(max_size):
+    """
+    Convert a (width, height) max_size, where either dimension may be None,
+    into a size for Pillow's Image.draft
+    """
+    return tuple(dimension or 1 for dimension in max_size)
+
 
 class Photo(models.Model):
     """
@@ -41,11 +53,47 @@ class Photo(models.Model):
     librarian_caption = models.CharField(max_length=252)
     photographer_caption = models.CharField(max_length=252)
 
+    # JSON of the resized copies made by createthumbnails, e.g. {"500": ["jpg", "webp"]}
+    derivatives = models.TextField(null=True, blank=True)
+
+    # Size of the local photo in pixels, recorded by get_dimensions the first time it's needed
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+
     def has_valid_source(self):
         return (self.cleaned_src or
                 self.front_src)
 
-    def get_image_data(self, as_gray=False, use_pillow=False, src_dir=settings.LOCAL_PHOTOS_DIR):
+    def get_neighbors(self, previous=False, count=1):
+        """
+        Get the count photos that come before (if previous) or after this one, ordered by map
+        square number and then photo number, nearest first
+
+        Every query is an index seek rather than a sort: photos are read in order from
+        app_photo_square_number_idx one map square at a time, starting with this photo's, and
+        each map square after that is found by its (indexed) number.
+        """
+        lookup = 'lt' if previous else 'gt'
+        ordering = '-number' if previous else 'number'
+        photos = Photo.objects.select_related('map_square', 'photographer').order_by(ordering)
+
+        neighbors = list(photos.filter(
+            map_square_id=self.map_square_id, **{f'number__{lookup}': self.number}
+        )[:count])
+        map_square_number = self.map_square.number
+        while len(neighbors) < count:
+            # The nearest map square that has any photos
+            map_square = MapSquare.objects.filter(
+                models.Exists(Photo.objects.filter(map_square=models.OuterRef('pk'))),
+                **{f'number__{lookup}': map_square_number},
+            ).order_by(ordering).only('id', 'number').first()
+            if map_square is None:
+                break
+            neighbors += photos.filter(map_square_id=map_square.id)[:count - len(neighbors)]
+            map_square_number = map_square.number
+        return neighbors
+
+    def get_image_data(self, as_gray=False, use_pillow=False, src_dir=None, max_size=None):
         """
         Get the image data via skimage's imread, for use in analyses
 
@@ -55,27 +103,93 @@ class Photo(models.Model):
         Optionally use Pillow instead (for pytorch analyses)
         and return as_gray
 
+        Analyses that shrink the image straight away should pass max_size=(width, height),
+        the most resolution they need (either dimension can be None). JPEGs are then decoded by
+        libjpeg at 1/2, 1/4 or 1/8 scale, which is much faster than decoding the full scan.
+        The result is never smaller than max_size, so resizing it afterwards gives an image of
+        the same size as before (though not necessarily identical pixel for pixel).
+
+        If settings.DECODED_IMAGE_CACHE_DIR is set, decoded arrays are cached on disk
+        (see app/image_cache.py).
+
+        src_dir defaults to settings.LOCAL_PHOTOS_DIR, read when called so that it can be
+        overridden (e.g., by benchmarkanalyses).
+
         TODO: implement as_gray for use_pillow
         """
+        if src_dir is None:
+            src_dir = settings.LOCAL_PHOTOS_DIR
         source = os.path.join(
             src_dir,
             str(self.map_square.number),
             f"{self.number}_photo.jpg"
         )
 
+        def decode():
+            if max_size:
+                with Image.open(source) as pil_image:
+                    pil_image.draft(pil_image.mode, get_draft_size(max_size))
+                    if pil_image.mode not in ('L', 'RGB'):
+                        pil_image = pil_image.convert('RGB')
+                    image = np.asarray(pil_image)
+                # Match skimage's imread, which only converts color images
+                if as_gray and image.ndim > 2:
+                    image = color.rgb2gray(image)
+                return image
+            return io.imread(source, as_gray)
+
         try:
-            if use_pillow:
-                image = Image.open(source)
-            else:
-                image = io.imread(source, as_gray)
+            with timed_stage('decode'):
+                if use_pillow:
+                    image = Image.open(source)
+                    if max_size:
+                        image.draft(image.mode, get_draft_size(max_size))
+                else:
+                    decoded_image_cache = get_decoded_image_cache()
+                    if decoded_image_cache:
+                        image = decoded_image_cache.load(source, (as_gray, max_size), decode)
+                    else:
+                        image = decode()
         except (HTTPError, RemoteDisconnected) as base_exception:
             raise Exception(
                 f'Failed to download image data for {self} due to Google API rate limiting.'
             ) from base_exception
+        if not use_pillow and not max_size and self.width is None:
+            # Record the dimensions we have for free, for get_dimensions to save
+            self.height, self.width = image.shape[:2]
         return image
 
+    def get_dimensions(self, src_dir=None, save=True):
+        """
+        Get the (width, height) of the photo, or None if there is no readable local photo.
+
+        If they haven't been recorded yet, they're read from the JPEG header (without decoding
+        the image) and recorded, and saved unless save is False (e.g., to save many photos at
+        once with bulk_update).
+        """
+        if self.width is None or self.height is None:
+            if src_dir is None:
+                src_dir = settings.LOCAL_PHOTOS_DIR
+            source = os.path.join(
+                src_dir,
+                str(self.map_square.number),
+                f"{self.number}_photo.jpg"
+            )
+            try:
+                with Image.open(source) as pil_image:
+                    self.width, self.height = pil_image.size
+            except (FileNotFoundError, UnidentifiedImageError):
+                return None
+            if save:
+                self.save(update_fields=['width', 'height'])
+        return self.width, self.height
+
     class Meta:
         unique_together = ['number', 'map_square']
+        indexes = [
+            # For listing a map square's photos, and previous/next photo navigation, in order
+            models.Index(fields=['map_square', 'number'], name='app_photo_square_number_idx'),
+        ]
 
     def get_image_local_filepath(self, src_dir=settings.LOCAL_PHOTOS_DIR):
         """
@@ -100,6 +214,43 @@ class Photo(models.Model):
         if source:
             return source
 
+    def get_derivative_path(self, size, extension, src_dir=settings.LOCAL_PHOTOS_DIR):
+        """
+        Path of the copy of the photo resized to fit in a size x size box, in the format
+        for extension (see createthumbnails)
+        """
+        return os.path.join(
+            src_dir,
+            str(self.map_square.number),
+            f"{self.number}_photo_{size}.{extension}"
+        )
+
+    def get_derivative_urls(self):
+        """
+        Map each size that createthumbnails made a resized copy of the photo at to a dict of
+        its URL in each format
+        """
+        if not self.derivatives:
+            return {}
+        return {
+            size: {
+                extension: self.get_derivative_path(size, extension)
+                for extension in extensions
+            }
+            for size, extensions in json.loads(self.derivatives).items()
+        }
+
+
+class MapSquareQuerySet(models.QuerySet):
+    """
+    Queries on map squares (MapSquare.objects), with their photo counts available as an annotation
+    """
+    def with_num_photos(self):
+        """
+        Annotate each map square with num_photos, its number of photos, counted in the same query
+        """
+        return self.annotate(num_photos=models.Count('photo'))
+
 
 class MapSquare(models.Model):
     """
@@ -108,18 +259,20 @@ class MapSquare(models.Model):
     the boundary of this Map Square.
     """
     name = models.CharField(max_length=252)
-    number = models.IntegerField(null=True)
+    number = models.IntegerField(null=True, db_index=True)
     boundaries = models.CharField(max_length=252)
     coordinates = models.CharField(max_length=252)
 
+    objects = MapSquareQuerySet.as_manager()
+
 
 class Photographer(models.Model):
     """
     This model contains data about a single Photographer,
     which includes their name and the Map Square that this photographer was assigned to
     """
-    name = models.CharField(max_length=252)
-    number = models.IntegerField(null=True)
+    name = models.CharField(max_length=252, db_index=True)
+    number = models.IntegerField(null=True, db_index=True)
     approx_loc = models.CharField(max_length=252, null=True, blank=True)
     map_square = models.ForeignKey(MapSquare, on_delete=models.SET_NULL, null=True)
     type = models.CharField(max_length=252, null=True)
@@ -161,6 +314,12 @@ class PhotoAnalysisResult(AnalysisResult):
     def __str__(self):
         return f'PhotoAnalysisResult {self.name} for photo with id {self.photo.id}'
 
+    class Meta:
+        indexes = [
+            # Results are looked up by analysis, and by analysis and photo
+            models.Index(fields=['name', 'photo'], name='app_result_name_photo_idx'),
+        ]
+
 
 class PhotographerAnalysisResult(AnalysisResult):
     """
@@ -24,6 +24,7 @@ class PhotoSerializer(serializers.ModelSerializer):
     map_square_number = serializers.SerializerMethodField()
     analyses = serializers.SerializerMethodField()
     map_square_coords = serializers.SerializerMethodField()
+    derivatives = serializers.SerializerMethodField()
 
     @staticmethod
     def get_photographer_name(instance):
@@ -65,13 +66,18 @@ class PhotoSerializer(serializers.ModelSerializer):
         else:
             return {}
 
+    @staticmethod
+    def get_derivatives(instance):
+        """ URLs of the resized copies of the photo, by size and format """
+        return instance.get_derivative_urls()
+
     class Meta:
         model = Photo
         fields = [
             'id', 'number', 'cleaned_src', 'front_src', 'back_src',
             'thumbnail_src', 'alt', 'photographer_name', 'photographer_number',
             'map_square_number', 'shelfmark', 'librarian_caption', 'photographer_caption',
-            'contains_sticker', 'analyses', 'map_square_coords'
+            'contains_sticker', 'analyses', 'map_square_coords', 'derivatives'
         ]
 
 
@@ -99,8 +105,14 @@ class MapSquareSerializerWithoutPhotos(serializers.ModelSerializer):
 
     @staticmethod
     def get_num_photos(instance):
-        photo_obj = Photo.objects.filter(map_square__number=instance.number)
-        return len(photo_obj)
+        """
+        Use the num_photos annotation (see MapSquare.objects.with_num_photos) if the map square
+        has it, so that serializing many map squares doesn't take a query for each
+        """
+        num_photos = getattr(instance, 'num_photos', None)
+        if num_photos is None:
+            num_photos = instance.photo_set.count()
+        return num_photos
 
     class Meta:
         model = MapSquare
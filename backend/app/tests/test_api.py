@@ -0,0 +1,518 @@
+"""
+Tests for the main app.
+"""
+import json
+import os
+import tempfile
+
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from app.analysis import yolo_model, yolo_pop_density
+from app.analysis.aggregated_analyses import LabelCounts, frequent_objects, \
+    materialize_label_statistics, object_percentage, statistics_analysis
+from app.analysis.photo_similarity import resnet18_cosine_similarity
+from app.instrumentation import QueryCounter
+from app.management.commands.benchmarkapi import drop_natural_key_indexes
+from app.management.commands.createkmeans import assign_clusters
+from app.management.commands.runanalysis import ResultWriter
+from app.models import Photo, PhotoAnalysisResult, MapSquare, Photographer, Cluster, \
+    CorpusAnalysisResult
+
+
+class MainAPITests(TestCase):
+    """
+    Backend TestCase. API Calls
+    """
+
+    def setUp(self):
+        """
+        Create dummy database entries and corresponding files in TEST_PHOTOS_DIR
+        """
+        names = ["Bob Frenchman", "Waddle Dee", "Kaito KID"]
+
+        # create 2 clusters, 1 CorpusAnalysisResult object
+        Cluster.objects.create(model_n=2, label=0)
+        Cluster.objects.create(model_n=2, label=1)
+        CorpusAnalysisResult.objects.create(name="corpus_analysis_result", result=json.dumps(''))
+
+        # create 3 map squares
+        for i in range(3):
+            map_square = MapSquare.objects.create(number=i + 1, coordinates="24, 25")
+            photographer = Photographer.objects.create(map_square=map_square, number=i + 1,
+                                                       name=names[i])
+            path = os.path.join(settings.TEST_PHOTOS_DIR, f"{i + 1}")
+            os.mkdir(path, mode=0o755)
+            # in each map square, create 4 empty photos and some PhotoAnalysisResult
+            # objects for each photo, and add photo to either cluster 0 or 1 (photo_number mod 2)
+            for j in range(4):
+                photo = Photo.objects.create(number=j + 1, map_square=map_square,
+                                             photographer=photographer, front_src=True)
+
+                with open(os.path.join(path, f"{j + 1}_photo.jpg"), "w+") as f:
+                    pass
+                yolo_result = {"boxes": [{"label": "car", "x_coord": 710, "y_coord": 645,
+                                          "width": 135, "height": 82, "confidence": 90}],
+                               "labels": {"car": 1}}
+
+                PhotoAnalysisResult.objects.create(name="yolo_model", result=json.dumps(
+                    yolo_result), photo=photo)
+                PhotoAnalysisResult.objects.create(name="resnet18_cosine_similarity", result=
+                json.dumps([]),
+                                                   photo=photo)
+                PhotoAnalysisResult.objects.create(name="photo_similarity.resnet18_cosine_"
+                                                        "similarity", result=json.dumps([]),
+                                                   photo=photo)
+                Cluster.objects.get(label=j % 2).photos.add(photo)
+        assert MapSquare.objects.count() == 3
+        assert Photographer.objects.count() == 3
+        assert Photo.objects.count() == 12
+
+    def tearDown(self):
+        """
+        Remove TEST_PHOTOS_DIR files.
+        """
+        for i in range(3):
+            path = os.path.join(settings.TEST_PHOTOS_DIR, f"{i + 1}", "")
+            for j in range(len(os.listdir(path))):
+                os.remove(os.path.join(path, f"{j + 1}_photo.jpg"))
+            os.rmdir(path)
+
+    def initTest(self, name, args=[]):
+        """
+        Performs basic GET api call for given parameters and,
+        after checking for success, returns json() version of the response
+        :param name: str
+        :param args: list of arguments for the call
+        :return:
+        """
+        response = self.client.get(reverse(name, args=args))
+        assert response.status_code == 200
+        return response.json()
+
+    def add_photo(self, map_square, photo_name_or_path):
+        """
+        Creates a Photo object and adds it to self.photo_dict given
+        the name of the photo or path relative to settings.TEST_PHOTOS_DIR
+        """
+
+        if Photo.objects.exists():
+            photo_number = Photo.objects.last().number + 1
+        else:
+            photo_number = 0
+
+        # create new file in test directory
+        directory = os.path.join(settings.TEST_PHOTOS_DIR, f"{map_square.number}", "")
+        current_photos_in_square = len(os.listdir(directory))
+        path = os.path.join(directory, f"{current_photos_in_square + 1}_photo.jpg")
+        with open(path, "w+") as f:
+            pass
+
+        # create new Photo object in database as well as a few PhotoAnalysisResult objects
+        photo = Photo(number=photo_number, map_square=map_square, front_src=True)
+        photo.save()
+
+        PhotoAnalysisResult.objects.create(name="yolo_model", result=json.dumps({"boxes": [],
+                                                                                 "labels": {}}),
+                                           photo=photo)
+        PhotoAnalysisResult.objects.create(name="resnet18_cosine_similarity", result=
+        json.dumps([]), photo=photo)
+        PhotoAnalysisResult.objects.create(name="photo_similarity.resnet18_cosine_similarity",
+                                           result=json.dumps([]), photo=photo)
+        Cluster.objects.get(label=photo_number % 2).photos.add(photo)
+        return photo
+
+    # testing database retrieval
+
+    def test_photo_functions(self):
+        photo = self.add_photo(MapSquare.objects.get(number=1), "example")
+
+        self.assertEqual(photo.has_valid_source(), True)
+
+        for photo in Photo.objects.all():
+            self.assertEqual(photo.has_valid_source(), True)
+
+    def test_get_all_photos(self):
+        res = self.initTest("all_photos")
+        assert len(res) == 12
+        assert res[-1]["id"] == 12
+
+    def test_query_counter(self):
+        """
+        QueryCounter counts queries and keeps the slowest ones
+        """
+        query_counter = QueryCounter(num_slowest=2)
+        with connection.execute_wrapper(query_counter):
+            self.initTest("all_analyses")
+            Photo.objects.count()
+        assert query_counter.count == 2
+        assert len(query_counter.slowest_queries()) == 2
+        assert query_counter.total_time >= sum(
+            seconds for seconds, _, _ in query_counter.slowest_queries()
+        )
+
+    def test_query_stats_middleware(self):
+        """
+        QueryStatsMiddleware adds the query count and database time to responses
+        """
+        response = self.client.get(reverse("all_analyses"))
+        assert 'X-Query-Count' not in response
+
+        with self.settings(QUERY_STATS_ENABLED=True, QUERY_STATS_MAX_QUERIES=0):
+            with self.assertLogs('app.middleware', level='WARNING') as logs:
+                response = Client().get(reverse("all_analyses"))
+        assert response['X-Query-Count'] == '1'
+        assert float(response['X-DB-Time']) >= 0
+        assert 'GET /api/all_analyses/ made 1 queries' in logs.output[0]
+        assert 'SELECT DISTINCT' in logs.output[0]
+
+    def test_get_map_squares(self):
+        # get all
+        with self.assertNumQueries(1):
+            res = self.initTest("all_map_squares")
+        assert len(res) == 3
+        assert res[-1]["num_photos"] == 4
+
+        # get one
+        res2 = self.initTest("map_square", args=[3])
+        assert {key: res[-1][key] for key in res[-1].keys() if key != "num_photos"} \
+               == {key: res2[key] for key in res2.keys() if key != "photos"}
+        assert len(res2["photos"]) == 4
+
+    def test_map_square_admin(self):
+        """
+        The map square admin list counts photos without a query per map square
+        """
+        self.client.force_login(
+            User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        )
+        response = self.client.get('/admin/app/mapsquare/?o=4')
+        assert response.status_code == 200
+        assert [map_square.num_photos for map_square in response.context['cl'].result_list] \
+               == [4, 4, 4]
+
+    def test_get_one_photo(self):
+        res = self.initTest("photo", args=[2, 2])
+        assert res["number"] == 2 and res["map_square_number"] == 2
+
+    def test_create_thumbnails(self):
+        """
+        createthumbnails writes resized copies of the photos, and the photo API returns their URLs
+        """
+        with tempfile.TemporaryDirectory() as src_dir:
+            os.mkdir(os.path.join(src_dir, '2'))
+            source = Image.new('RGB', (120, 80), (200, 30, 30))
+            source.save(os.path.join(src_dir, '2', '3_photo.jpg'))
+            call_command('createthumbnails', sizes=[50, 200], formats=['jpg', 'webp'], workers=1,
+                         src_dir=src_dir)
+
+            # Shrunk to fit, keeping the aspect ratio, but never enlarged
+            for name, size, pil_format in [('3_photo_50.jpg', (50, 33), 'JPEG'),
+                                           ('3_photo_50.webp', (50, 33), 'WEBP'),
+                                           ('3_photo_200.jpg', (120, 80), 'JPEG'),
+                                           ('3_photo_200.webp', (120, 80), 'WEBP')]:
+                with Image.open(os.path.join(src_dir, '2', name)) as derivative:
+                    assert (derivative.size, derivative.format) == (size, pil_format)
+            assert sorted(os.listdir(os.path.join(src_dir, '2'))) == [
+                '3_photo.jpg', '3_photo_200.jpg', '3_photo_200.webp', '3_photo_50.jpg',
+                '3_photo_50.webp',
+            ]
+
+        res = self.initTest("photo", args=[2, 3])
+        photos_dir = settings.LOCAL_PHOTOS_DIR
+        assert res["derivatives"] == {
+            str(size): {extension: f'{photos_dir}/2/3_photo_{size}.{extension}'
+                        for extension in ['jpg', 'webp']}
+            for size in [50, 200]
+        }
+        # Photos without a local source don't get any
+        assert self.initTest("photo", args=[2, 2])["derivatives"] == {}
+
+    def test_get_all_tags(self):
+        names = ["Bob Frenchman", "Waddle Dee", "Kaito KID"]
+        res = self.initTest("get_tags")
+        assert "person" and "bicycle" and "stop sign" in res["tags"]
+        assert (name in res["photographers"] for name in names)
+
+    def test_get_photographers(self):
+        names = ["Bob Frenchman", "Waddle Dee", "Kaito KID"]
+        # get all
+        resall = self.initTest("all_photographers")
+        photographer_names = [entry["name"] for entry in resall]
+        assert (name in photographer_names for name in names)
+
+        # get one, try 1 2 3
+        for i in (1, 2, 3):
+            resone = self.initTest("photographer", args=[i])
+            assert len(resone["photos"]) == 4
+
+    def test_prev_next_photos(self):
+        # need to decrease number of tries, currently too many
+        photo = self.add_photo(MapSquare.objects.get(number=1), "example")
+        self.assertEqual(photo.has_valid_source(), True)
+
+        for i in range(3):
+            for j in range(4):
+                res = self.initTest("previous_next_photos", args=[i + 1, j + 1])
+                assert len(res) == 2
+                if (i, j) == (0, 0):
+                    assert res[0] == ""
+
+    def test_prev_next_photos_order(self):
+        """
+        Previous and next photos follow map square and photo numbers rather than ids
+        """
+        # Ids no longer follow the order of the photos, and there are gaps in them
+        Photo.objects.get(number=1, map_square__number=2).delete()
+        Photo.objects.create(number=0, map_square=MapSquare.objects.get(number=2),
+                             front_src=True)
+
+        res = self.initTest("previous_next_photos", args=[1, 4])
+        assert [(photo["map_square_number"], photo["number"]) for photo in res] \
+               == [(1, 3), (2, 0)]
+
+        res = self.client.get(
+            reverse("previous_next_photos", args=[2, 3]), {"prefetch": 4}
+        ).json()
+        assert [(photo["map_square_number"], photo["number"]) for photo in res] \
+               == [(2, 2), (2, 4), (3, 1), (3, 2), (3, 3)]
+
+        res = self.initTest("previous_next_photos", args=[3, 4])
+        assert res[0]["number"] == 3 and res[1] == ""
+
+    def test_neighbors_query_plans(self):
+        """
+        Photo.get_neighbors finds photos across map squares with index seeks only
+        """
+        photo = Photo.objects.get(number=4, map_square__number=1)
+        with CaptureQueriesContext(connection) as queries:
+            neighbors = list(photo.get_neighbors(count=6))
+        assert [(neighbor.map_square.number, neighbor.number) for neighbor in neighbors] \
+               == [(2, 1), (2, 2), (2, 3), (2, 4), (3, 1), (3, 2)]
+        photo = Photo.objects.get(number=2, map_square__number=3)
+        with CaptureQueriesContext(connection) as previous_queries:
+            neighbors = list(photo.get_neighbors(previous=True, count=3))
+        assert [(neighbor.map_square.number, neighbor.number) for neighbor in neighbors] \
+               == [(3, 1), (2, 4), (2, 3)]
+
+        # Each query seeks on an index, so the time it takes doesn't grow with the number of
+        # photos: SQLite neither scans app_photo nor sorts its rows (USE TEMP B-TREE FOR ORDER BY)
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries + previous_queries.captured_queries:
+                cursor.execute(f'EXPLAIN QUERY PLAN {query["sql"]}')
+                plan = [row[-1] for row in cursor.fetchall()]
+                assert not any('SCAN' in line or 'TEMP B-TREE' in line for line in plan), plan
+
+    def test_drop_natural_key_indexes(self):
+        """
+        benchmarkapi can drop the natural key indexes and leave the rest of the schema
+        """
+        dropped_indexes = drop_natural_key_indexes()
+        assert 'app_photo_square_number_idx' in dropped_indexes
+        assert 'app_result_name_photo_idx' in dropped_indexes
+        assert len(dropped_indexes) == 5
+        assert not drop_natural_key_indexes()
+
+        # The rest of the schema is untouched, so photos can still be added
+        self.add_photo(MapSquare.objects.get(number=1), "example")
+        Photo.objects.filter(number=1).update(width=800, height=600)
+
+    def test_get_arrondissement(self):
+        # change num_arrondisements to be the number of arrond in the database as necessary
+        num_arrondissements = 2
+
+        # get all
+        res = self.initTest("get_arrondissement")
+        assert len(res) == num_arrondissements
+
+        # get each
+        for i in range(num_arrondissements):
+            res = self.initTest("get_one_arrondissement", args=[i + 1])
+            assert len(res) == 2
+
+    def test_cluster(self):
+        # test that both clusters return photos that were initially added to to them
+        res = self.initTest("clustering", args=[2, 0])
+        assert len(res) == 6
+        assert (photo['number'] % 2 == 0 for photo in res)
+
+        res = self.initTest("clustering", args=[2, 1])
+        assert len(res) == 6
+        assert (photo['number'] % 2 == 0 for photo in res)
+
+    def test_result_writer(self):
+        """
+        ResultWriter writes results in bulk, and one at a time if a batch fails
+        """
+        photos = list(Photo.objects.order_by('id'))
+        result_writer = ResultWriter(PhotoAnalysisResult, "test_analysis", batch_size=3)
+        for photo in photos[:4]:
+            result_writer.add(photo, {"number": photo.number})
+            if photo == photos[2]:
+                # The batch is written once it's full
+                assert PhotoAnalysisResult.objects.filter(name="test_analysis").count() == 3
+        result_writer.flush()
+        assert result_writer.num_written == 4
+
+        # In incremental mode, existing results are updated in place
+        result_ids = set(
+            PhotoAnalysisResult.objects.filter(name="test_analysis").values_list('id', flat=True)
+        )
+        result_writer = ResultWriter(PhotoAnalysisResult, "test_analysis", batch_size=10,
+                                     incremental=True)
+        result_writer.add(photos[0], {"number": 100})
+        result_writer.add(photos[4], {"number": 200})
+        result_writer.flush()
+        assert PhotoAnalysisResult.objects.filter(name="test_analysis").count() == 5
+        assert result_ids < set(
+            PhotoAnalysisResult.objects.filter(name="test_analysis").values_list('id', flat=True)
+        )
+        assert PhotoAnalysisResult.objects.get(
+            name="test_analysis", photo=photos[0]).parsed_result() == {"number": 100}
+
+        # If the batch fails, the rest of it is written one result at a time
+        result_writer = ResultWriter(PhotoAnalysisResult, "other_analysis", batch_size=10)
+        result_writer.add(photos[0], 1)
+        result_writer.add(Photo(number=99), 2)  # unsaved, so it can't be written
+        result_writer.add(photos[1], 3)
+        result_writer.flush()
+        assert result_writer.num_written == 2
+        assert sorted(PhotoAnalysisResult.objects.filter(name="other_analysis").values_list(
+            'photo__number', 'result')) == [(1, '1'), (2, '3')]
+
+    def test_assign_clusters(self):
+        """
+        assign_clusters adds each photo to the cluster of its label, in bulk
+        """
+        # re-clustering the same model replaces the photos in each cluster
+        photo_ids = [f'{photo.number}_{photo.map_square.number}' for photo in Photo.objects.all()]
+        labels = [0] * 3 + [1] * 9
+        assert assign_clusters(2, photo_ids + ['99_99'], labels + [0]) == 12
+
+        res = self.initTest("clustering", args=[2, 0])
+        assert len(res) == 3
+        res = self.initTest("clustering", args=[2, 1])
+        assert len(res) == 9
+        assert Cluster.objects.filter(model_n=2).count() == 2
+
+    def test_search(self):
+        def one_search(keyword, isAdvanced=False, data={}):
+            if data == {}:
+                data = {
+                    "keyword": keyword,
+                    "isAdvanced": isAdvanced
+                }
+            response = self.client.post(reverse("search"), json.dumps(data),
+                                        content_type="application/json")
+            assert response.status_code == 200
+            return response.json()
+
+        res = one_search(keyword="Bob Frenchman")
+        assert len(res) == 4
+
+        res = one_search(keyword="Waddle Bob")
+        assert len(res) == 0
+
+        res = one_search(keyword="car")
+        assert len(res) == 12
+
+        data = {"photographerName": "Bob Frenchman", 'photographerId': '1', 'caption': '',
+                'tags': ['car'], 'analysisTags': ['yolo_model'], 'sliderSearchValues':
+                    {'Object Detection Confidence': (0, 100)}, 'isAdvanced': True}
+        res = one_search(None, True, data)
+        assert len(res) == 4
+
+    # testing similarity/analysis functions
+
+    def test_all_analyses(self):
+        res = self.initTest("all_analyses")
+        assert all(analysis in res for analysis in ["yolo_model", "resnet18_cosine_similarity",
+                                                    "photo_similarity.resnet18_cosine_similarity"])
+
+    def test_get_photos_by_analysis(self):
+        # just analysis
+        res = self.initTest("get_photos_by_analysis", args=["yolo_model"])
+        assert len(res) == 12
+
+        # analysis and object
+        # TODO: FIGURE OUT IF THIS IS INTENTIONAL OR NOT: when specifiying object in this api
+        #  call, for the yolo model at least, it doesn't take actual objects bc that's one more
+        #  layer into the dictionary, instead takes keys 'boxes' or 'labels'
+        res = self.initTest("get_photos_by_analysis", args=["yolo_model", "boxes"])
+        assert len(res) == 12
+
+    def test_get_corpus_analysis(self):
+        res = self.initTest("get_corpus")
+        assert len(res) == 1
+
+    def test_aggregated_analyses(self):
+        """
+        LabelCounts statistics match the per photo yolo results, and are stored by
+        materialize_label_statistics
+        """
+        photo = Photo.objects.first()
+        PhotoAnalysisResult.objects.filter(photo=photo, name="yolo_model").update(
+            result=json.dumps({"labels": {"car": 2, "person": 3}}))
+
+        with self.assertNumQueries(1):
+            label_counts = LabelCounts.from_database("yolo_model")
+        assert label_counts.frequent_objects(2) == ["car", "person"]
+        assert label_counts.objects_in_common() == ["car"]
+        assert label_counts.object_percentage(["person", "car"], any_objects=False) == 8.33
+        assert statistics_analysis("yolo_model", object_percentage("person")) == 8.33
+        assert statistics_analysis("yolo_model", frequent_objects(1)) == ["car"]
+
+        summary = materialize_label_statistics("yolo_model")
+        assert summary["totals"] == {"person": 3, "car": 13}
+        assert summary["co_occurrence"]["car"] == {"person": 1, "car": 12}
+        res = self.initTest("get_corpus")
+        assert {"name": "aggregated_yolo_model", "result": summary} in res
+
+    def test_yolo_pop_density_batch(self):
+        """
+        The batch yolo_pop_density matches analyze, using the stored photo dimensions
+        """
+        boxes = [{"label": "person", "x_coord": x, "y_coord": y, "width": w, "height": h}
+                 for x, y, w, h in [(0, 0, 50, 80), (30, 10, 40, 90), (400, 300, 20, 60)]]
+        expected_density = sum(
+            sum(yolo_pop_density.overlap_2d(yolo_pop_density.box_to_rect(box_i),
+                                            yolo_pop_density.box_to_rect(box_j))
+                for j, box_j in enumerate(boxes) if i != j) / 2
+            for i, box_i in enumerate(boxes)
+        )
+        density = yolo_pop_density.object_density("person", {"boxes": boxes})
+        self.assertAlmostEqual(density, expected_density)
+
+        photos = list(Photo.objects.select_related('map_square'))
+        PhotoAnalysisResult.objects.filter(photo=photos[0], name="yolo_model").update(
+            result=json.dumps({"boxes": boxes[:1]}))
+        with tempfile.TemporaryDirectory() as photos_dir:
+            os.mkdir(os.path.join(photos_dir, "1"))
+            Image.new("RGB", (640, 480)).save(os.path.join(photos_dir, "1", "1_photo.jpg"))
+            with self.settings(LOCAL_PHOTOS_DIR=photos_dir), self.assertNumQueries(2):
+                results = dict(yolo_pop_density.analyze_batch(photos))
+
+        assert Photo.objects.get(pk=photos[0].pk).get_dimensions() == (640, 480)
+        assert results[photos[0]] == yolo_pop_density.object_density(
+            "person", {"boxes": boxes[:1]}, (640, 480))
+        # The other photos have no readable image, so they get the default dimensions
+        assert results[photos[1]] == yolo_pop_density.analyze(photos[1])
+
+    def test_similarity(self):
+        # all photos by map square, retrieved by resnet18_cosine_similarity
+        res = self.initTest("all_photos_in_order")
+        assert len(res) == 12
+
+    def test_similar_photos(self):
+        # supposed to pull top 10 similar photos from list saved in "photo_similarity
+        # .resnet18_cosine_similarity" PhotoAnalysisObject for given photo. Here, returns an
+        # empty list since aforementioned object is empty
+        res = self.initTest("similar_photos", args=[1, 1, 10])
+        assert res == []
@@ -0,0 +1,116 @@
+"""
+Tests for the createkmeans command
+"""
+import argparse
+import os
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+from sklearn.datasets import make_blobs
+from sklearn.decomposition import PCA
+from sklearn.metrics import adjusted_rand_score
+
+from django.test import SimpleTestCase
+
+from app.management.commands.createkmeans import best_cluster_count, fit_minibatch_kmeans, \
+    parse_cluster_counts, reduce_dimensions, sampled_silhouette_score, sweep_kmeans, \
+    write_features
+
+
+class CreateKmeansTests(SimpleTestCase):
+    """
+    Tests for the feature pipeline and clustering of createkmeans, on synthetic blobs
+    """
+
+    @staticmethod
+    def make_blob_features(num_features=4):
+        """ 90 float32 rows of features, in 3 well separated blobs """
+        features, blob_labels = make_blobs(n_samples=90, n_features=num_features, centers=3,
+                                           cluster_std=0.5, random_state=0)
+        return features.astype(np.float32), blob_labels
+
+    def test_write_features(self):
+        """
+        write_features streams the features into a memmap, skipping photos that fail
+        """
+        photos = [SimpleNamespace(number=i, map_square=SimpleNamespace(number=1))
+                  for i in range(4)]
+
+        def featurize(photo):
+            if photo.number == 2:
+                raise ValueError('Unreadable photo')
+            return np.full(3, photo.number)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            features_path = os.path.join(temp_dir, 'features.npy')
+            photo_ids = write_features(photos, 3, featurize, features_path)
+            features = np.load(features_path)
+
+        # Failed photos are skipped, leaving unused rows at the end
+        assert photo_ids == ['0_1', '1_1', '3_1']
+        assert features.dtype == np.float32
+        assert features.shape == (4, 3)
+        assert features[:3].tolist() == [[0] * 3, [1] * 3, [3] * 3]
+
+    def test_fit_minibatch_kmeans(self):
+        """
+        fit_minibatch_kmeans finds the blobs, fitting the features a chunk at a time
+        """
+        features, blob_labels = self.make_blob_features()
+        # Chunks of 20 rows, with a short last chunk
+        kmeans, labels, inertia = fit_minibatch_kmeans(
+            features, 3, random_state=0, chunk_size=20, passes=3
+        )
+        assert adjusted_rand_score(blob_labels, labels) == 1
+        squared_distances = ((features - kmeans.cluster_centers_[labels]) ** 2).sum()
+        self.assertAlmostEqual(inertia, squared_distances, places=2)
+
+    def test_reduce_dimensions(self):
+        """
+        reduce_dimensions matches a PCA fit on all of the rows, and handles short inputs
+        """
+        features, _ = self.make_blob_features(num_features=10)
+        full_pca = PCA(n_components=2).fit(features)
+
+        # 90 rows in chunks of 40 leaves a last chunk of 10, too few for 20 components
+        reduced = reduce_dimensions(features, 20, chunk_size=40)
+        assert reduced.shape == (90, 10)
+        reduced = reduce_dimensions(features, 2, chunk_size=40)
+        assert reduced.shape == (90, 2)
+        # The leading components match a PCA fit on all of the rows (up to sign)
+        assert np.allclose(np.abs(reduced), np.abs(full_pca.transform(features)), atol=1e-3)
+
+        # Fewer rows than components
+        assert reduce_dimensions(features[:5], 8, chunk_size=40).shape == (5, 5)
+        assert reduce_dimensions(features[:45], 8, chunk_size=40).shape == (45, 8)
+
+    def test_parse_cluster_counts(self):
+        """
+        parse_cluster_counts takes a number or a range of at least 2 clusters
+        """
+        assert parse_cluster_counts('8') == [8]
+        assert parse_cluster_counts('2-5') == [2, 3, 4, 5]
+        for value in ['eight', '1', '5-3', '1-4']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_cluster_counts(value)
+
+    def test_sweep_kmeans(self):
+        """
+        sweep_kmeans fits each number of clusters, and the best silhouette score picks the blobs
+        """
+        features, blob_labels = self.make_blob_features()
+        assert sampled_silhouette_score(features, blob_labels, 50, random_state=0) > 0.5
+        assert np.isnan(sampled_silhouette_score(features, np.zeros(90, dtype=int), 50, 0))
+
+        sweep_results = sweep_kmeans(features, [2, 3, 4], random_state=0, chunk_size=20,
+                                     passes=3, silhouette_sample_size=50, n_jobs=2)
+        assert sorted(sweep_results) == [2, 3, 4]
+        for number_of_clusters, (labels, inertia, silhouette) in sweep_results.items():
+            assert len(labels) == 90
+            assert len(set(labels)) == number_of_clusters
+            assert inertia > 0
+            assert -1 <= silhouette <= 1
+        # Inertia only goes down with more clusters
+        assert sweep_results[2][1] > sweep_results[3][1] > sweep_results[4][1]
+        assert best_cluster_count(sweep_results) == 3
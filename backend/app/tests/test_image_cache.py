@@ -0,0 +1,137 @@
+"""
+Tests for the derived and decoded image caches, and reduced resolution decoding
+"""
+import os
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from django.test import SimpleTestCase
+
+from app.image_cache import DecodedImageCache, DerivedImageCache
+from app.models import Photo, MapSquare
+
+
+class ImageCacheTests(SimpleTestCase):
+    """
+    Tests for the in-memory and on-disk caches of photo image data
+    """
+
+    @staticmethod
+    def make_photo(number, image):
+        """ Enough of a Photo for DerivedImages, with get_image_data returning image """
+        return SimpleNamespace(number=number, map_square=SimpleNamespace(number=1),
+                               get_image_data=lambda: image)
+
+    def test_derived_image_cache_eviction(self):
+        """
+        DerivedImageCache evicts the least recently used photos once it is over max_bytes
+        """
+        # pylint: disable=protected-access
+        image = np.zeros((10, 10, 3), dtype=np.uint8)
+        cache = DerivedImageCache(max_bytes=2 * image.nbytes)
+        photos = [self.make_photo(number, image) for number in range(3)]
+
+        cache.get(photos[0]).image()
+        cache.get(photos[1]).image()
+        # Entries are per instance, so a new instance of the same photo reads its image again
+        other_instance = self.make_photo(0, image)
+        assert cache.get(other_instance) is not cache.get(photos[0])
+        assert cache.get(photos[0]).image() is image
+
+        # Over the limit, so the least recently used photo with an image (1) is evicted
+        cache.get(photos[2]).image()
+        assert list(cache._entries) == [id(other_instance), id(photos[0]), id(photos[2])]
+
+        # A single photo is kept even if it's over the limit by itself
+        cache.get(photos[2]).grayscale()
+        cache.get(photos[2]).normalized_grayscale()
+        assert len(cache._entries) == 1
+
+    def test_pyramid_levels(self):
+        """
+        Pyramid levels are memoized, counted in nbytes and evicted with the photo's other arrays
+        """
+        # pylint: disable=protected-access
+        image = np.arange(16 * 16 * 3, dtype=np.uint8).reshape(16, 16, 3)
+        cache = DerivedImageCache(max_bytes=2 * image.nbytes)
+        photos = [self.make_photo(number, image) for number in range(2)]
+        derived_images = cache.get(photos[0])
+
+        assert derived_images.pyramid_level(0) is derived_images.grayscale()
+        assert derived_images.pyramid_level(2).shape == (4, 4)
+        assert derived_images.pyramid_level(1).shape == (8, 8)
+        assert derived_images.pyramid_level(2) is derived_images.pyramid_level(2)
+        assert np.array_equal(derived_images.pyramid_level(1),
+                              cv2.pyrDown(derived_images.grayscale()))
+        assert derived_images.nbytes == image.nbytes + 16 * 16 + 8 * 8 + 4 * 4
+
+        # The photo's image, grayscale and pyramid levels together put the cache over its limit
+        cache.get(photos[1]).image()
+        assert list(cache._entries) == [id(photos[1])]
+
+    def test_reduced_resolution_decoding(self):
+        """
+        get_image_data decodes JPEGs at the smallest scale that covers max_size
+        """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            os.mkdir(os.path.join(photos_dir, "1"))
+            Image.new("RGB", (800, 600), (200, 100, 50)).save(
+                os.path.join(photos_dir, "1", "1_photo.jpg"))
+            photo = Photo(number=1, map_square=MapSquare(number=1))
+
+            assert photo.get_image_data(src_dir=photos_dir).shape == (600, 800, 3)
+            # JPEGs are decoded at the smallest scale that still covers max_size
+            assert photo.get_image_data(src_dir=photos_dir, max_size=(200, None)).shape == \
+                (150, 200, 3)
+            assert photo.get_image_data(src_dir=photos_dir, max_size=(300, 100)).shape == \
+                (300, 400, 3)
+            assert photo.get_image_data(src_dir=photos_dir, as_gray=True,
+                                        max_size=(None, 75)).shape == (75, 100)
+            with photo.get_image_data(src_dir=photos_dir, use_pillow=True,
+                                      max_size=(224, 224)) as pil_image:
+                assert pil_image.size == (400, 300)
+
+    def test_decoded_image_cache(self):
+        """
+        DecodedImageCache misses, hits, overwrites corrupt entries and evicts by modification time
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "1_photo.jpg")
+            Path(source).write_bytes(b"not really a JPEG")
+            array = np.arange(1000, dtype=np.uint8)
+            entry_size = array.nbytes + 128  # .npy header
+            cache = DecodedImageCache(os.path.join(temp_dir, "cache"), 2 * entry_size + 100)
+            decoded = []
+
+            def load(variant):
+                def decode():
+                    decoded.append(variant)
+                    return array
+                return cache.load(source, variant, decode)
+
+            # Miss, then hit
+            assert np.array_equal(load("a"), array)
+            assert np.array_equal(load("a"), array)
+            assert decoded == ["a"]
+
+            # A corrupt entry is decoded again and overwritten
+            Path(cache.entry_path(source, "a")).write_bytes(b"corrupt")
+            assert np.array_equal(load("a"), array)
+            assert np.array_equal(load("a"), array)
+            assert decoded == ["a", "a"]
+
+            # Over max_bytes, the least recently used entry is evicted
+            load("b")
+            os.utime(cache.entry_path(source, "a"), (1000, 1000))
+            os.utime(cache.entry_path(source, "b"), (2000, 2000))
+            load("a")  # a hit, so a is now the most recently used
+            load("c")
+            assert os.path.exists(cache.entry_path(source, "a"))
+            assert not os.path.exists(cache.entry_path(source, "b"))
+            assert os.path.exists(cache.entry_path(source, "c"))
+            assert decoded == ["a", "a", "b", "c"]
@@ -0,0 +1,78 @@
+"""
+Tests for the batch image scripts in backend/scripts
+"""
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from django.test import SimpleTestCase
+
+from scripts.cropborder import find_content_box
+from scripts.imageconversion import convert_file, fit_within, parse_commands
+
+
+class ImageScriptTests(SimpleTestCase):
+    """
+    Tests for the Pillow versions of the batch image scripts in backend/scripts
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_parse_commands(self):
+        """
+        parse_commands translates the options Pillow can apply, and rejects the rest
+        """
+        assert parse_commands([]) == {}
+        assert parse_commands(['-quality', '20%', '-thumbnail', '300x90']) == {
+            'quality': 20, 'size': (300, 90)
+        }
+        assert parse_commands(['-resize', 'x90']) == {'size': (None, 90)}
+        # Anything else needs ImageMagick
+        for commands in [['-rotate', '90'], ['-quality'], ['-resize', 'x'], ['-quality', 'high']]:
+            assert parse_commands(commands) is None
+
+    def test_fit_within(self):
+        """
+        fit_within keeps the aspect ratio, like ImageMagick's -resize
+        """
+        image = Image.new('RGB', (400, 300))
+        assert fit_within(image, (200, None)).size == (200, 150)
+        assert fit_within(image, (None, 30)).size == (40, 30)
+        assert fit_within(image, (100, 100)).size == (100, 75)
+        assert fit_within(image, (800, 800)).size == (800, 600)
+        assert fit_within(image, (400, 1000)) is image
+
+    def test_find_content_box(self):
+        """
+        find_content_box finds the non white pixels, within the fuzz, in 8 and 16 bit images
+        """
+        pixels = np.full((40, 50), 255, dtype=np.uint8)
+        pixels[5:15, 10:20] = 0
+        pixels[30, 40] = 250  # close enough to white
+        assert find_content_box(Image.fromarray(pixels), 20) == (10, 5, 20, 15)
+        assert find_content_box(Image.fromarray(pixels), 1) == (10, 5, 41, 31)
+        assert find_content_box(Image.new('RGB', (50, 40), 'white'), 20) is None
+
+        # 16 bit scans aren't all clipped to white
+        assert find_content_box(Image.fromarray(pixels.astype(np.uint16) * 257), 20) == \
+            (10, 5, 20, 15)
+
+    def test_convert_16_bit(self):
+        """
+        16 bit scans are scaled down to 8 bit rather than clipped
+        """
+        pixels = np.arange(0, 2 ** 16, 2 ** 8, dtype=np.uint16).reshape(16, 16)
+        in_file = os.path.join(self.temp_dir.name, 'scan.tif')
+        Image.fromarray(pixels).save(in_file)
+        with Image.open(in_file) as image:
+            assert image.mode.startswith('I;16')
+
+        out_file = os.path.join(self.temp_dir.name, 'scan.png')
+        convert_file(in_file, out_file, parse_commands([]), [])
+        with Image.open(out_file) as image:
+            assert image.mode == 'L'
+            assert np.array_equal(np.asarray(image), pixels >> 8)
@@ -0,0 +1,115 @@
+"""
+Tests for running analyses with runanalysis and benchmarking them with benchmarkanalyses
+"""
+import os
+import pickle
+import tempfile
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from app.instrumentation import RunStats
+from app.management.commands.benchmarkanalyses import compare_to_baseline, draw_synthetic_photo
+from app.management.commands.runanalysis import ResultJournal, compute_results
+
+
+class RunAnalysisTests(SimpleTestCase):
+    """
+    Tests for how runanalysis runs analyses and times them
+    """
+
+    def test_compute_results_stats(self):
+        """
+        compute_results falls back on analyze for batches that fail, and records every stage and
+        failure in RunStats
+        """
+        photos = [
+            SimpleNamespace(id=i, number=i, map_square=SimpleNamespace(number=1)) for i in range(6)
+        ]
+
+        def analyze(photo):
+            if photo.number == 4:
+                raise ValueError('Unreadable photo')
+            return photo.number * 10
+
+        def analyze_batch(batch):
+            for photo in batch:
+                if photo.number == 1:
+                    raise ValueError('Batch failed')
+                yield photo, analyze(photo)
+
+        stats = RunStats('test_analysis', num_total=len(photos))
+        results = list(compute_results(photos, analyze, analyze_batch, 3, 'test_analysis', stats))
+        for _ in results:
+            stats.item_done()
+
+        assert [(photo.number, result) for photo, result in results] == [
+            (0, 0), (1, 10), (2, 20), (3, 30), (5, 50),
+        ]
+        summary = stats.summary()
+        assert summary['photos'] == 5
+        assert summary['failed'] == 1
+        # Each batch yields one result before failing, then the rest are run one at a time
+        assert summary['stages']['analyze']['count'] == 6
+        assert summary['stages']['analyze']['p50'] <= summary['stages']['analyze']['max']
+        assert '6/6 photos (1 failed)' in stats.progress_line()
+
+    def test_result_journal(self):
+        """
+        ResultJournal replays appended results, skips a truncated last line and reads legacy
+        pickles
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal_path = os.path.join(temp_dir, 'analysis.jsonl')
+            legacy_pickle_path = os.path.join(temp_dir, 'analysis.pickle')
+            journal = ResultJournal(journal_path, fsync_every=2)
+            assert journal.load(legacy_pickle_path) == {}
+
+            # With no journal yet, the pickled results of older runs are imported
+            with open(legacy_pickle_path, 'wb') as legacy_pickle:
+                pickle.dump({'photo_1_1': {'count': 1}}, legacy_pickle)
+            stored_results = journal.load(legacy_pickle_path)
+            assert stored_results == {'photo_1_1': {'count': 1}}
+
+            journal.open(stored_results)
+            journal.append('photo_2_1', {'count': 2})
+            journal.append('photo_1_1', {'count': 10})
+            journal.append('photo_3_1', [3])
+            journal.close()
+            # Later entries override earlier ones, and the journal is used over the pickle
+            assert journal.load(legacy_pickle_path) == {
+                'photo_1_1': {'count': 10}, 'photo_2_1': {'count': 2}, 'photo_3_1': [3],
+            }
+
+            # A line cut short by a crash is skipped
+            with open(journal_path, 'a', encoding='utf-8') as journal_file:
+                journal_file.write('{"id": "photo_4_1", "res')
+            stored_results = journal.load()
+            assert sorted(stored_results) == ['photo_1_1', 'photo_2_1', 'photo_3_1']
+
+            # Reopening compacts the journal to one line per result
+            journal.open(stored_results)
+            journal.close()
+            with open(journal_path, encoding='utf-8') as journal_file:
+                assert len(journal_file.readlines()) == 3
+            assert journal.load() == stored_results
+
+    def test_benchmark_regressions(self):
+        """
+        compare_to_baseline only reports differences that are over the tolerance and not noise
+        """
+        photo = draw_synthetic_photo((160, 120), seed=3)
+        assert photo.size == (160, 120)
+        assert photo.tobytes() == draw_synthetic_photo((160, 120), seed=3).tobytes()
+
+        baseline = {'stdev': {'800x600': {
+            'seconds_per_photo': 0.1, 'peak_rss_mb': 100, 'failed': 0, 'results_digest': 'a',
+        }}}
+        benchmarks = {'stdev': {'800x600': {
+            'seconds_per_photo': 0.2, 'peak_rss_mb': 105, 'failed': 0, 'results_digest': 'b',
+        }}}
+        assert compare_to_baseline(benchmarks, baseline, tolerance=0.25) == [
+            'stdev at 800x600: seconds_per_photo went from 0.100 to 0.200',
+            'stdev at 800x600: results changed',
+        ]
+        assert not compare_to_baseline(baseline, baseline, tolerance=0.25)
@@ -0,0 +1,304 @@
+"""
+Tests for the syncdb command: listing and downloading photos in Google Drive, and
+syncing the database with the project Google Sheet
+"""
+import json
+import os
+import re
+import socket
+import ssl
+import tempfile
+import threading
+from pathlib import Path
+
+import httplib2
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from app.management.commands.syncdb import PhotoDownloader, PHOTO_FOLDER_ID, SIDES, \
+    create_lookup_dict, get_lookup_dict, populate_database
+from app.models import Photo, PhotoAnalysisResult, MapSquare, Photographer
+
+
+class FakeDriveService:
+    """
+    Stands in for a Google Drive service, serving files().get_media() from a dict of
+    file id -> content. Responses listed in errors[file id] are returned (or exceptions raised)
+    before the content, one per request, with None to serve the content for that request.
+    files().list() lists folders, a dict of folder id -> [(file id, name)], page_size at a time.
+    """
+
+    def __init__(self, files=None, errors=None, folders=None, page_size=2):
+        self.files_by_id = files or {}
+        self.errors = errors or {}
+        self.folders = folders or {}
+        self.page_size = page_size
+        self.requested_ranges = []
+        self.lock = threading.Lock()
+
+    def files(self):
+        return self
+
+    def list(self, q, fields, pageSize, pageToken=None):  # pylint: disable=invalid-name
+        """
+        files().list(): the files in the folders of q, page_size at a time
+        """
+        parent_ids = re.findall(r"'([^']+)' in parents", q)
+        files = [
+            {'id': file_id, 'name': name, 'parents': [parent_id]}
+            for parent_id in parent_ids
+            for file_id, name in self.folders.get(parent_id, [])
+        ]
+        start = int(pageToken or 0)
+        end = start + min(pageSize, self.page_size)
+        response = {'files': files[start:end]}
+        if end < len(files):
+            response['nextPageToken'] = str(end)
+        return type('FakeListRequest', (), {'execute': lambda self: response})()
+
+    def get_media(self, fileId):  # pylint: disable=invalid-name
+        # Enough of an HttpRequest for MediaIoBaseDownload
+        return type('FakeRequest', (), {'uri': fileId, 'http': self, 'headers': {}})()
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        """
+        Serve a ranged GET of a file, or the next of its errors
+        """
+        with self.lock:
+            error = self.errors[uri].pop(0) if self.errors.get(uri) else None
+            if isinstance(error, Exception):
+                raise error
+            if error is not None:
+                status, content = error
+                return httplib2.Response({'status': status}), content
+            self.requested_ranges.append((uri, headers['range']))
+        if uri not in self.files_by_id:
+            return httplib2.Response({'status': 404}), b'Not found'
+        content = self.files_by_id[uri]
+        start, end = (int(byte) for byte in headers['range'][len('bytes='):].split('-'))
+        chunk = content[start:end + 1]
+        return httplib2.Response({
+            'status': 206,
+            'content-range': f'bytes {start}-{start + len(chunk) - 1}/{len(content)}',
+        }), chunk
+
+
+class SyncdbDriveTests(SimpleTestCase):
+    """
+    Tests for how syncdb lists and downloads photos in Google Drive, against a fake Drive service
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def make_downloader(self, drive_service):
+        """
+        A PhotoDownloader on drive_service that retries without sleeping
+        """
+        downloader = PhotoDownloader(lambda: drive_service, max_workers=4, max_retries=2)
+        downloader.sleep = lambda seconds: None
+        self.addCleanup(downloader.shutdown)
+        return downloader
+
+    def test_downloads_with_retries(self):
+        """
+        Rate limited and server errors are retried until the photo is downloaded
+        """
+        files = {f'file{i}': os.urandom(1000 + i) for i in range(10)}
+        drive_service = FakeDriveService(files, errors={
+            'file0': [(429, b'Too many requests')],
+            'file1': [(403, b'{"reason": "userRateLimitExceeded"}'), (503, b'Unavailable')],
+        })
+        downloader = self.make_downloader(drive_service)
+        for file_id in files:
+            downloader.submit(file_id, Path(self.temp_dir.name, f'{file_id}.jpg'))
+
+        assert downloader.wait() == 0
+        for file_id, content in files.items():
+            assert Path(self.temp_dir.name, f'{file_id}.jpg').read_bytes() == content
+        assert not list(Path(self.temp_dir.name).glob('*.part'))
+
+    def test_failed_downloads(self):
+        """
+        Errors that are not transient fail the photo without retrying, and leave no file behind
+        """
+        drive_service = FakeDriveService({'forbidden': b'photo'}, errors={
+            'forbidden': [(403, b'{"reason": "insufficientFilePermissions"}')],
+        })
+        downloader = self.make_downloader(drive_service)
+        downloader.submit('forbidden', Path(self.temp_dir.name, 'forbidden.jpg'))
+        downloader.submit('missing', Path(self.temp_dir.name, 'missing.jpg'))
+
+        assert downloader.wait() == 2
+        assert not list(Path(self.temp_dir.name).iterdir())
+
+    def test_resumes_part_file(self):
+        """
+        A partial download is resumed from where it stopped with a range request
+        """
+        content = os.urandom(1000)
+        Path(self.temp_dir.name, 'photo.jpg.part').write_bytes(content[:600])
+        drive_service = FakeDriveService({'photo': content})
+        downloader = self.make_downloader(drive_service)
+        downloader.submit('photo', Path(self.temp_dir.name, 'photo.jpg'))
+
+        assert downloader.wait() == 0
+        assert Path(self.temp_dir.name, 'photo.jpg').read_bytes() == content
+        assert drive_service.requested_ranges[0][1].startswith('bytes=600-')
+
+    def test_retries_dropped_connections(self):
+        """
+        Dropped connections and timeouts are retried, resuming from what was downloaded
+        """
+        content = os.urandom(1000)
+        drive_service = FakeDriveService({'photo': content, 'flaky': content}, errors={
+            'photo': [None, socket.timeout('timed out'), ssl.SSLError('bad record mac')],
+            'flaky': [None] + [ConnectionResetError('reset by peer')] * 3,
+        })
+        downloader = self.make_downloader(drive_service)
+        downloader.chunk_size = 256
+        downloader.submit('photo', Path(self.temp_dir.name, 'photo.jpg'))
+        downloader.submit('flaky', Path(self.temp_dir.name, 'flaky.jpg'))
+
+        assert downloader.wait() == 1
+        assert Path(self.temp_dir.name, 'photo.jpg').read_bytes() == content
+        # Each retry requests the rest of the file rather than starting over
+        assert [byte_range for file_id, byte_range in drive_service.requested_ranges
+                if file_id == 'photo'] == [
+            'bytes=0-255', 'bytes=256-511', 'bytes=512-767', 'bytes=768-1023',
+        ]
+        # Out of retries, what was downloaded is kept for the next run to resume
+        assert Path(self.temp_dir.name, 'flaky.jpg.part').read_bytes() == content[:256]
+        assert not Path(self.temp_dir.name, 'flaky.jpg').exists()
+
+    def test_create_lookup_dict(self):
+        """
+        create_lookup_dict lists the map square folders several at a time, in threads
+        """
+        folders = {PHOTO_FOLDER_ID: [(f'folder{i}', str(i)) for i in range(1, 6)]}
+        for i in range(1, 6):
+            folders[f'folder{i}'] = [
+                (f'{i}_{j}_{side}', f'{j}_{side}.JPG') for j in range(3) for side in SIDES
+            ]
+        drive_service = FakeDriveService(folders=folders)
+
+        lookup_dict = create_lookup_dict(
+            drive_service, lambda: drive_service, max_workers=2, parents_per_query=2
+        )
+        assert sorted(lookup_dict) == ['1', '2', '3', '4', '5']
+        assert lookup_dict['4']['GOOGLE_DRIVE_MAP_SQUARE_FOLDER_ID'] == 'folder4'
+        assert lookup_dict['4']['2'] == {f'2_{side}.jpg': f'4_2_{side}' for side in SIDES}
+
+    def test_lookup_dict_cache(self):
+        """
+        get_lookup_dict uses the cached listing until it is refreshed or expires
+        """
+        folders = {PHOTO_FOLDER_ID: [('folder1', '1')], 'folder1': [('1_0_recto', '0_recto.jpg')]}
+        drive_service = FakeDriveService(folders=folders)
+        cache_file = Path(self.temp_dir.name, 'drive_lookup_cache.json')
+
+        with override_settings(DRIVE_LOOKUP_CACHE_FILE=str(cache_file)):
+            assert get_lookup_dict(drive_service)['1']['0'] == {'0_recto.jpg': '1_0_recto'}
+            assert json.loads(cache_file.read_text(encoding='utf-8'))['1']['0'] \
+                == {'0_recto.jpg': '1_0_recto'}
+
+            # Photos added to Drive are only listed once the cache is refreshed
+            folders['folder1'].append(('1_0_verso', '0_verso.jpg'))
+            assert '0_verso.jpg' not in get_lookup_dict(drive_service)['1']['0']
+            assert '0_verso.jpg' in get_lookup_dict(drive_service, refresh=True)['1']['0']
+            assert '0_verso.jpg' in get_lookup_dict(drive_service)['1']['0']
+
+            # or once it expires
+            folders['folder1'].append(('1_1_recto', '1_recto.jpg'))
+            with override_settings(DRIVE_LOOKUP_CACHE_TTL=0):
+                assert '1' in get_lookup_dict(drive_service)['1']
+
+
+class SyncdbPopulateTests(TestCase):
+    """
+    Tests for how syncdb writes spreadsheet rows to the database
+    """
+
+    def setUp(self):
+        for number in range(1, 3):
+            MapSquare.objects.create(number=number, name=f'map square {number}')
+        self.photographer_rows = [
+            {'number': '1', 'name': 'Bob Frenchman', 'map_square_number': '1'},
+            {'number': '2', 'name': 'Waddle Dee', 'map_square_number': '2'},
+        ]
+        self.photo_rows = [
+            {'number': '1', 'map_square_number': '1', 'photographer': '1', 'alt': 'A street'},
+            {'number': '2', 'map_square_number': '1', 'photographer': '2', 'alt': 'A cafe'},
+            {'number': '1', 'map_square_number': '2', 'photographer_name': 'Waddle Dee',
+             'alt': 'A park'},
+        ]
+
+    @staticmethod
+    def sync(model_name, rows, delete_missing=False):
+        """ Run populate_database on rows, with no Drive photos """
+        return populate_database(model_name, rows, {}, None, False, False, delete_missing)
+
+    def test_incremental_sync(self):
+        """
+        Syncing again only changes the rows that changed, and reports or deletes missing rows
+        """
+        assert self.sync('Photographer', self.photographer_rows) == {'created': 2}
+        assert self.sync('Photo', self.photo_rows) == {'created': 3}
+        photo = Photo.objects.get(map_square__number=1, number=1)
+        PhotoAnalysisResult.objects.create(name='yolo_model', result='{}', photo=photo)
+
+        self.photo_rows[0]['alt'] = 'A busy street'
+        assert self.sync('Photo', self.photo_rows) == {'updated': 1, 'unchanged': 2}
+        updated_photo = Photo.objects.get(map_square__number=1, number=1)
+        assert updated_photo.pk == photo.pk
+        assert updated_photo.alt == 'A busy street'
+        # Analysis results of updated photos are kept
+        assert PhotoAnalysisResult.objects.filter(photo=updated_photo).count() == 1
+
+        # Nothing changed, so nothing is written
+        with CaptureQueriesContext(connection) as queries:
+            assert self.sync('Photo', self.photo_rows) == {'unchanged': 3}
+        assert not [query for query in queries.captured_queries
+                    if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+        # Rows that were deleted from the spreadsheet are reported, and only deleted if asked
+        assert self.sync('Photo', self.photo_rows[1:]) == {'unchanged': 2, 'missing': 1}
+        assert Photo.objects.count() == 3
+        assert self.sync('Photo', self.photo_rows[1:], delete_missing=True) == {
+            'unchanged': 2, 'missing': 1, 'deleted': 1,
+        }
+        assert not Photo.objects.filter(pk=photo.pk).exists()
+        assert not PhotoAnalysisResult.objects.filter(name='yolo_model').exists()
+
+    def test_bulk_creation_resolves_foreign_keys(self):
+        """
+        New rows are created in bulk, with their foreign keys resolved in a constant number of
+        queries
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.sync('Photographer', self.photographer_rows)
+        num_queries = len(queries)
+        photographers = {photographer.number: photographer
+                         for photographer in Photographer.objects.select_related('map_square')}
+        assert photographers[2].map_square.number == 2
+
+        # Foreign keys point at the saved rows, looked up by number (or photographer name)
+        self.sync('Photo', self.photo_rows)
+        photos = Photo.objects.select_related('map_square', 'photographer')
+        assert sorted((photo.map_square.number, photo.number, photo.photographer_id)
+                      for photo in photos) == [
+            (1, 1, photographers[1].pk), (1, 2, photographers[2].pk), (2, 1, photographers[2].pk),
+        ]
+
+        # Rows are created in bulk, so more rows don't take more queries
+        more_photographer_rows = [
+            {'number': str(number), 'name': f'Photographer {number}', 'map_square_number': '1'}
+            for number in range(3, 50)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            assert self.sync('Photographer', self.photographer_rows + more_photographer_rows) \
+                == {'unchanged': 2, 'created': 47}
+        assert len(queries) == num_queries
@@ -33,6 +33,9 @@ from .serializers import (
     CorpusAnalysisResultsSerializer
 )
 
+# Most photos previous_next_photos returns after the current one
+MAX_PREFETCHED_PHOTOS = 20
+
 ANALYSIS_TAGS = {
     'detail_fft2': 'detail_fft2',
     'find_vanishing_point': 'find_vanishing_point',
@@ -71,24 +74,27 @@ def photo(request, map_square_number, photo_number):
 def previous_next_photos(request, map_square_number, photo_number):
     """
     API endpoint to get the previous and next photos given the map square number and
-    photo number of the current photo
-    """
-    photo_obj = Photo.objects.get(number=photo_number, map_square__number=map_square_number)
-    resp = []
-    if photo_obj.id > 1:
-        previous_photo_object = Photo.objects.get(id=photo_obj.id - 1)
-        previous_serialized = PhotoSerializer(previous_photo_object)
-        resp.append(previous_serialized.data)
-    else:
-        resp.append("")
-
-    if photo_obj.id < len(Photo.objects.all()):
-        next_photo_object = Photo.objects.get(id=photo_obj.id + 1)
-        next_serialized = PhotoSerializer(next_photo_object)
-        resp.append(next_serialized.data)
-    else:
-        resp.append("")
+    photo number of the current photo, in order of map square number and then photo number
+    ("" if there is none)
 
+    With ?prefetch=n, the n - 1 photos after the next one are added to the end of the list,
+    so that paging forward doesn't need a request per photo
+    """
+    photo_obj = Photo.objects.select_related('map_square').get(
+        number=photo_number, map_square__number=map_square_number
+    )
+    try:
+        num_next = min(max(int(request.GET.get('prefetch', 1)), 1), MAX_PREFETCHED_PHOTOS)
+    except ValueError:
+        num_next = 1
+
+    previous_photos = list(photo_obj.get_neighbors(previous=True))
+    next_photos = list(photo_obj.get_neighbors(count=num_next))
+    resp = [
+        PhotoSerializer(previous_photos[0]).data if previous_photos else "",
+        PhotoSerializer(next_photos[0]).data if next_photos else "",
+    ]
+    resp += PhotoSerializer(next_photos[1:], many=True).data
     return Response(resp)
 
 
@@ -117,7 +123,7 @@ def all_map_squares(request):
     """
     API endpoint to get all map squares in the database for landing page
     """
-    map_square_obj = MapSquare.objects.all()
+    map_square_obj = MapSquare.objects.with_num_photos()
     serializer = MapSquareSerializerWithoutPhotos(map_square_obj, many=True)
     return Response(serializer.data)
 
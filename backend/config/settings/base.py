@@ -19,6 +19,9 @@ DB_PATH = os.path.join(BACKEND_DIR, 'db.sqlite3')
 PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
 BACKEND_DATA_DIR = os.path.join(BACKEND_DIR, 'data')
 GOOGLE_TOKEN_FILE = os.path.join(BACKEND_DIR, 'token.pickle')
+# syncdb caches its listing of the photos in Google Drive here, for DRIVE_LOOKUP_CACHE_TTL seconds
+DRIVE_LOOKUP_CACHE_FILE = os.path.join(BACKEND_DIR, 'drive_lookup_cache.json')
+DRIVE_LOOKUP_CACHE_TTL = 24 * 60 * 60
 ANALYSIS_DIR = Path(PROJECT_ROOT, 'backend', 'app', 'analysis')
 ANALYSIS_PICKLE_PATH = Path(BACKEND_DIR, ANALYSIS_DIR, 'analysis_results')
 LOCAL_PHOTOS_DIR = "/static/images/photos"
@@ -26,6 +29,18 @@ TEST_PHOTOS_DIR = Path(PROJECT_ROOT, 'backend', 'data', 'test_photos')
 TESSDATA_DIR = Path(PROJECT_ROOT, 'backend', 'data', 'tessdata')
 TEXT_DETECTION_PATH = Path(BACKEND_DATA_DIR, 'frozen_east_text_detection.pb')
 YOLO_DIR = Path(ANALYSIS_DIR, 'yolo_files')
+# Opt-in on-disk cache of decoded photos for repeat analysis runs (see app/image_cache.py)
+# Set to a directory (e.g. Path(ANALYSIS_PICKLE_PATH, 'decoded_images')) to enable
+DECODED_IMAGE_CACHE_DIR = None
+DECODED_IMAGE_CACHE_MAX_BYTES = 20 * 2 ** 30
+
+# When enabled, app.middleware.QueryStatsMiddleware adds X-Query-Count and X-DB-Time (in ms)
+# headers to every response, and logs the requests that go over these limits along with their
+# slowest queries
+QUERY_STATS_ENABLED = False
+QUERY_STATS_MAX_QUERIES = 50
+QUERY_STATS_MAX_DB_TIME = 0.5  # seconds
+QUERY_STATS_NUM_SLOWEST = 5
 BLOG_ROOT_URL = "blog"
 
 # See https://docs.djangoproject.com/en/3.0/howto/deployment/checklist/
@@ -64,6 +79,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.QueryStatsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
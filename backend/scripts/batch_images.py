@@ -0,0 +1,101 @@
+"""
+Shared helpers for the batch image scripts (imageconversion.py and cropborder.py)
+
+Files are processed in a pool of processes with Pillow, falling back on ImageMagick's
+`magick` (if it's installed) for anything Pillow can't handle.
+"""
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+BAR_FORMAT = '{l_bar}{bar:30}{r_bar}{bar:-10b}'
+
+# Pillow format names for the file extensions we write
+PIL_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'tif': 'TIFF',
+    'tiff': 'TIFF',
+    'webp': 'WEBP',
+}
+
+
+def is_up_to_date(out_file, in_file):
+    """
+    Whether out_file exists and is newer than in_file
+    """
+    try:
+        return os.path.getmtime(out_file) >= os.path.getmtime(in_file)
+    except OSError:
+        return False
+
+
+def magick_available():
+    return shutil.which('magick') is not None
+
+
+def run_magick(args):
+    """
+    Run ImageMagick with a list of arguments (not through a shell, so paths can have spaces)
+    """
+    subprocess.run(['magick', *args], check=True, capture_output=True)
+
+
+def to_8_bit(image):
+    """
+    Scale a 16 bit grayscale image (Pillow modes I;16* and I, as 16 bit TIFFs and PNGs are
+    opened) down to an 8 bit 'L' image, since Pillow's convert('L') and convert('RGB') clip their
+    values at 255 instead. Other images are returned as is.
+    """
+    if not (image.mode.startswith('I;16') or image.mode == 'I'):
+        return image
+    pixels = np.clip(np.asarray(image, dtype=np.int64), 0, 2 ** 16 - 1)
+    return Image.fromarray((pixels >> 8).astype(np.uint8), 'L')
+
+
+def save_image(image, out_file, quality=None):
+    """
+    Save a Pillow image in the format for out_file's extension, via a temporary file so that an
+    interrupted run never leaves a partial output behind
+    """
+    extension = os.path.splitext(out_file)[1][1:].lower()
+    pil_format = PIL_FORMATS.get(extension)
+    if pil_format is None:
+        raise ValueError(f'Unsupported output format: {extension}')
+    if pil_format == 'JPEG' and image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+
+    save_options = {}
+    if quality is not None and pil_format in ('JPEG', 'WEBP'):
+        save_options['quality'] = quality
+    temp_file = f'{out_file}.tmp'
+    image.save(temp_file, pil_format, **save_options)
+    os.replace(temp_file, out_file)
+
+
+def run_batch(jobs, process_file, workers=None):
+    """
+    Call process_file(*job) for each job in a pool of workers processes (by default one per
+    core), showing a progress bar. Jobs that fail are reported rather than stopping the batch.
+
+    :return: list of (job, error) for the jobs that failed
+    """
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_file, *job) for job in jobs]
+        for job, future in tqdm(zip(jobs, futures), total=len(jobs), bar_format=BAR_FORMAT):
+            try:
+                future.result()
+            except Exception as job_error:  # pylint: disable=broad-except
+                failures.append((job, job_error))
+
+    for job, error in failures:
+        print(f'Error: {error}')
+        print(f'Skipping {job[0]}')
+    return failures
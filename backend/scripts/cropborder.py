@@ -1,12 +1,62 @@
 import os
-import subprocess
-from tqdm import tqdm
 import sys
 
+import numpy as np
+from PIL import Image
 
-def crop_border(old_path, new_path, fuzz_val='20'):
+try:
+    from scripts.batch_images import is_up_to_date, magick_available, run_batch, run_magick, \
+        save_image, to_8_bit
+except ImportError:  # run as python scripts/cropborder.py
+    from batch_images import is_up_to_date, magick_available, run_batch, run_magick, \
+        save_image, to_8_bit
+
+
+def find_content_box(image, fuzz_val):
+    """
+    Find the bounding box of the pixels that aren't white, treating colors within fuzz_val percent
+    (root mean square distance over the channels) of white as white, like Image Magick's -fuzz
+
+    :return: (left, upper, right, lower), or None if the whole image is white
+    """
+    pixels = np.asarray(to_8_bit(image).convert('RGB'), dtype=np.float32)
+    distance = np.sqrt(np.mean((255 - pixels) ** 2, axis=2)) / 255
+    content = distance > float(fuzz_val) / 100
+
+    rows = np.flatnonzero(content.any(axis=1))
+    columns = np.flatnonzero(content.any(axis=0))
+    if not rows.size:
+        return None
+    return columns[0], rows[0], columns[-1] + 1, rows[-1] + 1
+
+
+def crop_file(in_file, out_file, fuzz_val, use_magick=False):
     """
-    Python script for cropping white borders off slides using Image Magick
+    Crop the white border off a single image with Pillow, or Image Magick if use_magick
+    (or Pillow can't read the file)
+    """
+    if not use_magick:
+        try:
+            with Image.open(in_file) as image:
+                image = to_8_bit(image)
+                box = find_content_box(image, fuzz_val)
+                if box is not None:
+                    image = image.crop(box)
+                save_image(image, out_file, quality=95)
+            return
+        except (OSError, ValueError):
+            if not magick_available():
+                raise
+
+    # adds 1 pixel wide white border, and trims based on fuzz (mean color distance)
+    run_magick(['convert', in_file, '-bordercolor', 'white', '-border', '1',
+                '-fuzz', f'{fuzz_val}%', '-trim', '-background', 'white', out_file])
+
+
+def crop_border(old_path, new_path, fuzz_val='20', workers=None, use_magick=False):
+    """
+    Python script for cropping white borders off slides, in parallel with Pillow
+    (or Image Magick)
 
     :param old_path: (str) path to directory containing images
             [ex. 'Users/bob/Desktop/']
@@ -14,7 +64,10 @@ def crop_border(old_path, new_path, fuzz_val='20'):
             [ex. 'Users/bob/Desktop/new/']
     :param fuzz_val: (str) percentage value for Image Magick fuzz command, default 20
             [ex. 55]
-    :return: None, output produced in new directory
+    :param workers: (int) number of processes, default = one per core
+    :param use_magick: (bool) crop with Image Magick instead of Pillow, default False
+    :return: None, output produced in new directory (images whose output is newer than them
+             are skipped)
     """
 
     # creating new directory (and all intermediate-level directories) for output
@@ -23,19 +76,15 @@ def crop_border(old_path, new_path, fuzz_val='20'):
     except FileExistsError:
         pass
 
-    # loop through images running command
-    for img in tqdm(os.listdir(old_path), bar_format='{l_bar}{bar:30}{r_bar}{bar:-10b}'):
+    jobs = []
+    for img in os.listdir(old_path):
         # create new and old paths
         in_file = os.path.join(old_path, img)
         out_file = os.path.join(new_path, img)
+        if os.path.isfile(in_file) and not is_up_to_date(out_file, in_file):
+            jobs.append((in_file, out_file, fuzz_val, use_magick))
 
-        # formatting command
-        # ex. magick convert Users/bob/Desktop/old/img3.jpg -bordercolor white -border 1 -fuzz 20%
-        # -trim -background white Users/bob/Desktop/new/img3.jpg
-        cmd = f'magick convert {in_file} -bordercolor white -border 1 -fuzz {fuzz_val}% -trim ' \
-              f'-background white {out_file}'
-        # adds 1 pixel wide white border, and trims based on fuzz (mean color distance)
-        subprocess.run(cmd, shell=True, capture_output=True)
+    run_batch(jobs, crop_file, workers)
 
 
 if __name__ == '__main__':
@@ -57,6 +106,3 @@ if __name__ == '__main__':
         # provided fuzz percentage
         fuzz_arg = sys.argv[3]  # argument 3 fuzz_val
         crop_border(old_path_arg, new_path_arg, fuzz_arg)
-
-
-
@@ -1,13 +1,83 @@
 import os
-import subprocess
-from tqdm import tqdm
+import re
 import sys
 
+from PIL import Image
 
-def convert(old_path, new_path, old_filetype, new_filetype, commands=None):
+try:
+    from scripts.batch_images import is_up_to_date, magick_available, run_batch, run_magick, \
+        save_image, to_8_bit
+except ImportError:  # run as python scripts/imageconversion.py
+    from batch_images import is_up_to_date, magick_available, run_batch, run_magick, \
+        save_image, to_8_bit
+
+
+def parse_commands(commands):
+    """
+    Translate the ImageMagick options that we can apply with Pillow (-quality N, and
+    -thumbnail/-resize WxH) into a dict of settings for convert_file
+
+    :return: the settings, or None if some options need ImageMagick
+    """
+    pil_settings = {}
+    i = 0
+    while i < len(commands):
+        option = commands[i]
+        value = commands[i + 1] if i + 1 < len(commands) else ''
+        size_match = re.fullmatch(r'(\d*)x(\d*)', value)
+        if option == '-quality' and value.rstrip('%').isdigit():
+            pil_settings['quality'] = int(value.rstrip('%'))
+        elif option in ('-thumbnail', '-resize') and size_match and any(size_match.groups()):
+            pil_settings['size'] = tuple(int(dim) if dim else None for dim in size_match.groups())
+        else:
+            return None
+        i += 2
+    return pil_settings
+
+
+def fit_within(image, size):
+    """
+    Resize image to fit in a (width, height) box, keeping its aspect ratio like ImageMagick's
+    -resize (either dimension may be None)
     """
-    Python script for image conversion using Image Magick
-    
+    width, height = size
+    scale = min(
+        width / image.width if width else float('inf'),
+        height / image.height if height else float('inf'),
+    )
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if new_size == image.size:
+        return image
+    if image.format == 'JPEG' and scale < 1:
+        # Let libjpeg decode at a reduced scale first, which is much faster
+        image.draft(image.mode, new_size)
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def convert_file(in_file, out_file, pil_settings, commands):
+    """
+    Convert a single image with Pillow, or ImageMagick if pil_settings is None
+    (or Pillow can't read the file)
+    """
+    if pil_settings is not None:
+        try:
+            with Image.open(in_file) as image:
+                image = to_8_bit(image)
+                if 'size' in pil_settings:
+                    image = fit_within(image, pil_settings['size'])
+                save_image(image, out_file, pil_settings.get('quality'))
+            return
+        except (OSError, ValueError):
+            if not magick_available():
+                raise
+    run_magick([in_file, *commands, out_file])
+
+
+def convert(old_path, new_path, old_filetype, new_filetype, commands=None, workers=None):
+    """
+    Python script for image conversion, in parallel with Pillow for the common options and
+    Image Magick for the rest
+
     :param old_path: (str) path to directory containing images
             [ex. 'Users/bob/Desktop/']
     :param new_path: (str) path where output is intended to be saved in
@@ -18,8 +88,12 @@ def convert(old_path, new_path, old_filetype, new_filetype, commands=None):
             [ex. 'jpg']
     :param commands: (list) commands to apply to images, default = None
             [ex. ['-quality, '20%']
-    :return: None, output produced in new directory
+    :param workers: (int) number of processes, default = one per core
+    :return: None, output produced in new directory (images whose output is newer than them
+             are skipped)
     """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    commands = commands or []
 
     # creating new directory for output
     try:
@@ -27,24 +101,22 @@ def convert(old_path, new_path, old_filetype, new_filetype, commands=None):
     except FileExistsError:
         pass
 
-    # str of commands to apply to images
-    command_str = ''
-    for i in commands:
-        command_str += i + ' '
+    pil_settings = parse_commands(commands)
+    if pil_settings is None and not magick_available():
+        raise ValueError(f'Image Magick is needed for these commands: {" ".join(commands)}')
 
+    jobs = []
     # looping through old directory
-    for tif_path in tqdm(os.listdir(old_path), bar_format='{l_bar}{bar:30}{r_bar}{bar:-10b}'):
+    for tif_path in os.listdir(old_path):
         old_type = os.path.join(old_path, tif_path)
         if os.path.isfile(old_type) and old_type.endswith(old_filetype):
             # formatting new filename ex. '/square.jpg'
             name = os.path.splitext(tif_path)[0] + "." + new_filetype
             new_type = os.path.join(new_path, name)
+            if not is_up_to_date(new_type, old_type):
+                jobs.append((old_type, new_type, pil_settings, commands))
 
-            # formatting command
-            # ex. magick Users/bob/Desktop/old/square.jpg -quality 20%
-            # Users/bob/Desktop/new/square.jpg
-            cmd = f'magick {old_type} {command_str}{new_type}'
-            subprocess.run(cmd, shell=True, capture_output=True)
+    run_batch(jobs, convert_file, workers)
 
 
 if __name__ == "__main__":